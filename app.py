@@ -1,166 +1,701 @@
 import os
 import io
-import base64
+import math
+import json
+import time
 import random
-from flask import Flask, render_template, request, jsonify
+import uuid
+import socket
+import select
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeout
+from flask import Flask, Response, render_template, request, jsonify, url_for, g
 from PIL import Image
-import diffusers
-from utils.model_loader import get_pipeline_for_mode, cleanup_models 
-from utils.image_utils import remove_background, load_style_images, load_image_from_path 
-from utils.config import STYLE_LIBRARIES, NUM_STYLE_IMAGES_PER_LIBRARY
-from generators.text_emoji import generate_text_emoji
-from generators.face_style_emoji import generate_face_style_emoji
-from generators.text_style_emoji import generate_text_style_emoji
+# Only light modules are imported here; torch/diffusers load on the warm-up thread (or on
+# first use), so the app starts serving /healthz immediately.
+from utils import config
+from utils.image_utils import load_image_from_path, encode_image
+from utils.background_removal import submit_background_removal
+from utils.batch_scheduler import GenerationRequest, GenerationError, GenerationCancelled, DeadlineExceeded
+from utils.admission import submit_admitted, AdmissionRejected
+from utils.jobs import job_store
+from utils.quality import resolve_quality_tier
+from utils.result_cache import result_cache, image_store, content_key
+from utils.face_embeddings import face_embeds_cache, normalize_face_upload
+from utils.packs import parse_sizes, pack_generation_size, downsample_rgba, build_sprite_atlas, stream_zip_pack
+from utils.warmup import start_warmup, readiness
+from utils.worker_pool import start_worker_pool
+from utils.metrics import timed, observe_stage, log_event, render_metrics, HTTP_REQUESTS, HTTP_SECONDS, REQUESTS_ABANDONED
+from utils.config import (
+    STYLE_LIBRARIES, JOB_POSTPROCESS_WORKERS, SSE_HEARTBEAT_SECONDS,
+    PREVIEW_INTERVAL_STEPS, PREVIEW_SIZE, QUALITY_TIERS,
+    IMAGE_FORMATS, DEFAULT_IMAGE_FORMAT, DEFAULT_PNG_COMPRESS_LEVEL, DEFAULT_WEBP_METHOD, IMAGE_CACHE_MAX_AGE,
+    MAX_UPLOAD_BYTES, MAX_VARIANTS, PACK_NATIVE_RESOLUTION, WORKERS,
+    REQUEST_DEADLINE_SECONDS, DISCONNECT_POLL_SECONDS, TEXT_EMOJI_PROMPT_SUFFIX,
+    DEEP_CACHE_INTERVAL, DEEP_CACHE_MAX_INTERVAL, DEEP_CACHE_DEPTH, DEEP_CACHE_SCHEDULE
+)
 
 
 app = Flask(__name__)
+app.config["MAX_CONTENT_LENGTH"] = MAX_UPLOAD_BYTES + 2**20 # Face upload plus the form fields
 
-# --- Routes ---
+# Background removal and encoding for async jobs run here, off the scheduler thread
+postprocess_pool = ThreadPoolExecutor(max_workers=JOB_POSTPROCESS_WORKERS, thread_name_prefix="postprocess")
+# Variants of one request are matted and encoded concurrently
+variant_pool = ThreadPoolExecutor(max_workers=MAX_VARIANTS, thread_name_prefix="variant")
 
-@app.route('/')
-def index():
-    """Renders the main HTML page."""
-    # Pass available style names to the template if needed (dynamic select)
-    # available_styles = list(STYLE_LIBRARIES.keys())
-    return render_template('index.html') # Renders templates/index.html
+# --- Helpers ---
 
-@app.route('/api/generate', methods=['POST'])
-def api_generate():
-    """API endpoint to handle emoji generation requests."""
+def parse_generation_request():
+    """Validates the form and builds a GenerationRequest.
+
+    Returns (generation_request, None) on success or (None, (response, status)) on a client error.
+    """
     # --- Get Data from Request ---
+    mode = request.form.get('mode', 'text')
+    prompt = request.form.get('prompt', '')
+    negative_prompt = request.form.get('negative_prompt', None) # Use None if empty
+    style_name = request.form.get('style', list(STYLE_LIBRARIES.keys())[0] if STYLE_LIBRARIES else None)
+    face_image_file = request.files.get('face_image', None)
+    # NEW: Get slider values
+    guidance_scale = float(request.form.get('guidance_scale', 5.0))
+    style_scale = float(request.form.get('style_scale', 0.4))
+    face_scale = float(request.form.get('face_scale', 0.7))
+    quality = request.form.get('quality', config.DEFAULT_QUALITY)
+    # Latent preview options (only used by the async job API)
+    try:
+        preview_interval = max(0, int(request.form.get('preview_interval', PREVIEW_INTERVAL_STEPS)))
+        preview_size = min(512, max(32, int(request.form.get('preview_size', PREVIEW_SIZE))))
+    except ValueError:
+        return None, (jsonify({"error": "preview_interval and preview_size must be integers."}), 400)
+    # Output encoding: PNG (effort = compress level 0-9) or lossless WebP (effort = method 0-6)
+    image_format = request.form.get('format', DEFAULT_IMAGE_FORMAT).lower()
+    if image_format not in IMAGE_FORMATS:
+        return None, (jsonify({"error": f"Unsupported format: {image_format}"}), 400)
+    max_effort = 9 if image_format == "png" else 6
+    default_effort = DEFAULT_PNG_COMPRESS_LEVEL if image_format == "png" else DEFAULT_WEBP_METHOD
+    try:
+        image_effort = min(max_effort, max(0, int(request.form.get('effort', default_effort))))
+    except ValueError:
+        return None, (jsonify({"error": "Effort must be an integer."}), 400)
+    try:
+        count = int(request.form.get('count', 1)) # Variants with consecutive seeds, one pipeline call
+    except ValueError:
+        return None, (jsonify({"error": "Count must be an integer."}), 400)
+    # Optional multi-size pack (e.g. sizes=32,64,128,256) as a streamed ZIP or a sprite atlas
+    pack_sizes = None
+    if request.form.get('sizes'):
+        try:
+            pack_sizes = parse_sizes(request.form['sizes'])
+        except ValueError as e:
+            return None, (jsonify({"error": str(e)}), 400)
+    pack_format = request.form.get('pack', 'zip')
+    if pack_format not in ("zip", "atlas"):
+        return None, (jsonify({"error": f"Unsupported pack: {pack_format} (expected zip or atlas)"}), 400)
+    # Generation is abandoned after the deadline (seconds from arrival, at most REQUEST_DEADLINE_SECONDS)
+    deadline_seconds = REQUEST_DEADLINE_SECONDS
+    if request.form.get('deadline'):
+        try:
+            requested_deadline = float(request.form['deadline'])
+        except ValueError:
+            return None, (jsonify({"error": "Deadline must be a number of seconds."}), 400)
+        if not math.isfinite(requested_deadline) or requested_deadline <= 0:
+            return None, (jsonify({"error": "Deadline must be a positive, finite number of seconds."}), 400)
+        deadline_seconds = min(requested_deadline, REQUEST_DEADLINE_SECONDS) if REQUEST_DEADLINE_SECONDS > 0 else requested_deadline
+    # Opt-in UNet feature caching: full UNet every `deep_cache` steps, cached deep features in between
     try:
-        mode = request.form.get('mode', 'text')
-        prompt = request.form.get('prompt', '')
-        negative_prompt = request.form.get('negative_prompt', None) # Use None if empty
-        style_name = request.form.get('style', list(STYLE_LIBRARIES.keys())[0] if STYLE_LIBRARIES else None)
-        face_image_file = request.files.get('face_image', None)
-        # NEW: Get slider values
-        guidance_scale = float(request.form.get('guidance_scale', 5.0))
-        style_scale = float(request.form.get('style_scale', 0.4))
-        face_scale = float(request.form.get('face_scale', 0.7))
-
-        print(f"\nReceived generation request:")
-        print(f"  Mode: {mode}")
-        print(f"  Prompt: '{prompt}'")
-        print(f"  Negative Prompt: '{negative_prompt}'")
-        print(f"  Style Name: {style_name}")
-        print(f"  Face Image Provided: {'Yes' if face_image_file else 'No'}")
-        print(f"  Guidance Scale: {guidance_scale}")
-        print(f"  Style Scale: {style_scale}")
-        print(f"  Face Scale: {face_scale}")
-
-        # --- Input Validation ---
-        if not prompt:
-            return jsonify({"error": "Prompt is required."}), 400
-
-        generated_image = None
+        deep_cache_interval = int(request.form.get('deep_cache', DEEP_CACHE_INTERVAL))
+    except ValueError:
+        return None, (jsonify({"error": "deep_cache must be an integer interval."}), 400)
+    if not 0 <= deep_cache_interval <= DEEP_CACHE_MAX_INTERVAL:
+        return None, (jsonify({"error": f"deep_cache must be between 0 and {DEEP_CACHE_MAX_INTERVAL}."}), 400)
+
+    print(f"\nReceived generation request:")
+    print(f"  Mode: {mode}")
+    print(f"  Prompt: '{prompt}'")
+    print(f"  Negative Prompt: '{negative_prompt}'")
+    print(f"  Style Name: {style_name}")
+    print(f"  Face Image Provided: {'Yes' if face_image_file else 'No'}")
+    print(f"  Guidance Scale: {guidance_scale}")
+    print(f"  Style Scale: {style_scale}")
+    print(f"  Face Scale: {face_scale}")
+    print(f"  Quality: {quality}")
+    print(f"  Variants: {count}")
+    print(f"  Deep cache interval: {deep_cache_interval or 'off'}")
+
+    # --- Input Validation ---
+    if not prompt:
+        return None, (jsonify({"error": "Prompt is required."}), 400)
+    if not 1 <= count <= MAX_VARIANTS:
+        return None, (jsonify({"error": f"Count must be between 1 and {MAX_VARIANTS}."}), 400)
+    if quality not in QUALITY_TIERS:
+        return None, (jsonify({"error": f"Invalid quality: {quality} (expected one of {list(QUALITY_TIERS)})"}), 400)
+
+    # Optional seed: identical requests with the same seed produce (and cache) the same image
+    seed_value = request.form.get('seed', '').strip()
+    if seed_value:
+        try:
+            seed = int(seed_value)
+        except ValueError:
+            return None, (jsonify({"error": "Seed must be an integer."}), 400)
+        if not 0 <= seed < 2**32:
+            return None, (jsonify({"error": "Seed must be between 0 and 2^32 - 1."}), 400)
+    else:
         seed = random.randint(0, 2**32 - 1) # Generate random seed for variation
-        print(f"  Using Seed: {seed}")
-
-        # --- Mode-Specific Logic ---
-        pipeline_to_use = get_pipeline_for_mode(mode)
-        if not pipeline_to_use:
-            return jsonify({"error": f"{mode.capitalize()} generation model not loaded."}), 500
-
-        if mode == 'text':
-            # Add emoji style suffix to prompt
-            emoji_style_suffix = (
-                "Apple Emoji Style, Plain Matte White background, centered, minimal, no text, "
-                "no watermark, no border, high contrast, simple, clean, isolated, icon, 3D, soft shadow"
-            )
-            full_prompt = f"{prompt.strip()}, {emoji_style_suffix}"
-            generated_image = generate_text_emoji(
-                pipe=pipeline_to_use,
-                prompt=full_prompt,
-                negative_prompt=negative_prompt,
-                guidance_scale=guidance_scale,
-                seed=seed
-            )
+    print(f"  Using Seed: {seed}")
 
-        elif mode == 'text_style':
-            if not style_name or style_name not in STYLE_LIBRARIES:
-                return jsonify({"error": f"Invalid style selected: {style_name}"}), 400
-
-            style_dir = STYLE_LIBRARIES[style_name]
-            style_images = load_style_images(style_dir, NUM_STYLE_IMAGES_PER_LIBRARY)
-            if not style_images:
-                return jsonify({"error": f"Could not load style images from '{style_dir}'."}), 500
-
-            generated_image = generate_text_style_emoji(
-                pipe=pipeline_to_use,
-                style_images=style_images,
-                prompt=prompt,
-                negative_prompt=negative_prompt,
-                style_scale=style_scale,
-                guidance_scale=guidance_scale,
-                seed=seed
-            )
+    # --- Mode-Specific Logic ---
+    # Validation and input decoding happen here; generation itself runs on the
+    # shared batch scheduler thread, which owns the pipeline.
+    if mode == 'text':
+        # Add emoji style suffix to prompt
+        full_prompt = f"{prompt.strip()}, {TEXT_EMOJI_PROMPT_SUFFIX}"
+        generation_request = GenerationRequest(
+            mode=mode,
+            prompt=full_prompt,
+            negative_prompt=negative_prompt,
+            guidance_scale=guidance_scale,
+            seed=seed
+        )
 
-        elif mode == 'face_style':
-            if not face_image_file:
-                return jsonify({"error": "Face image is required for Face+Style mode."}), 400
-            if not style_name or style_name not in STYLE_LIBRARIES:
-                return jsonify({"error": f"Invalid style selected: {style_name}"}), 400
+    elif mode == 'text_style':
+        if not style_name or style_name not in STYLE_LIBRARIES:
+            return None, (jsonify({"error": f"Invalid style selected: {style_name}"}), 400)
 
-            # Load face image from upload
+        generation_request = GenerationRequest(
+            mode=mode,
+            prompt=prompt,
+            negative_prompt=negative_prompt,
+            style_name=style_name,
+            style_scale=style_scale,
+            guidance_scale=guidance_scale,
+            seed=seed
+        )
+
+    elif mode == 'face_style':
+        if not face_image_file:
+            return None, (jsonify({"error": "Face image is required for Face+Style mode."}), 400)
+        if not style_name or style_name not in STYLE_LIBRARIES:
+            return None, (jsonify({"error": f"Invalid style selected: {style_name}"}), 400)
+
+        # Load face image from upload (bounded), unless this exact file was seen before
+        face_bytes = face_image_file.read(MAX_UPLOAD_BYTES + 1)
+        if len(face_bytes) > MAX_UPLOAD_BYTES:
+            return None, (jsonify({"error": f"Face image is larger than {MAX_UPLOAD_BYTES // 2**20}MB."}), 413)
+        upload_hash = hashlib.sha256(face_bytes).hexdigest()
+        cached_face = face_embeds_cache.lookup_upload(upload_hash)
+        if cached_face is not None:
+            face_image = None # The cached Plus-Face embeds replace the image
+            face_hash, face_embeds = cached_face
+            print("  Face embeddings: cached")
+        else:
             try:
-                face_image = Image.open(face_image_file.stream).convert("RGB")
+                face_image, face_hash = normalize_face_upload(face_bytes)
+            except ValueError as e:
+                return None, (jsonify({"error": str(e)}), 413)
             except Exception as e:
                 print(f"Error reading uploaded face image: {e}")
-                return jsonify({"error": "Invalid or corrupted face image file."}), 400
-
-            # Load style images
-            style_dir = STYLE_LIBRARIES[style_name]
-            style_images = load_style_images(style_dir, NUM_STYLE_IMAGES_PER_LIBRARY)
-            if not style_images:
-                return jsonify({"error": f"Could not load style images from '{style_dir}'."}), 500
-
-            generated_image = generate_face_style_emoji(
-                pipe=pipeline_to_use,
-                face_image=face_image,
-                style_images=style_images,
-                prompt=prompt,
-                negative_prompt=negative_prompt,
-                style_scale=style_scale,
-                face_scale=face_scale,
-                guidance_scale=guidance_scale,
-                seed=seed
+                return None, (jsonify({"error": "Invalid or corrupted face image file."}), 400)
+            face_embeds_cache.add_alias(upload_hash, face_hash)
+            face_embeds = None
+
+        generation_request = GenerationRequest(
+            mode=mode,
+            prompt=prompt,
+            negative_prompt=negative_prompt,
+            style_name=style_name,
+            face_image=face_image,
+            face_hash=face_hash,
+            face_embeds=face_embeds,
+            style_scale=style_scale,
+            face_scale=face_scale,
+            guidance_scale=guidance_scale,
+            seed=seed
+        )
+
+    else:
+        return None, (jsonify({"error": f"Invalid mode specified: {mode}"}), 400)
+
+    # The tier sets the step budget (and guidance, for distilled adapters)
+    tier = resolve_quality_tier(quality)
+    generation_request.quality = quality
+    generation_request.num_inference_steps = tier["steps"]
+    if tier["guidance_scale"] is not None:
+        generation_request.guidance_scale = tier["guidance_scale"]
+    generation_request.preview_interval = preview_interval
+    generation_request.preview_size = preview_size
+    generation_request.image_format = image_format
+    generation_request.image_effort = image_effort
+    generation_request.count = count
+    generation_request.deep_cache_interval = deep_cache_interval
+    generation_request.request_id = g.request_id
+    if deadline_seconds > 0:
+        generation_request.deadline = g.request_started_at + deadline_seconds
+    if pack_sizes is not None:
+        generation_request.pack_sizes = pack_sizes
+        generation_request.pack_format = pack_format
+        if PACK_NATIVE_RESOLUTION:
+            generation_request.image_size = pack_generation_size(pack_sizes, generation_request.image_size)
+    print(f"  Pack: {pack_format} {pack_sizes} at {generation_request.image_size}px" if pack_sizes else "  Pack: none")
+    return generation_request, None
+
+def result_cache_key(generation_request: GenerationRequest, seed: int) -> str | None:
+    """Hash of everything that determines one final image (None if the style library can't be hashed)."""
+    from utils.style_embeddings import style_library_hash
+    mode = generation_request.mode
+    uses_style = mode in ("text_style", "face_style")
+    style_hash = style_library_hash(generation_request.style_name) if uses_style else None
+    if uses_style and style_hash is None:
+        return None
+    fields = {
+        "mode": mode,
+        "prompt": generation_request.prompt,
+        "negative_prompt": generation_request.negative_prompt or "", # Empty means the mode's default
+        "style_hash": style_hash,
+        "guidance_scale": generation_request.guidance_scale,
+        "style_scale": generation_request.style_scale if uses_style else None,
+        "face_scale": generation_request.face_scale if mode == "face_style" else None,
+        "steps": generation_request.num_inference_steps,
+        "image_size": generation_request.image_size,
+        "scheduler": resolve_quality_tier(generation_request.quality, mode)["scheduler"],
+        "seed": seed,
+        "face_hash": generation_request.face_hash,
+    }
+    if generation_request.deep_cache_interval > 1: # Only then, so uncached keys stay unchanged
+        fields["deep_cache"] = [generation_request.deep_cache_interval, DEEP_CACHE_DEPTH, DEEP_CACHE_SCHEDULE]
+    return content_key(fields)
+
+def finalize_image(
+    generated_image: Image.Image, generation_request: GenerationRequest, seed: int, cache_key: str | None = None
+) -> tuple[dict, dict]:
+    """Removes the background, encodes the image in the requested format and publishes it.
+
+    Matting runs on the background-removal pool. Returns (published image, per-stage latencies);
+    a lossless PNG of the result is stored in the result cache.
+    """
+    print("Generation successful. Removing background...")
+    # Remove background (the scheduler is already free to start the next batch)
+    final_image, stage_timings = submit_background_removal(generated_image).result()
+    if final_image is None:
+        print("Warning: Background removal failed. Returning original image.")
+        final_image = generated_image # Fallback to original if removal fails
+        cache_key = None # Don't cache the fallback
+
+    start = time.perf_counter()
+    image_bytes = encode_image(final_image, generation_request.image_format, generation_request.image_effort)
+    stage_timings["encode_seconds"] = time.perf_counter() - start
+    observe_stage("background_removal_wait", stage_timings["background_removal_wait_seconds"])
+    observe_stage("background_removal", stage_timings["background_removal_seconds"])
+    observe_stage("output_encode", stage_timings["encode_seconds"])
+    if cache_key is not None:
+        png_bytes = image_bytes if generation_request.image_format == "png" else encode_image(final_image, "png", 1)
+        result_cache.put(cache_key, png_bytes)
+
+    print("Background removal complete: " + ", ".join(
+        f"{k}={v:.3f}s" for k, v in stage_timings.items() if k.endswith("_seconds")
+    ))
+    return publish_image(image_bytes, generation_request, seed, image=final_image), stage_timings
+
+def finalize_images(
+    generated_images: list[Image.Image], generation_request: GenerationRequest, cache_keys: list[str | None]
+) -> dict:
+    """Finalizes every variant in parallel and builds the response body.
+
+    The top-level fields describe the first variant; "images" lists all of them. Stage latencies
+    added to the request's timings are the slowest variant's.
+    """
+    futures = [
+        variant_pool.submit(finalize_image, image, generation_request, seed, cache_key)
+        for image, seed, cache_key in zip(generated_images, generation_request.variant_seeds(), cache_keys)
+    ]
+    variants = []
+    for future in futures:
+        published, stage_timings = future.result()
+        variants.append(published)
+        for name, value in stage_timings.items():
+            generation_request.timings[name] = max(value, generation_request.timings.get(name, value))
+    return {**variants[0], "images": variants}
+
+def publish_image(
+    image_bytes: bytes, generation_request: GenerationRequest, seed: int, cached: bool = False,
+    image: Image.Image | None = None
+) -> dict:
+    """Stores encoded bytes under their content hash and returns the JSON body pointing at them.
+
+    `image` is the decoded result, if at hand; it saves a decode when building a sprite atlas.
+    """
+    image_format = generation_request.image_format
+    image_id = f"{hashlib.sha256(image_bytes).hexdigest()[:32]}.{image_format}"
+    image_store.put(image_id, image_bytes)
+    published = {
+        "image_url": f"/api/images/{image_id}", # Built by hand: also called outside request contexts
+        "image_id": image_id,
+        "format": image_format,
+        "bytes": len(image_bytes),
+        "seed": seed,
+        "cached": cached,
+    }
+    if generation_request.pack_sizes:
+        published["pack"] = publish_pack(image_id, image_bytes, generation_request, image)
+    return published
+
+def publish_pack(image_id: str, image_bytes: bytes, generation_request: GenerationRequest, image: Image.Image | None) -> dict:
+    """Describes the multi-size pack of a published image.
+
+    ZIPs are built while streaming from /api/images/<id>/pack.zip; atlases are built and stored now.
+    """
+    sizes = generation_request.pack_sizes
+    sizes_param = ",".join(str(size) for size in sizes)
+    if generation_request.pack_format == "zip":
+        return {"format": "zip", "sizes": sizes, "url": f"/api/images/{image_id}/pack.zip?sizes={sizes_param}"}
+
+    if image is None:
+        image = Image.open(io.BytesIO(image_bytes))
+    atlas, frames = build_sprite_atlas(downsample_rgba(image, sizes))
+    atlas_bytes = encode_image(atlas, "png")
+    atlas_id = f"{hashlib.sha256(atlas_bytes).hexdigest()[:32]}.png"
+    image_store.put(atlas_id, atlas_bytes)
+    return {"format": "atlas", "sizes": sizes, "image_url": f"/api/images/{atlas_id}", "image_id": atlas_id, "frames": frames}
+
+def publish_cached_results(cached_pngs: list[bytes], generation_request: GenerationRequest) -> dict:
+    """Publishes result-cache hits, re-encoding the stored PNGs if another format was requested."""
+    variants = []
+    for png_bytes, seed in zip(cached_pngs, generation_request.variant_seeds()):
+        if generation_request.image_format != "png":
+            png_bytes = encode_image(
+                Image.open(io.BytesIO(png_bytes)), generation_request.image_format, generation_request.image_effort
             )
+        variants.append(publish_image(png_bytes, generation_request, seed, cached=True))
+    return {**variants[0], "images": variants}
 
-        else:
-            return jsonify({"error": f"Invalid mode specified: {mode}"}), 400
+def lookup_cached_result(generation_request: GenerationRequest) -> tuple[list[str | None], list[bytes] | None]:
+    """Returns (one cache key per variant, cached PNG bytes per variant or None unless all are cached)."""
+    cache_keys = [result_cache_key(generation_request, seed) for seed in generation_request.variant_seeds()]
+    if any(cache_key is None for cache_key in cache_keys):
+        return cache_keys, None
+    cached_pngs = [result_cache.get(cache_key) for cache_key in cache_keys]
+    if any(png_bytes is None for png_bytes in cached_pngs):
+        return cache_keys, None
+    print(f"Result cache hit ({cache_keys[0][:12]}), skipping generation.")
+    return cache_keys, cached_pngs
+
+def client_id() -> str:
+    """Key for the per-client concurrency limit (behind a proxy, apply werkzeug's ProxyFix)."""
+    return request.remote_addr or "unknown"
+
+def rejection_response(e: AdmissionRejected):
+    """429 with the Retry-After estimate."""
+    response = jsonify({"error": str(e), "retry_after": e.retry_after})
+    response.headers["Retry-After"] = str(e.retry_after)
+    return response, 429
+
+def client_disconnected() -> bool:
+    """True once the client has closed its connection (werkzeug and gunicorn expose the socket)."""
+    sock = request.environ.get("werkzeug.socket") or request.environ.get("gunicorn.socket")
+    if sock is None:
+        return False
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+        # Readable with nothing to read means the peer closed (a pipelined request would be data)
+        return bool(readable) and sock.recv(1, socket.MSG_PEEK) == b""
+    except ValueError: # e.g. TLS sockets don't support MSG_PEEK
+        return False
+    except OSError:
+        return True
+
+def abandon_generation(generation_request: GenerationRequest, reason: str):
+    REQUESTS_ABANDONED.inc(reason=reason)
+    log_event("generation_abandoned", generation_request.request_id, mode=generation_request.mode, reason=reason)
+
+def wait_for_generation(generation_request: GenerationRequest, generation_future) -> list[Image.Image]:
+    """Blocks until the images are ready, giving up when the client disconnects or the deadline passes.
+
+    Raises GenerationCancelled (client gone) or DeadlineExceeded. Giving up also stops the GPU work:
+    a disconnect cancels the request, and the step callback interrupts requests past their deadline.
+    """
+    while True:
+        try:
+            return generation_future.result(timeout=DISCONNECT_POLL_SECONDS)
+        except FuturesTimeout:
+            pass
+        except DeadlineExceeded:
+            abandon_generation(generation_request, "deadline")
+            raise
+        if client_disconnected():
+            generation_request.cancel()
+            abandon_generation(generation_request, "disconnect")
+            raise GenerationCancelled("Client disconnected.")
+        if generation_request.expired():
+            abandon_generation(generation_request, "deadline")
+            raise DeadlineExceeded("Deadline exceeded before the generation finished.")
+
+def finish_job(job_id: str, generation_request: GenerationRequest, generation_future, cache_keys: list[str | None]):
+    """Post-processes a finished generation and stores the outcome on the job."""
+    try:
+        generated_images = generation_future.result()
+        result = finalize_images(generated_images, generation_request, cache_keys)
+        result["timings"] = generation_request.timings # Preview cost is reported separately
+        job_store.update(job_id, status="done", result=result)
+        log_event("job_finished", generation_request.request_id, job_id=job_id, mode=generation_request.mode,
+                  images=generation_request.count, timings=generation_request.timings)
+    except DeadlineExceeded as e:
+        print(f"Job {job_id} abandoned: {e}")
+        abandon_generation(generation_request, "deadline")
+        job_store.update(job_id, status="error", error=str(e))
+    except GenerationCancelled:
+        print(f"Job {job_id} cancelled.")
+        job_store.update(job_id, status="cancelled")
+    except GenerationError as e:
+        print(f"Job {job_id} failed: {e}")
+        job_store.update(job_id, status="error", error=str(e))
+    except Exception as e:
+        print(f"Unhandled error in job {job_id}: {e}")
+        import traceback
+        traceback.print_exc() # Log the full traceback for debugging
+        job_store.update(job_id, status="error", error="An unexpected server error occurred.")
+
+# --- Request Ids and Metrics ---
+
+@app.before_request
+def assign_request_id():
+    """Uses the caller's X-Request-ID (e.g. from a proxy) or generates one."""
+    g.request_id = request.headers.get("X-Request-ID", "")[:64] or uuid.uuid4().hex
+    g.request_started_at = time.perf_counter()
+
+@app.after_request
+def record_request(response):
+    endpoint = request.endpoint or "unknown"
+    response.headers["X-Request-ID"] = g.request_id
+    HTTP_REQUESTS.inc(endpoint=endpoint, status=response.status_code)
+    if endpoint != "metrics":
+        HTTP_SECONDS.observe(time.perf_counter() - g.request_started_at, endpoint=endpoint)
+    return response
+
+# --- Routes ---
+
+@app.errorhandler(413)
+def request_too_large(e):
+    """Uploads above MAX_CONTENT_LENGTH are rejected before they are read."""
+    return jsonify({"error": f"Request is larger than {MAX_UPLOAD_BYTES // 2**20}MB."}), 413
+
+@app.route('/')
+def index():
+    """Renders the main HTML page."""
+    # Pass available style names to the template if needed (dynamic select)
+    # available_styles = list(STYLE_LIBRARIES.keys())
+    # The quality select starts on the device's default tier (draft on CPU, see utils/config.py)
+    return render_template('index.html', default_quality=config.DEFAULT_QUALITY) # Renders templates/index.html
+
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    """Liveness: the process is up and serving requests."""
+    return jsonify({"status": "ok"})
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus scrape endpoint: stage latencies, cache, queue and device counters."""
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
+
+@app.route('/readyz', methods=['GET'])
+def readyz():
+    """Readiness: 200 once every configured mode is loaded and warmed up, 503 before that."""
+    state = readiness()
+    return jsonify(state), 200 if state["ready"] else 503
+
+@app.route('/api/generate', methods=['POST'])
+def api_generate():
+    """API endpoint to handle emoji generation requests (blocks until the image is ready)."""
+    try:
+        with timed("parse"):
+            generation_request, error_response = parse_generation_request()
+        if error_response:
+            return error_response
+
+        cache_keys, cached_pngs = lookup_cached_result(generation_request)
+        if cached_pngs is not None:
+            return jsonify(publish_cached_results(cached_pngs, generation_request))
+
+        try:
+            generation_future = submit_admitted(generation_request, client_id())
+        except AdmissionRejected as e:
+            return rejection_response(e)
+        try:
+            generated_images = wait_for_generation(generation_request, generation_future)
+        except DeadlineExceeded as e:
+            return jsonify({"error": str(e)}), 504
+        except GenerationCancelled as e:
+            return jsonify({"error": str(e)}), 499 # Client closed the request (nobody reads this)
+        except GenerationError as e:
+            print(f"Generation failed: {e}")
+            return jsonify({"error": str(e)}), 500
 
         # --- Process Result ---
-        if generated_image is None:
+        if not generated_images:
             print("Generation function returned None.")
             return jsonify({"error": "Failed to generate image. Check server logs for details."}), 500
 
-        print("Generation successful. Removing background...")
-        # Remove background
-        final_image = remove_background(generated_image)
-        if final_image is None:
-            print("Warning: Background removal failed. Returning original image.")
-            final_image = generated_image # Fallback to original if removal fails
+        print("Sending image URL.")
+        result = finalize_images(generated_images, generation_request, cache_keys)
+        result["timings"] = generation_request.timings
+        log_event("generation_finished", generation_request.request_id, mode=generation_request.mode,
+                  images=generation_request.count, timings=generation_request.timings)
+        return jsonify(result)
+
+    except Exception as e:
+        print(f"Unhandled error during generation: {e}")
+        import traceback
+        traceback.print_exc() # Log the full traceback for debugging
+        return jsonify({"error": "An unexpected server error occurred."}), 500
+
+@app.route('/api/images/<image_id>', methods=['GET'])
+def api_get_image(image_id):
+    """Serves a finished image as raw bytes; ids are content hashes, so responses are immutable."""
+    image_hash, _, image_format = image_id.partition(".")
+    if image_format not in IMAGE_FORMATS or not image_hash.isalnum():
+        return jsonify({"error": f"Invalid image id: {image_id}"}), 400
+    image_bytes = image_store.get(image_id)
+    if image_bytes is None:
+        return jsonify({"error": f"Unknown or expired image: {image_id}"}), 404
 
-        # Convert final image to Base64 PNG data URL
-        buffered = io.BytesIO()
-        final_image.save(buffered, format="PNG")
-        img_str = base64.b64encode(buffered.getvalue()).decode("utf-8")
-        image_data_url = f"data:image/png;base64,{img_str}"
+    response = Response(image_bytes, mimetype=IMAGE_FORMATS[image_format])
+    response.set_etag(image_hash)
+    response.cache_control.public = True
+    response.cache_control.max_age = IMAGE_CACHE_MAX_AGE
+    response.cache_control.immutable = True
+    if request.args.get('download'):
+        response.headers["Content-Disposition"] = f'attachment; filename="MojiSan_{image_id}"'
+    return response.make_conditional(request) # 304 for a matching If-None-Match
 
-        print("Background removal complete. Sending image data.")
-        return jsonify({"image_data": image_data_url})
+@app.route('/api/images/<image_id>/pack.zip', methods=['GET'])
+def api_get_image_pack(image_id):
+    """Streams a ZIP of premultiplied-alpha downsamples of a finished image (?sizes=32,64,...)."""
+    image_hash, _, image_format = image_id.partition(".")
+    if image_format not in IMAGE_FORMATS or not image_hash.isalnum():
+        return jsonify({"error": f"Invalid image id: {image_id}"}), 400
+    try:
+        sizes = parse_sizes(request.args.get('sizes', ''))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    image_bytes = image_store.get(image_id)
+    if image_bytes is None:
+        return jsonify({"error": f"Unknown or expired image: {image_id}"}), 404
+
+    image = Image.open(io.BytesIO(image_bytes))
+    response = Response(stream_zip_pack(image, sizes, name=f"MojiSan_{image_hash[:12]}"), mimetype="application/zip")
+    response.headers["Content-Disposition"] = f'attachment; filename="MojiSan_{image_hash[:12]}.zip"'
+    response.cache_control.public = True
+    response.cache_control.max_age = IMAGE_CACHE_MAX_AGE
+    return response
+
+@app.route('/api/jobs', methods=['POST'])
+def api_create_job():
+    """Queues a generation and returns a job id immediately (202)."""
+    try:
+        with timed("parse"):
+            generation_request, error_response = parse_generation_request()
+        if error_response:
+            return error_response
+
+        from utils.previews import preview_to_data_url
+
+        job = job_store.create()
+        job_urls = {
+            "job_id": job.id,
+            "status_url": url_for('api_get_job', job_id=job.id),
+            "events_url": url_for('api_job_events', job_id=job.id),
+        }
+        cache_keys, cached_pngs = lookup_cached_result(generation_request)
+        if cached_pngs is not None:
+            job_store.update(job.id, status="done", result=publish_cached_results(cached_pngs, generation_request))
+            return jsonify(job_urls), 202
+
+        generation_request.progress = lambda step, total: job_store.update(
+            job.id, status="running", step=step, total_steps=total
+        )
+        generation_request.preview = lambda step, thumbnail: job_store.update(
+            job.id, preview=preview_to_data_url(thumbnail), preview_step=step
+        )
+        job_store.update(job.id, cancel_hook=generation_request.cancel)
+        try:
+            generation_future = submit_admitted(generation_request, client_id())
+        except AdmissionRejected as e:
+            job_store.discard(job.id)
+            return rejection_response(e)
+        # Runs on the scheduler thread, so only hand off to the post-processing pool
+        generation_future.add_done_callback(
+            lambda f: postprocess_pool.submit(finish_job, job.id, generation_request, f, cache_keys)
+        )
+
+        print(f"Created job {job.id}")
+        return jsonify(job_urls), 202
 
     except Exception as e:
-        print(f"Unhandled error during generation: {e}")
+        print(f"Unhandled error while creating job: {e}")
         import traceback
         traceback.print_exc() # Log the full traceback for debugging
         return jsonify({"error": "An unexpected server error occurred."}), 500
 
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def api_get_job(job_id):
+    """Returns a job's status, progress and (once done) its result."""
+    job = job_store.get(job_id)
+    if job is None:
+        return jsonify({"error": f"Unknown job: {job_id}"}), 404
+    return jsonify(job.to_dict())
+
+@app.route('/api/jobs/<job_id>/cancel', methods=['POST'])
+def api_cancel_job(job_id):
+    """Aborts a queued or running job; its remaining denoising steps are skipped."""
+    job = job_store.get(job_id)
+    if job is None:
+        return jsonify({"error": f"Unknown job: {job_id}"}), 404
+    if job.finished:
+        return jsonify({"error": f"Job already {job.status}."}), 409
+    if job.cancel_hook is not None:
+        job.cancel_hook()
+    print(f"Cancellation requested for job {job_id}")
+    return jsonify({"job_id": job_id, "status": "cancelling"}), 202
+
+@app.route('/api/jobs/<job_id>/events', methods=['GET'])
+def api_job_events(job_id):
+    """Server-Sent Events stream of a job's per-step progress, ending with a done/error event."""
+    if job_store.get(job_id) is None:
+        return jsonify({"error": f"Unknown job: {job_id}"}), 404
+
+    def stream():
+        seen_version = -1
+        sent_preview_step = None
+        while True:
+            job = job_store.wait_for_change(job_id, seen_version, timeout=SSE_HEARTBEAT_SECONDS)
+            if job is None:
+                yield f"event: error\ndata: {json.dumps({'error': 'Job expired.'})}\n\n"
+                return
+            if job.version == seen_version:
+                yield ": keep-alive\n\n" # Heartbeat so proxies don't close an idle stream
+                continue
+            seen_version = job.version
+            if job.finished:
+                yield f"event: {job.status}\ndata: {json.dumps(job.to_dict())}\n\n"
+                return
+            progress = {"status": job.status, "step": job.step, "total_steps": job.total_steps}
+            yield f"event: progress\ndata: {json.dumps(progress)}\n\n"
+            if job.preview_step is not None and job.preview_step != sent_preview_step:
+                sent_preview_step = job.preview_step
+                preview = {"step": job.preview_step, "image_data": job.preview}
+                yield f"event: preview\ndata: {json.dumps(preview)}\n\n"
+
+    return Response(stream(), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no", # Disable proxy buffering (nginx)
+    })
+
 
 
 if __name__ == '__main__':
-    
-  
-    app.run(debug=True, host='0.0.0.0', port=5000)
+    # With WORKERS set, generation runs in worker processes that load their own modes
+    start_worker_pool()
+    # Load and warm up the configured modes in the background; /readyz reports progress
+    start_warmup()
 
+    # The reloader would run a second front end (and a second set of workers)
+    app.run(debug=True, host='0.0.0.0', port=5000, use_reloader=not WORKERS)
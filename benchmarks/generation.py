@@ -0,0 +1,353 @@
+"""Benchmarks generation latency and throughput per mode on tiny random-weight pipelines.
+
+Runs offline on a plain CPU: the SDXL backbone is replaced by benchmarks/tiny_pipeline.py,
+so the numbers track the overhead and scaling of this project's own code (scheduling,
+caching, encoding, post-processing), not SDXL itself.
+
+Usage:
+    python -m benchmarks.generation                                   # all modes, generators + API
+    python -m benchmarks.generation --target api --requests 32 --concurrency 8
+    python -m benchmarks.generation --output results.json             # save results
+    python -m benchmarks.generation --baseline results.json           # compare (exit 1 on regression)
+    python -m benchmarks.generation --target api --workers "text@cpu;text_style,face_style@cpu"
+    python -m benchmarks.generation --target generators --steps 20 --deep-cache 3 --min-ssim 0.9
+"""
+import os
+import sys
+import io
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+MODES = ["text", "text_style", "face_style"]
+
+
+def configure_environment(args):
+    """Settings are read from the environment when the config is imported, so set them first."""
+    os.environ["GENERATION_SIZE"] = str(args.size)
+    for tier in ("DRAFT", "STANDARD", "HIGH"):
+        os.environ[f"{tier}_STEPS"] = str(args.steps)
+    cache_root = tempfile.mkdtemp(prefix="bench_cache_")
+    os.environ["RESULT_CACHE_DIR"] = os.path.join(cache_root, "results")
+    os.environ["IMAGE_STORE_DIR"] = os.path.join(cache_root, "images")
+    os.environ["PREVIEW_INTERVAL_STEPS"] = "0"
+    os.environ["MAX_REQUESTS_PER_CLIENT"] = "0" # Every benchmark client shares one address
+    if not args.rembg:
+        # Always accept the fast matte: rembg needs a model download (see benchmarks.matting)
+        os.environ["FAST_MATTING_MIN_CONFIDENCE"] = "0"
+
+def make_face_image(size: int = 512) -> Image.Image:
+    rng = np.random.default_rng(1)
+    pixels = rng.integers(0, 256, (size // 16, size // 16, 3), dtype=np.uint8)
+    return Image.fromarray(pixels).resize((size, size), Image.BICUBIC)
+
+# --- Measurement ---
+
+def summarize(latencies: list[float], wall_seconds: float, images: int, concurrency: int, stages: dict,
+              rejected: int = 0) -> dict:
+    values = np.array(latencies)
+    return {
+        "requests": len(latencies),
+        "rejected": rejected, # 429s from admission control (not in the latencies)
+        "images": images,
+        "concurrency": concurrency,
+        "wall_seconds": wall_seconds,
+        "throughput_rps": len(latencies) / wall_seconds,
+        "throughput_images_per_second": images / wall_seconds,
+        "latency": {
+            "mean": float(values.mean()),
+            "p50": float(np.percentile(values, 50)),
+            "p90": float(np.percentile(values, 90)),
+            "p99": float(np.percentile(values, 99)),
+            "max": float(values.max()),
+        },
+        "stages": stages,
+    }
+
+def image_similarity(image: Image.Image, reference: Image.Image) -> dict:
+    """PSNR and SSIM (over 8x8 blocks of the luma) of an image against a reference."""
+    a = np.asarray(image.convert("L"), dtype=np.float64)
+    b = np.asarray(reference.convert("L"), dtype=np.float64)
+    mse = float(np.mean((a - b) ** 2))
+    psnr = float("inf") if mse == 0 else 10 * np.log10(255.0**2 / mse)
+    height, width = (a.shape[0] // 8) * 8, (a.shape[1] // 8) * 8
+    blocks_a = a[:height, :width].reshape(height // 8, 8, width // 8, 8).swapaxes(1, 2).reshape(-1, 64)
+    blocks_b = b[:height, :width].reshape(height // 8, 8, width // 8, 8).swapaxes(1, 2).reshape(-1, 64)
+    mean_a, mean_b = blocks_a.mean(axis=1), blocks_b.mean(axis=1)
+    var_a, var_b = blocks_a.var(axis=1), blocks_b.var(axis=1)
+    covariance = ((blocks_a - mean_a[:, None]) * (blocks_b - mean_b[:, None])).mean(axis=1)
+    c1, c2 = (0.01 * 255) ** 2, (0.03 * 255) ** 2
+    ssim = ((2 * mean_a * mean_b + c1) * (2 * covariance + c2)) / ((mean_a**2 + mean_b**2 + c1) * (var_a + var_b + c2))
+    return {"psnr": psnr, "ssim": float(ssim.mean())}
+
+def stage_breakdown(before: dict, after: dict, requests: int) -> dict:
+    """Per-stage deltas of the emoji_stage_seconds histogram over one run."""
+    stages = {}
+    for key, (total, count) in after.items():
+        previous_total, previous_count = before.get(key, (0.0, 0))
+        if count > previous_count:
+            seconds = total - previous_total
+            stages[key[0]] = {
+                "count": count - previous_count,
+                "mean_seconds": seconds / (count - previous_count),
+                "seconds_per_request": seconds / requests,
+            }
+    return stages
+
+def make_generator_runner(mode: str, args):
+    """Returns run(prompts, seeds, deep_cache_interval) -> images, calling the generators/* batch functions."""
+    from utils.model_loader import get_pipeline_for_mode
+    from utils.style_embeddings import get_style_embeds
+    from utils.cpu_profile import inference_autocast
+    from generators.text_emoji import generate_text_emoji_batch
+    from generators.text_style_emoji import generate_text_style_emoji_batch
+    from generators.face_style_emoji import generate_face_style_emoji_batch
+
+    pipe = get_pipeline_for_mode(mode, args.quality)
+    style_name = next(iter(args.styles))
+    style_embeds = get_style_embeds(pipe, style_name) if mode != "text" else None
+    face_image = make_face_image()
+
+    def run(prompts: list[str], seeds: list[int], deep_cache_interval: int = 0) -> list[Image.Image]:
+        batch = len(prompts)
+        common = dict(num_inference_steps=args.steps, seeds=seeds, image_size=args.size,
+                      deep_cache_interval=deep_cache_interval)
+        with inference_autocast():
+            if mode == "text":
+                images = generate_text_emoji_batch(pipe, prompts, [None] * batch, **common)
+            elif mode == "text_style":
+                images = generate_text_style_emoji_batch(pipe, style_embeds, prompts, [None] * batch, **common)
+            else:
+                images = generate_face_style_emoji_batch(pipe, [face_image] * batch, style_embeds, prompts, [None] * batch, **common)
+        if not images:
+            raise RuntimeError(f"{mode} generation failed")
+        return images
+
+    return run
+
+def bench_generators(mode: str, args, deep_cache_interval: int = 0) -> dict:
+    """Calls the generators/* batch functions directly (no Flask, no batch scheduler)."""
+    from utils.metrics import STAGE_SECONDS
+
+    runner = make_generator_runner(mode, args)
+    batch = args.batch_size
+
+    def run(index: int):
+        prompts = [f"benchmark emoji {index}-{i}" for i in range(batch)]
+        seeds = [random.randint(0, 2**32 - 1) for _ in range(batch)]
+        runner(prompts, seeds, deep_cache_interval)
+
+    for index in range(args.warmup):
+        run(-1 - index)
+    before = STAGE_SECONDS.totals()
+    latencies = []
+    start = time.perf_counter()
+    for index in range(args.requests):
+        request_start = time.perf_counter()
+        run(index)
+        latencies.append(time.perf_counter() - request_start)
+    wall_seconds = time.perf_counter() - start
+    stages = stage_breakdown(before, STAGE_SECONDS.totals(), args.requests)
+    return summarize(latencies, wall_seconds, args.requests * batch, 1, stages)
+
+def deep_cache_similarity(mode: str, args) -> dict:
+    """Compares images generated with UNet feature caching to the uncached images of the same seeds."""
+    runner = make_generator_runner(mode, args)
+    prompts = [f"similarity emoji {i}" for i in range(args.similarity_samples)]
+    seeds = list(range(args.similarity_samples))
+    reference = runner(prompts, seeds)
+    cached = runner(prompts, seeds, args.deep_cache)
+    scores = [image_similarity(image, reference_image) for image, reference_image in zip(cached, reference)]
+    return {
+        "samples": len(scores),
+        "psnr_mean": float(np.mean([score["psnr"] for score in scores])),
+        "ssim_mean": float(np.mean([score["ssim"] for score in scores])),
+        "ssim_min": float(min(score["ssim"] for score in scores)),
+    }
+
+def bench_api(mode: str, args) -> dict:
+    """Posts to /api/generate through the Flask test client with `concurrency` client threads."""
+    import app as app_module
+    from utils.metrics import STAGE_SECONDS
+
+    client = app_module.app.test_client()
+    face_bytes = io.BytesIO()
+    make_face_image().save(face_bytes, format="JPEG", quality=90)
+    style_name = next(iter(args.styles))
+
+    def post(index: int) -> float | None:
+        data = {
+            "mode": mode,
+            "prompt": f"benchmark emoji {index}",
+            "style": style_name,
+            "quality": args.quality,
+            "count": str(args.batch_size),
+            "seed": str(random.randint(0, 2**32 - 1)), # Never a result-cache hit
+        }
+        if mode == "face_style":
+            data["face_image"] = (io.BytesIO(face_bytes.getvalue()), "face.jpg")
+        start = time.perf_counter()
+        response = client.post("/api/generate", data=data, content_type="multipart/form-data")
+        if response.status_code == 429:
+            return None
+        if response.status_code != 200:
+            raise RuntimeError(f"{mode} request failed ({response.status_code}): {response.get_json()}")
+        return time.perf_counter() - start
+
+    for index in range(args.warmup):
+        post(-1 - index)
+    before = STAGE_SECONDS.totals()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        results = list(pool.map(post, range(args.requests)))
+    wall_seconds = time.perf_counter() - start
+    latencies = [latency for latency in results if latency is not None]
+    if not latencies:
+        raise RuntimeError(f"Every {mode} request was rejected by admission control.")
+    stages = stage_breakdown(before, STAGE_SECONDS.totals(), len(latencies))
+    return summarize(latencies, wall_seconds, len(latencies) * args.batch_size, args.concurrency, stages,
+                     rejected=len(results) - len(latencies))
+
+def start_workers(spec: str, style_root: str):
+    """Routes API requests to tiny-model worker processes and waits until they are warm."""
+    from benchmarks.tiny_pipeline import use_tiny_backbone
+    from utils.worker_pool import start_worker_pool, parse_worker_specs
+
+    pool = start_worker_pool(parse_worker_specs(spec), initializer=partial(use_tiny_backbone, style_root))
+    print(f"Waiting for {len(pool.stats()['workers'])} worker process(es) to warm up...")
+    while True:
+        status = pool.mode_status()
+        if "error" in status.values():
+            raise RuntimeError(f"Worker warm-up failed: {pool.stats()['workers']}")
+        if all(state == "ready" for state in status.values()):
+            return
+        time.sleep(0.5)
+
+# --- Baseline Comparison ---
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """Prints current vs. baseline p50 latency and throughput; returns the regressed entries."""
+    regressions = []
+    print("\n--- Comparison with baseline ---")
+    print(f"{'run':<24}{'p50 (s)':>12}{'baseline':>12}{'change':>10}{'rps':>10}{'baseline':>10}{'change':>10}")
+    for name, current in results["results"].items():
+        previous = baseline.get("results", {}).get(name)
+        if previous is None:
+            print(f"{name:<24}{'(not in baseline)':>36}")
+            continue
+        p50, base_p50 = current["latency"]["p50"], previous["latency"]["p50"]
+        rps, base_rps = current["throughput_rps"], previous["throughput_rps"]
+        latency_change, throughput_change = p50 / base_p50 - 1, rps / base_rps - 1
+        flag = ""
+        if latency_change > tolerance or throughput_change < -tolerance:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(f"{name:<24}{p50:>12.4f}{base_p50:>12.4f}{latency_change:>+10.1%}{rps:>10.2f}{base_rps:>10.2f}{throughput_change:>+10.1%}{flag}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--modes", default=",".join(MODES), help="Comma-separated modes")
+    parser.add_argument("--target", choices=["generators", "api", "both"], default="both")
+    parser.add_argument("--requests", type=int, default=8, help="Measured requests per mode")
+    parser.add_argument("--warmup", type=int, default=1, help="Unmeasured requests per mode first")
+    parser.add_argument("--concurrency", type=int, default=4, help="Client threads for the API target")
+    parser.add_argument("--batch-size", type=int, default=1, help="Images per request (count)")
+    parser.add_argument("--steps", type=int, default=4)
+    parser.add_argument("--size", type=int, default=128, help="Generation size in px (multiple of 8)")
+    parser.add_argument("--quality", default="draft", help="Quality tier (selects the scheduler)")
+    parser.add_argument("--workers", help='Worker processes for the API target, e.g. "text@cpu;text_style,face_style@cpu"')
+    parser.add_argument("--rembg", action="store_true", help="Fall back to rembg for low-confidence mattes")
+    parser.add_argument("--deep-cache", type=int, default=0,
+                        help="Also benchmark the generators with UNet feature caching at this interval, and its similarity")
+    parser.add_argument("--similarity-samples", type=int, default=4, help="Images compared per mode for --deep-cache")
+    parser.add_argument("--min-ssim", type=float, help="Exit 1 if a mode's mean SSIM with --deep-cache is below this")
+    parser.add_argument("--output", help="Write results as JSON")
+    parser.add_argument("--baseline", help="Results JSON to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="Allowed relative regression")
+    args = parser.parse_args()
+
+    configure_environment(args)
+    # Project modules are imported only now, after the environment is configured
+    import torch
+    import diffusers
+    from benchmarks.tiny_pipeline import install_tiny_backbone
+    from utils import config
+
+    style_root = install_tiny_backbone()
+    if args.workers:
+        start_workers(args.workers, style_root)
+    args.styles = list(config.STYLE_LIBRARIES)
+    targets = ["generators", "api"] if args.target == "both" else [args.target]
+    results = {
+        "environment": {
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "diffusers": diffusers.__version__,
+            "device": str(config.DEVICE),
+            "cpu_count": os.cpu_count(),
+            "platform": platform.platform(),
+        },
+        "settings": {k: v for k, v in vars(args).items() if k not in ("styles", "output", "baseline")},
+        "results": {},
+    }
+    modes = [mode for mode in args.modes.split(",") if mode]
+    for mode in modes:
+        runs = []
+        for target in targets:
+            runs.append((f"{target}/{mode}", partial(bench_generators if target == "generators" else bench_api, mode, args)))
+            if target == "generators" and args.deep_cache > 1:
+                runs.append((f"generators/{mode}+dc{args.deep_cache}", partial(bench_generators, mode, args, args.deep_cache)))
+        for name, bench in runs:
+            print(f"\nBenchmarking {name}...")
+            summary = bench()
+            results["results"][name] = summary
+            latency = summary["latency"]
+            print(f"{name}: p50={latency['p50']:.4f}s p90={latency['p90']:.4f}s p99={latency['p99']:.4f}s "
+                  f"throughput={summary['throughput_rps']:.2f} req/s"
+                  + (f" ({summary['rejected']} rejected with 429)" if summary["rejected"] else ""))
+            for stage, stats in sorted(summary["stages"].items(), key=lambda item: -item[1]["seconds_per_request"]):
+                print(f"    {stage:<24} {stats['seconds_per_request']:.4f}s/request  (mean {stats['mean_seconds']:.4f}s x {stats['count']})")
+
+    below_min_ssim = []
+    if args.deep_cache > 1:
+        print(f"\n--- UNet feature caching (interval {args.deep_cache}) vs. uncached ---")
+        results["deep_cache"] = {}
+        for mode in modes:
+            similarity = deep_cache_similarity(mode, args)
+            uncached = results["results"].get(f"generators/{mode}")
+            cached = results["results"].get(f"generators/{mode}+dc{args.deep_cache}")
+            if uncached and cached:
+                similarity["speedup"] = uncached["latency"]["p50"] / cached["latency"]["p50"]
+            results["deep_cache"][mode] = similarity
+            print(f"{mode:<12} speedup={similarity.get('speedup', float('nan')):.2f}x "
+                  f"psnr={similarity['psnr_mean']:.2f}dB ssim={similarity['ssim_mean']:.4f} (min {similarity['ssim_min']:.4f})")
+            if args.min_ssim is not None and similarity["ssim_mean"] < args.min_ssim:
+                below_min_ssim.append(mode)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"\nResults written to {args.output}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"\nRegressions beyond {args.tolerance:.0%}: {', '.join(regressions)}")
+            sys.exit(1)
+    if below_min_ssim:
+        print(f"\nMean SSIM with UNet feature caching below {args.min_ssim}: {', '.join(below_min_ssim)}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
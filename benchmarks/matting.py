@@ -0,0 +1,128 @@
+"""Benchmarks the NumPy fast matte against rembg for speed and mask agreement.
+
+Usage:
+    python -m benchmarks.matting                      # synthetic fixtures with known masks
+    python -m benchmarks.matting --fixtures DIR       # real outputs (compared against rembg)
+"""
+import os
+import sys
+import time
+import json
+import argparse
+import numpy as np
+from PIL import Image, ImageDraw, ImageFilter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.config import FAST_MATTING_TOLERANCE, FAST_MATTING_MIN_CONFIDENCE
+from utils.image_utils import fast_matte, list_style_image_files, load_image_from_path
+
+
+# --- Fixtures ---
+
+def synthetic_fixtures(size: int = 1024) -> list[tuple[str, Image.Image, np.ndarray]]:
+    """Emoji-like subjects on off-white backgrounds, with their ground-truth masks."""
+    fixtures = []
+    rng = np.random.default_rng(0)
+    for index in range(8):
+        background = tuple(int(v) for v in rng.integers(238, 256, size=3))
+        mask = Image.new("L", (size, size), 0)
+        draw = ImageDraw.Draw(mask)
+        margin = int(size * rng.uniform(0.15, 0.3))
+        draw.ellipse((margin, margin, size - margin, size - margin), fill=255)
+        if index % 2:
+            draw.rectangle((size // 3, size - margin, 2 * size // 3, size - margin // 2), fill=255)
+        mask = mask.filter(ImageFilter.GaussianBlur(1.5)) # Anti-aliased edges
+
+        subject = Image.new("RGB", (size, size), tuple(int(v) for v in rng.integers(20, 230, size=3)))
+        subject_draw = ImageDraw.Draw(subject)
+        eye = size // 10
+        subject_draw.ellipse((size // 2 - 2 * eye, size // 2 - eye, size // 2 - eye, size // 2), fill=background) # Enclosed highlight
+        image = Image.composite(subject, Image.new("RGB", (size, size), background), mask)
+        noise = rng.normal(0, 2.0, (size, size, 3)) # Sensor-like noise on the flat background
+        image = Image.fromarray(np.clip(np.asarray(image) + noise, 0, 255).astype(np.uint8))
+        fixtures.append((f"synthetic_{index}", image, np.asarray(mask) > 127))
+    return fixtures
+
+def directory_fixtures(fixture_dir: str) -> list[tuple[str, Image.Image, None]]:
+    fixtures = []
+    for path in list_style_image_files(fixture_dir):
+        image = load_image_from_path(path)
+        if image is not None:
+            fixtures.append((os.path.basename(path), image, None))
+    return fixtures
+
+# --- Measurement ---
+
+def mask_iou(a: np.ndarray, b: np.ndarray) -> float:
+    union = np.logical_or(a, b).sum()
+    return float(np.logical_and(a, b).sum() / union) if union else 1.0
+
+def timed(fn, repeats: int):
+    """Returns (last result, median seconds)."""
+    durations = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = fn()
+        durations.append(time.perf_counter() - start)
+    return result, float(np.median(durations))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--fixtures", help="Directory of generated images (default: synthetic set)")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--tolerance", type=float, default=FAST_MATTING_TOLERANCE)
+    parser.add_argument("--no-rembg", action="store_true", help="Skip the rembg comparison")
+    parser.add_argument("--output", help="Write per-fixture results as JSON")
+    args = parser.parse_args()
+
+    fixtures = directory_fixtures(args.fixtures) if args.fixtures else synthetic_fixtures()
+    if not fixtures:
+        print("No fixtures found.")
+        return
+
+    session = None
+    if not args.no_rembg:
+        try:
+            from utils.background_removal import create_rembg_session
+            session = create_rembg_session()
+        except Exception as e:
+            print(f"rembg unavailable, skipping the comparison: {e}")
+
+    rows = []
+    for name, image, truth in fixtures:
+        (fast_image, confidence), fast_seconds = timed(
+            lambda: fast_matte(image, tolerance=args.tolerance), args.repeats
+        )
+        fast_mask = np.asarray(fast_image)[..., 3] > 127
+        row = {"fixture": name, "fast_seconds": fast_seconds, "confidence": confidence,
+               "fast_used": confidence >= FAST_MATTING_MIN_CONFIDENCE}
+        if truth is not None:
+            row["fast_iou_truth"] = mask_iou(fast_mask, truth)
+        if session is not None:
+            from rembg import remove
+            rembg_image, rembg_seconds = timed(lambda: remove(image, session=session), args.repeats)
+            rembg_mask = np.asarray(rembg_image)[..., 3] > 127
+            row["rembg_seconds"] = rembg_seconds
+            row["fast_iou_rembg"] = mask_iou(fast_mask, rembg_mask)
+            if truth is not None:
+                row["rembg_iou_truth"] = mask_iou(rembg_mask, truth)
+        rows.append(row)
+        print("  ".join(f"{k}={v:.4f}" if isinstance(v, float) else f"{k}={v}" for k, v in row.items()))
+
+    print("\n--- Summary ---")
+    print(f"Fixtures: {len(rows)}, fast path accepted: {sum(r['fast_used'] for r in rows)}")
+    for key in ("fast_seconds", "rembg_seconds", "fast_iou_truth", "rembg_iou_truth", "fast_iou_rembg"):
+        values = [r[key] for r in rows if key in r]
+        if values:
+            print(f"{key}: median={np.median(values):.4f} min={np.min(values):.4f}")
+    if session is not None:
+        speedup = np.median([r["rembg_seconds"] for r in rows]) / np.median([r["fast_seconds"] for r in rows])
+        print(f"Speedup (median): {speedup:.1f}x")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(rows, f, indent=2)
+        print(f"Results written to {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+"""Tiny randomly-initialised SDXL-architecture pipelines for offline benchmarking.
+
+Every component the app uses is present (UNet with text-time conditioning, VAE, both CLIP
+text encoders, CLIP vision encoder, IP-Adapter Plus attention processors and image
+projections), just a few layers wide, so the full request path runs on a plain CPU
+without downloading any weights.
+"""
+import os
+import json
+import tempfile
+import numpy as np
+import torch
+from PIL import Image, ImageDraw
+from diffusers import UNet2DConditionModel, AutoencoderKL, EulerDiscreteScheduler, StableDiffusionXLPipeline
+from diffusers.models.attention_processor import AttnProcessor2_0, IPAdapterAttnProcessor2_0
+from diffusers.models.embeddings import IPAdapterPlusImageProjection, MultiIPAdapterImageProjection
+from transformers import (
+    CLIPTextConfig, CLIPTextModel, CLIPTextModelWithProjection, CLIPTokenizer,
+    CLIPVisionConfig, CLIPVisionModelWithProjection, CLIPImageProcessor,
+)
+from utils import config
+
+HIDDEN_SIZE = 32         # Text and vision encoders
+CROSS_ATTENTION_DIM = 64 # Two concatenated text encoders
+IP_ADAPTER_TOKENS = 4
+
+
+def _byte_level_vocab() -> list[str]:
+    """The 256 printable stand-ins CLIP's byte-level BPE uses for raw bytes."""
+    printable = list(range(ord("!"), ord("~") + 1)) + list(range(ord("¡"), ord("¬") + 1)) + list(range(ord("®"), ord("ÿ") + 1))
+    codes = printable[:]
+    extra = 0
+    for byte in range(256):
+        if byte not in printable:
+            printable.append(byte)
+            codes.append(256 + extra)
+            extra += 1
+    return [chr(code) for code in codes]
+
+def build_tokenizer(directory: str) -> CLIPTokenizer:
+    """Character-level CLIP tokenizer (no merges) written to `directory`."""
+    vocab = {}
+    for suffix in ("", "</w>"):
+        for char in _byte_level_vocab():
+            vocab[char + suffix] = len(vocab)
+    vocab["<|startoftext|>"] = len(vocab)
+    vocab["<|endoftext|>"] = len(vocab)
+    vocab_path = os.path.join(directory, "vocab.json")
+    merges_path = os.path.join(directory, "merges.txt")
+    with open(vocab_path, "w") as f:
+        json.dump(vocab, f)
+    with open(merges_path, "w") as f:
+        f.write("#version: 0.2\n")
+    return CLIPTokenizer(vocab_path, merges_path, model_max_length=77)
+
+def build_tiny_pipeline(seed: int = 0) -> StableDiffusionXLPipeline:
+    """Builds the tiny SDXL pipeline (64px native resolution, any multiple of 8 works)."""
+    torch.manual_seed(seed)
+    tokenizer = build_tokenizer(tempfile.mkdtemp(prefix="tiny_tokenizer_"))
+    unet = UNet2DConditionModel(
+        block_out_channels=(32, 64), layers_per_block=2, sample_size=32, in_channels=4, out_channels=4,
+        down_block_types=("DownBlock2D", "CrossAttnDownBlock2D"), up_block_types=("CrossAttnUpBlock2D", "UpBlock2D"),
+        attention_head_dim=(2, 4), use_linear_projection=True, addition_embed_type="text_time",
+        addition_time_embed_dim=8, transformer_layers_per_block=(1, 2),
+        projection_class_embeddings_input_dim=80, # 6 time ids x 8 + pooled text embeds (32)
+        cross_attention_dim=CROSS_ATTENTION_DIM, norm_num_groups=1,
+    )
+    vae = AutoencoderKL(
+        block_out_channels=[32, 64], in_channels=3, out_channels=3,
+        down_block_types=["DownEncoderBlock2D"] * 2, up_block_types=["UpDecoderBlock2D"] * 2,
+        latent_channels=4, sample_size=128,
+    )
+    text_config = CLIPTextConfig(
+        bos_token_id=tokenizer.bos_token_id, eos_token_id=tokenizer.eos_token_id, pad_token_id=tokenizer.pad_token_id,
+        hidden_size=HIDDEN_SIZE, intermediate_size=37, layer_norm_eps=1e-5, num_attention_heads=4,
+        num_hidden_layers=5, vocab_size=1000, hidden_act="gelu", projection_dim=HIDDEN_SIZE,
+    )
+    image_encoder = CLIPVisionModelWithProjection(CLIPVisionConfig(
+        hidden_size=HIDDEN_SIZE, image_size=32, patch_size=8, projection_dim=HIDDEN_SIZE,
+        num_hidden_layers=2, num_attention_heads=4, intermediate_size=37,
+    ))
+    scheduler = EulerDiscreteScheduler(
+        beta_start=0.00085, beta_end=0.012, beta_schedule="scaled_linear",
+        timestep_spacing="leading", steps_offset=1,
+    )
+    return StableDiffusionXLPipeline(
+        vae=vae, text_encoder=CLIPTextModel(text_config), text_encoder_2=CLIPTextModelWithProjection(text_config),
+        tokenizer=tokenizer, tokenizer_2=build_tokenizer(tempfile.mkdtemp(prefix="tiny_tokenizer_")),
+        unet=unet, scheduler=scheduler, image_encoder=image_encoder,
+        feature_extractor=CLIPImageProcessor(crop_size=32, size=32),
+    )
+
+def load_tiny_ip_adapter(pipe, weight_name):
+    """Installs randomly-initialised IP-Adapter Plus layers, one set per weight name."""
+    num_adapters = len(weight_name) if isinstance(weight_name, list) else 1
+    unet = pipe.unet
+    block_channels = unet.config.block_out_channels
+    processors = {}
+    for name in unet.attn_processors.keys():
+        if name.endswith("attn1.processor"): # Self-attention
+            processors[name] = AttnProcessor2_0()
+            continue
+        if name.startswith("mid_block"):
+            hidden_size = block_channels[-1]
+        elif name.startswith("up_blocks"):
+            hidden_size = list(reversed(block_channels))[int(name[len("up_blocks.")])]
+        else:
+            hidden_size = block_channels[int(name[len("down_blocks.")])]
+        processors[name] = IPAdapterAttnProcessor2_0(
+            hidden_size, unet.config.cross_attention_dim,
+            num_tokens=(IP_ADAPTER_TOKENS,) * num_adapters, scale=[1.0] * num_adapters,
+        ).to(device=unet.device, dtype=unet.dtype)
+    unet.set_attn_processor(processors)
+    unet.encoder_hid_proj = MultiIPAdapterImageProjection([
+        IPAdapterPlusImageProjection(
+            embed_dims=HIDDEN_SIZE, output_dims=CROSS_ATTENTION_DIM, hidden_dims=64, depth=1,
+            dim_head=16, heads=4, num_queries=IP_ADAPTER_TOKENS, ffn_ratio=2,
+        )
+        for _ in range(num_adapters)
+    ]).to(device=unet.device, dtype=unet.dtype)
+    unet.config.encoder_hid_dim_type = "ip_image_proj"
+
+def tiny_backbone_factory():
+    """Backbone factory for utils.model_loader.set_backbone_factory."""
+    return build_tiny_pipeline(), load_tiny_ip_adapter
+
+def make_style_libraries(root: str, num_images: int = config.NUM_STYLE_IMAGES_PER_LIBRARY, size: int = 256):
+    """Writes synthetic style libraries under `root` and points STYLE_LIBRARIES at them.
+
+    Keeps benchmark embeddings (persisted next to each library) away from the real libraries.
+    """
+    rng = np.random.default_rng(0)
+    for style_name in list(config.STYLE_LIBRARIES):
+        style_dir = os.path.join(root, style_name)
+        os.makedirs(style_dir, exist_ok=True)
+        for index in range(num_images):
+            image = Image.new("RGB", (size, size), tuple(int(v) for v in rng.integers(0, 256, 3)))
+            draw = ImageDraw.Draw(image)
+            for _ in range(6):
+                x0, y0 = (int(v) for v in rng.integers(0, size // 2, 2))
+                x1, y1 = x0 + int(rng.integers(16, size // 2)), y0 + int(rng.integers(16, size // 2))
+                draw.ellipse((x0, y0, x1, y1), fill=tuple(int(v) for v in rng.integers(0, 256, 3)))
+            image.save(os.path.join(style_dir, f"{index + 1}.png"))
+        config.STYLE_LIBRARIES[style_name] = style_dir # Mutated in place: every module shares the dict
+
+def use_tiny_backbone(style_root: str):
+    """Worker-process initializer: tiny models and the libraries install_tiny_backbone wrote to style_root."""
+    from utils.model_loader import set_backbone_factory
+    for style_name in list(config.STYLE_LIBRARIES):
+        config.STYLE_LIBRARIES[style_name] = os.path.join(style_root, style_name)
+    set_backbone_factory(tiny_backbone_factory)
+
+def install_tiny_backbone(style_root: str | None = None) -> str:
+    """Makes the app load tiny models and synthetic style libraries; returns the style root."""
+    from utils.model_loader import set_backbone_factory
+    style_root = style_root or tempfile.mkdtemp(prefix="tiny_styles_")
+    make_style_libraries(style_root)
+    set_backbone_factory(tiny_backbone_factory)
+    return style_root
@@ -0,0 +1,311 @@
+"""Generates emojis offline from a JSONL request file, one request per line.
+
+Each line is a JSON object:
+    {"id": "sku-123", "mode": "face_style", "prompt": "smiling", "style": "ziggy",
+     "face": "faces/123.jpg", "negative_prompt": null, "guidance_scale": 5.0,
+     "style_scale": 0.4, "face_scale": 0.7, "quality": "standard", "seed": 42, "deep_cache": 3}
+Only "mode" and "prompt" are required ("style" for the style modes, "face" for face_style).
+Without an "id", the request's content hash is used; without a "seed", one is derived from the
+id, so reruns reproduce the same image.
+
+Requests are sorted by mode, style and settings to minimise pipeline and style embedding
+switches, and run through the same batch scheduler (or worker pool, see WORKERS) as the web app,
+which batches compatible neighbours. Background removal and encoding run on a thread pool while
+the next batches denoise.
+
+Outputs go to <output>/images/<shard>/<id>.<format>, and every outcome is appended to
+<output>/results.jsonl. Rerunning skips the requests that already succeeded.
+
+Usage:
+    python bulk_generate.py requests.jsonl --output out/
+    python bulk_generate.py requests.jsonl --output out/ --format webp --limit 100
+"""
+import os
+import re
+import json
+import time
+import hashlib
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from utils import config
+from utils.config import (
+    STYLE_LIBRARIES, QUALITY_TIERS, IMAGE_FORMATS, DEFAULT_IMAGE_FORMAT,
+    DEFAULT_GUIDANCE_SCALE, DEFAULT_STYLE_SCALE, DEFAULT_FACE_SCALE, TEXT_EMOJI_PROMPT_SUFFIX,
+    DEEP_CACHE_INTERVAL, DEEP_CACHE_MAX_INTERVAL,
+    BULK_MAX_IN_FLIGHT, BULK_POSTPROCESS_WORKERS, BULK_SHARD_CHARS, BULK_PROGRESS_INTERVAL_SECONDS,
+)
+from utils.batch_scheduler import GenerationRequest, submit_generation
+from utils.background_removal import submit_background_removal
+from utils.face_embeddings import face_embeds_cache, normalize_face_upload
+from utils.image_utils import encode_image
+from utils.quality import resolve_quality_tier
+from utils.result_cache import content_key
+from utils.worker_pool import start_worker_pool
+
+MODES = ("text", "text_style", "face_style")
+RESULTS_FILENAME = "results.jsonl"
+
+
+# --- Requests ---
+
+def parse_line(line: str, line_number: int) -> dict:
+    """Validates one request line and fills in its defaults. Raises ValueError on a bad request."""
+    item = json.loads(line)
+    if not isinstance(item, dict):
+        raise ValueError("Expected a JSON object.")
+    mode = item.get("mode", "text")
+    if mode not in MODES:
+        raise ValueError(f"Invalid mode: {mode}")
+    if not item.get("prompt"):
+        raise ValueError("Prompt is required.")
+    style = item.get("style") if mode != "text" else None
+    if mode != "text" and style not in STYLE_LIBRARIES:
+        raise ValueError(f"Invalid style: {style}")
+    if mode == "face_style" and not item.get("face"):
+        raise ValueError("Face image path is required for face_style.")
+    quality = item.get("quality", config.DEFAULT_QUALITY)
+    if quality not in QUALITY_TIERS:
+        raise ValueError(f"Invalid quality: {quality} (expected one of {list(QUALITY_TIERS)})")
+    deep_cache_interval = item.get("deep_cache", DEEP_CACHE_INTERVAL)
+    if not isinstance(deep_cache_interval, int) or not 0 <= deep_cache_interval <= DEEP_CACHE_MAX_INTERVAL:
+        raise ValueError(f"deep_cache must be an integer between 0 and {DEEP_CACHE_MAX_INTERVAL}.")
+
+    spec = {
+        "mode": mode,
+        "prompt": item["prompt"],
+        "negative_prompt": item.get("negative_prompt"),
+        "style": style,
+        "face": item.get("face") if mode == "face_style" else None,
+        "guidance_scale": float(item.get("guidance_scale", DEFAULT_GUIDANCE_SCALE)),
+        "style_scale": float(item.get("style_scale", DEFAULT_STYLE_SCALE)),
+        "face_scale": float(item.get("face_scale", DEFAULT_FACE_SCALE)),
+        "quality": quality,
+    }
+    if deep_cache_interval > 1: # Only then, so the ids of uncached requests stay unchanged
+        spec["deep_cache"] = deep_cache_interval
+    item_id = str(item.get("id") or content_key(spec)[:16])
+    seed = item.get("seed")
+    if seed is None:
+        seed = int(hashlib.sha256(item_id.encode("utf-8")).hexdigest()[:8], 16)
+    elif not isinstance(seed, int) or not 0 <= seed < 2**32:
+        raise ValueError("Seed must be an integer between 0 and 2^32 - 1.")
+    return {**spec, "id": item_id, "seed": seed, "line": line_number}
+
+def build_request(item: dict) -> GenerationRequest:
+    """The GenerationRequest for an item, as the web app would build it (without the face)."""
+    prompt = item["prompt"]
+    if item["mode"] == "text":
+        prompt = f"{prompt.strip()}, {TEXT_EMOJI_PROMPT_SUFFIX}"
+    generation_request = GenerationRequest(
+        mode=item["mode"],
+        prompt=prompt,
+        request_id=f"bulk-{item['id']}",
+        negative_prompt=item["negative_prompt"],
+        style_name=item["style"],
+        guidance_scale=item["guidance_scale"],
+        style_scale=item["style_scale"],
+        face_scale=item["face_scale"],
+        quality=item["quality"],
+        seed=item["seed"],
+        deep_cache_interval=item.get("deep_cache", 0),
+        preview_interval=0,
+    )
+    tier = resolve_quality_tier(item["quality"])
+    generation_request.num_inference_steps = tier["steps"]
+    if tier["guidance_scale"] is not None:
+        generation_request.guidance_scale = tier["guidance_scale"]
+    return generation_request
+
+def load_face(generation_request: GenerationRequest, face_path: str):
+    """Attaches the face (or its cached embeddings, for a file seen before) to a face_style request."""
+    with open(face_path, "rb") as f:
+        face_bytes = f.read()
+    upload_hash = hashlib.sha256(face_bytes).hexdigest()
+    cached_face = face_embeds_cache.lookup_upload(upload_hash)
+    if cached_face is not None:
+        generation_request.face_hash, generation_request.face_embeds = cached_face
+        return
+    generation_request.face_image, generation_request.face_hash = normalize_face_upload(face_bytes)
+    face_embeds_cache.add_alias(upload_hash, generation_request.face_hash)
+
+def sort_key(pair: tuple[dict, GenerationRequest]) -> tuple:
+    """Groups requests that share a pipeline call, then by face so repeated faces are adjacent."""
+    item, generation_request = pair
+    batch_key = tuple((value is not None, value) for value in generation_request.batch_key())
+    return batch_key, item["face"] or "", item["line"]
+
+# --- Output ---
+
+def output_path(output_dir: str, item_id: str, image_format: str) -> str:
+    """<output>/images/<shard>/<id>.<format>; ids that are not file-name safe get a hash suffix."""
+    digest = hashlib.sha256(item_id.encode("utf-8")).hexdigest()
+    name = re.sub(r"[^A-Za-z0-9._-]", "_", item_id)[:100]
+    if name != item_id:
+        name = f"{name}-{digest[:8]}"
+    return os.path.join(output_dir, "images", digest[:BULK_SHARD_CHARS], f"{name}.{image_format}")
+
+def completed_ids(results_path: str, output_dir: str) -> set[str]:
+    """Ids whose last recorded outcome is a success with the output file still present."""
+    status = {}
+    if not os.path.exists(results_path):
+        return set()
+    with open(results_path) as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except ValueError:
+                continue # A line cut short by an interrupted run
+            ok = result.get("status") == "ok" and os.path.exists(os.path.join(output_dir, result.get("file", "")))
+            status[result["id"]] = ok
+    return {item_id for item_id, ok in status.items() if ok}
+
+
+class BulkRun:
+    """Appends results to results.jsonl and prints throughput progress."""
+
+    def __init__(self, results_path: str, total: int):
+        self.results_file = open(results_path, "a")
+        self.total = total
+        self.done = 0
+        self.failed = 0
+        self.images = 0
+        self.started_at = time.perf_counter()
+        self._last_report = self.started_at
+        self._lock = threading.Lock()
+
+    def record(self, result: dict):
+        with self._lock:
+            self.results_file.write(json.dumps(result) + "\n")
+            self.results_file.flush()
+            self.done += 1
+            if result["status"] == "ok":
+                self.images += 1
+            else:
+                self.failed += 1
+            now = time.perf_counter()
+            if now - self._last_report >= BULK_PROGRESS_INTERVAL_SECONDS:
+                self._last_report = now
+                self.report(now)
+
+    def report(self, now: float):
+        elapsed = now - self.started_at
+        rate = self.images / elapsed if elapsed > 0 else 0.0
+        eta = (self.total - self.done) / rate if rate > 0 else float("inf")
+        print(f"[{self.done}/{self.total}] {rate:.2f} images/s, {self.failed} failed, "
+              f"elapsed {elapsed:.0f}s, ETA {eta:.0f}s")
+
+    def close(self):
+        self.results_file.close()
+
+
+def finish_item(run: BulkRun, item: dict, generation_request: GenerationRequest, generation_future,
+                output_dir: str, image_format: str, effort: int | None):
+    """Mattes, encodes and writes one generated image (runs on the post-processing pool)."""
+    result = {"id": item["id"], "line": item["line"], "mode": item["mode"], "style": item["style"], "seed": item["seed"]}
+    try:
+        generated_image = generation_future.result()[0]
+        final_image, stage_timings = submit_background_removal(generated_image).result()
+        if final_image is None:
+            print(f"Warning: Background removal failed for '{item['id']}'. Writing the original image.")
+            final_image = generated_image
+        image_bytes = encode_image(final_image, image_format, effort)
+        path = output_path(output_dir, item["id"], image_format)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "wb") as f:
+            f.write(image_bytes)
+        os.replace(path + ".tmp", path) # A rerun never finds a truncated file
+        result.update(
+            status="ok",
+            file=os.path.relpath(path, output_dir),
+            bytes=len(image_bytes),
+            batch_size=generation_request.timings.get("batch_size"),
+            generation_seconds=round(generation_request.timings.get("generation_seconds", 0.0), 3),
+            background_removal_seconds=round(stage_timings.get("background_removal_seconds", 0.0), 3),
+        )
+    except Exception as e:
+        print(f"Error generating '{item['id']}': {e}")
+        result.update(status="error", error=str(e))
+    run.record(result)
+
+# --- Main ---
+
+def main():
+    parser = argparse.ArgumentParser(description="Generates emojis from a JSONL request file.")
+    parser.add_argument("requests", help="JSONL file, one request per line")
+    parser.add_argument("--output", required=True, help="Output directory (images/ and results.jsonl)")
+    parser.add_argument("--format", default=DEFAULT_IMAGE_FORMAT, choices=list(IMAGE_FORMATS))
+    parser.add_argument("--effort", type=int, default=None, help="PNG compress level (0-9) or WebP method (0-6)")
+    parser.add_argument("--in-flight", type=int, default=BULK_MAX_IN_FLIGHT, help="Requests submitted ahead of completion")
+    parser.add_argument("--limit", type=int, default=None, help="Only run the first N pending requests (in run order)")
+    args = parser.parse_args()
+
+    os.makedirs(args.output, exist_ok=True)
+    results_path = os.path.join(args.output, RESULTS_FILENAME)
+    done_ids = completed_ids(results_path, args.output)
+
+    pending, seen, invalid = [], set(), 0
+    with open(args.requests) as f:
+        for line_number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            try:
+                item = parse_line(line, line_number)
+            except (ValueError, TypeError) as e:
+                print(f"Skipping line {line_number}: {e}")
+                invalid += 1
+                continue
+            if item["id"] in seen:
+                print(f"Skipping line {line_number}: duplicate id '{item['id']}'")
+                invalid += 1
+                continue
+            seen.add(item["id"])
+            if item["id"] not in done_ids:
+                pending.append((item, build_request(item)))
+    pending.sort(key=sort_key)
+    if args.limit is not None:
+        pending = pending[:args.limit]
+    print(f"{len(seen)} request(s): {len(seen) - len(pending)} already done or beyond --limit, "
+          f"{len(pending)} to generate, {invalid} invalid line(s).")
+    if not pending:
+        return
+
+    start_worker_pool() # Routes generation to worker processes when WORKERS is set
+    run = BulkRun(results_path, len(pending))
+    postprocess_pool = ThreadPoolExecutor(max_workers=BULK_POSTPROCESS_WORKERS, thread_name_prefix="bulk-postprocess")
+    in_flight = threading.BoundedSemaphore(max(1, args.in_flight))
+
+    def on_generated(item, generation_request, generation_future):
+        # Called on the scheduler thread: hand off right away so the next batch can start
+        def task():
+            try:
+                finish_item(run, item, generation_request, generation_future, args.output, args.format, args.effort)
+            finally:
+                in_flight.release()
+        postprocess_pool.submit(task)
+
+    try:
+        for item, generation_request in pending:
+            in_flight.acquire()
+            try:
+                if item["face"]:
+                    load_face(generation_request, item["face"])
+                generation_future = submit_generation(generation_request)
+            except Exception as e:
+                print(f"Error preparing '{item['id']}': {e}")
+                run.record({"id": item["id"], "line": item["line"], "status": "error", "error": str(e)})
+                in_flight.release()
+                continue
+            generation_future.add_done_callback(
+                lambda f, item=item, generation_request=generation_request: on_generated(item, generation_request, f)
+            )
+        for _ in range(max(1, args.in_flight)): # Wait for the last requests to be written
+            in_flight.acquire()
+    finally:
+        postprocess_pool.shutdown(wait=True)
+        run.report(time.perf_counter())
+        run.close()
+    print(f"Bulk generation complete: {run.images} image(s) written, {run.failed} failed.")
+
+if __name__ == "__main__":
+    main()
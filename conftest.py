@@ -0,0 +1 @@
+# Puts the repository root on sys.path so tests import `utils` the same way the app does.
@@ -1,11 +1,27 @@
+"""Generates the style libraries (static/styles/<style>/<n>.png) with FLUX.1-dev.
+
+Resumable: every library has a manifest.json recording the file hash, prompt, seed, model and
+parameters of each image, and images whose file and manifest entry still match are skipped.
+Several seeds are generated per pipeline call, and styles can be spread over devices (one
+process per device).
+
+Usage:
+    python datasetgen.py                                   # all styles, 10 images each
+    python datasetgen.py --num-images 50 --batch-size 4    # extend every library to 50 images
+    python datasetgen.py --styles ziggy pixel_art --devices cuda:0,cuda:1
+    python datasetgen.py --adopt                           # record existing images without regenerating
+"""
 import os
+import time
+import queue
+import argparse
+import multiprocessing
 import torch
 from diffusers import FluxPipeline
-from PIL import Image
+from utils.style_manifest import load_library_manifest, write_library_manifest, file_sha256, trusted_file_hashes
 
 # --- Configuration ---
 DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
-DTYPE = torch.bfloat16 if DEVICE == "cuda" else torch.float32
 
 # Correct FLUX.1 dev model ID from Black Forest Labs
 MODEL_ID = "black-forest-labs/FLUX.1-dev"
@@ -13,6 +29,16 @@ MODEL_ID = "black-forest-labs/FLUX.1-dev"
 NUM_IMAGES_PER_STYLE = 10
 OUTPUT_ROOT = os.path.join("static", "styles")
 SEED_BASE = 12345
+BATCH_SIZE = 2 # Seeds per pipeline call
+
+# Part of every manifest entry: changing any of them regenerates the affected images
+GENERATION_PARAMS = {
+    "height": 1024,  # FLUX.1 recommends 1024x1024 for high quality
+    "width": 1024,
+    "num_inference_steps": 50,  # Recommended for FLUX.1-dev
+    "guidance_scale": 3.5,  # Suggested value for FLUX.1-dev
+    "max_sequence_length": 512,  # FLUX.1 supports longer prompts
+}
 
 # Updated style prompts to include single person's face with freely generated environment
 STYLE_PROMPTS = {
@@ -45,47 +71,181 @@ NEGATIVE_PROMPT = (
     "low quality, cropped, crowded, extra faces"
 )
 
-def main():
-    os.makedirs(OUTPUT_ROOT, exist_ok=True)
-    
-    # Load pipeline
+# --- Manifest ---
+
+def image_spec(style: str, index: int) -> dict:
+    """Everything that determines image `index` of a style (compared against its manifest entry)."""
+    return {
+        "prompt": STYLE_PROMPTS[style],
+        "negative_prompt": NEGATIVE_PROMPT,
+        "seed": SEED_BASE + index,
+        "model": MODEL_ID,
+        "params": GENERATION_PARAMS,
+    }
+
+def image_file(index: int) -> str:
+    return f"{index + 1}.png"
+
+def read_entries(out_dir: str) -> dict:
+    """Manifest entries by file name; the sha256 of files changed since the manifest is re-checked."""
+    manifest = load_library_manifest(out_dir)
+    if manifest is None:
+        return {}
+    trusted = trusted_file_hashes(out_dir, manifest)
+    entries = {}
+    for entry in manifest.get("images", []):
+        path = os.path.join(out_dir, entry["file"])
+        if not os.path.exists(path):
+            continue
+        if entry["file"] in trusted or file_sha256(path) == entry["sha256"]:
+            entries[entry["file"]] = entry
+    return entries
+
+def write_entries(out_dir: str, style: str, entries: dict):
+    ordered = sorted(entries.values(), key=lambda entry: int(os.path.splitext(entry["file"])[0]))
+    write_library_manifest(out_dir, {"style": style, "images": ordered})
+
+def make_entry(out_dir: str, style: str, index: int) -> dict:
+    path = os.path.join(out_dir, image_file(index))
+    return {
+        "file": image_file(index),
+        "sha256": file_sha256(path),
+        "bytes": os.path.getsize(path),
+        **image_spec(style, index),
+    }
+
+def plan_style(style: str, num_images: int, force: bool = False) -> list[int]:
+    """Indices of the images that are missing or don't match their manifest entry."""
+    out_dir = os.path.join(OUTPUT_ROOT, style)
+    entries = {} if force else read_entries(out_dir)
+    pending = []
+    for index in range(num_images):
+        entry = entries.get(image_file(index))
+        if entry is None or {key: entry.get(key) for key in image_spec(style, index)} != image_spec(style, index):
+            pending.append(index)
+    return pending
+
+def adopt_existing(style: str, num_images: int) -> int:
+    """Records existing images that have no manifest entry as made with the current settings."""
+    out_dir = os.path.join(OUTPUT_ROOT, style)
+    entries = read_entries(out_dir)
+    adopted = 0
+    for index in range(num_images):
+        if image_file(index) not in entries and os.path.exists(os.path.join(out_dir, image_file(index))):
+            entries[image_file(index)] = make_entry(out_dir, style, index)
+            adopted += 1
+    if adopted:
+        write_entries(out_dir, style, entries)
+    return adopted
+
+# --- Generation ---
+
+def load_pipeline(device: str) -> FluxPipeline:
+    dtype = torch.bfloat16 if device.startswith("cuda") else torch.float32
     pipe = FluxPipeline.from_pretrained(
         MODEL_ID,
-        torch_dtype=DTYPE,
+        torch_dtype=dtype,
     )
-
-    # Move to device and enable optimizations
-    pipe.to(DEVICE)
-    if DEVICE == "cuda":
-        pipe.enable_model_cpu_offload()  # Save VRAM by offloading to CPU
+    if device.startswith("cuda"):
+        pipe.enable_model_cpu_offload(device=device)  # Save VRAM by offloading to CPU
         try:
             pipe.enable_xformers_memory_efficient_attention()
-        except:
+        except Exception:
             print("xformers not available, skipping.")
+    else:
+        pipe.to(device)
     pipe.enable_attention_slicing()  # Further memory optimization
+    return pipe
+
+def build_style(pipe, style: str, num_images: int, batch_size: int, force: bool = False):
+    """Generates a style's pending images, batch_size seeds per call, updating the manifest after every batch."""
+    out_dir = os.path.join(OUTPUT_ROOT, style)
+    os.makedirs(out_dir, exist_ok=True)
+    pending = plan_style(style, num_images, force)
+    if not pending:
+        print(f"Style '{style}' is up to date ({num_images} images).")
+        return
+    entries = read_entries(out_dir)
+    print(f"Generating {len(pending)} of {num_images} images for style '{style}'")
+
+    for start in range(0, len(pending), batch_size):
+        indices = pending[start:start + batch_size]
+        generators = [torch.Generator(device="cpu").manual_seed(SEED_BASE + index) for index in indices]
+        batch_start = time.perf_counter()
+        result = pipe(
+            prompt=[STYLE_PROMPTS[style]] * len(indices),
+            negative_prompt=[NEGATIVE_PROMPT] * len(indices),
+            generator=generators,
+            **GENERATION_PARAMS,
+        )
+        for index, image in zip(indices, result.images):
+            # Written under a temporary name first, so an interruption never leaves a truncated PNG
+            path = os.path.join(out_dir, image_file(index))
+            image.save(path + ".tmp", format="PNG")
+            os.replace(path + ".tmp", path)
+            entries[image_file(index)] = make_entry(out_dir, style, index)
+        write_entries(out_dir, style, entries)
+        print(f"  {style}: images {[index + 1 for index in indices]} done in {time.perf_counter() - batch_start:.1f}s")
+
+def style_queue(queue_, styles: list[str]):
+    for style in styles:
+        queue_.put(style)
+    return queue_
+
+def run_device(device: str, styles, num_images: int, batch_size: int, force: bool):
+    """Loads the pipeline on one device and builds styles taken from `styles` until none are left."""
+    pipe = load_pipeline(device)
+    while True:
+        try:
+            style = styles.get_nowait()
+        except queue.Empty:
+            return
+        build_style(pipe, style, num_images, batch_size, force)
+
+def main():
+    parser = argparse.ArgumentParser(description="Generates the style libraries with FLUX.1-dev.")
+    parser.add_argument("--styles", nargs="+", default=list(STYLE_PROMPTS), choices=list(STYLE_PROMPTS))
+    parser.add_argument("--num-images", type=int, default=NUM_IMAGES_PER_STYLE, help="Images per style")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="Seeds per pipeline call")
+    parser.add_argument("--devices", default=DEVICE, help="Comma-separated devices, one process each (e.g. cuda:0,cuda:1)")
+    parser.add_argument("--force", action="store_true", help="Regenerate even if the manifest matches")
+    parser.add_argument("--adopt", action="store_true", help="Record existing images without manifest entries, then exit")
+    args = parser.parse_args()
+    os.makedirs(OUTPUT_ROOT, exist_ok=True)
+
+    if args.adopt:
+        for style in args.styles:
+            print(f"Style '{style}': recorded {adopt_existing(style, args.num_images)} existing image(s).")
+        return
+
+    # The pipeline is only loaded when something is missing
+    plan = {style: plan_style(style, args.num_images, args.force) for style in args.styles}
+    styles = [style for style in args.styles if plan[style]]
+    for style in args.styles:
+        print(f"Style '{style}': {len(plan[style])} of {args.num_images} images to generate.")
+    if not styles:
+        print("Dataset is up to date.")
+        return
 
-    # Generate images per style
-    for style, prompt in STYLE_PROMPTS.items():
-        out_dir = os.path.join(OUTPUT_ROOT, style)
-        os.makedirs(out_dir, exist_ok=True)
-        print(f"Generating {NUM_IMAGES_PER_STYLE} images for style '{style}'")
-
-        for i in range(NUM_IMAGES_PER_STYLE):
-            gen = torch.Generator(device="cpu").manual_seed(SEED_BASE + i)
-            result = pipe(
-                prompt=prompt,
-                negative_prompt=NEGATIVE_PROMPT,
-                height=1024,  # FLUX.1 recommends 1024x1024 for high quality
-                width=1024,
-                num_inference_steps=50,  # Recommended for FLUX.1-dev
-                guidance_scale=3.5,  # Suggested value for FLUX.1-dev
-                max_sequence_length=512,  # FLUX.1 supports longer prompts
-                generator=gen
-            )
-            img = result.images[0]
-            img.save(os.path.join(out_dir, f"{i+1}.png"))
+    devices = [device.strip() for device in args.devices.split(",") if device.strip()]
+    if len(devices) == 1 or len(styles) == 1:
+        run_device(devices[0], style_queue(queue.Queue(), styles), args.num_images, args.batch_size, args.force)
+    else:
+        # One process per device; each takes the next unfinished style when it is done
+        context = multiprocessing.get_context("spawn")
+        shared_styles = style_queue(context.Queue(), styles)
+        processes = [
+            context.Process(target=run_device, args=(device, shared_styles, args.num_images, args.batch_size, args.force))
+            for device in devices[:len(styles)]
+        ]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        if any(process.exitcode != 0 for process in processes):
+            raise SystemExit("A generation process failed; rerun to resume.")
 
     print("Dataset generation complete.")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,15 @@
+import torch
+from utils.config import DEVICE
+
+
+def make_generators(seeds: list[int | None]) -> list[torch.Generator]:
+    """One torch.Generator per batch item so each image stays reproducible from its own seed."""
+    generators = []
+    for seed in seeds:
+        generator = torch.Generator(device=DEVICE)
+        if seed is not None:
+            generator.manual_seed(seed)
+        else:
+            generator.seed()
+        generators.append(generator)
+    return generators
@@ -1,8 +1,6 @@
 import torch
 from PIL import Image
-from typing import List
 from utils.config import (
-    DEVICE,
     DEFAULT_NEGATIVE_PROMPT,
     DEFAULT_STEPS,
     DEFAULT_STYLE_SCALE,
@@ -10,53 +8,110 @@ from utils.config import (
     DEFAULT_GUIDANCE_SCALE,
     DEFAULT_STYLE_NEGATIVE_PROMPT
 )
+from utils.style_embeddings import prepare_ip_adapter_embeds
+from utils.face_embeddings import get_face_embeds
+from generators.common import make_generators
+from utils.batch_scheduler import consecutive_seeds
+from utils.prompt_cache import encode_prompts_cached
+from utils.deep_cache import deep_cache
 
 @torch.no_grad()
-def generate_face_style_emoji(
+def generate_face_style_emoji_batch(
     pipe,
-    face_image: Image.Image,
-    style_images: List[Image.Image],
-    prompt: str,
-    negative_prompt: str | None = None,  # Allow None from caller
+    face_images: list[Image.Image | None],
+    style_embeds: torch.Tensor,
+    prompts: list[str],
+    negative_prompts: list[str | None],
     style_scale: float = DEFAULT_STYLE_SCALE,
     face_scale: float = DEFAULT_FACE_SCALE,
     num_inference_steps: int = DEFAULT_STEPS,
     guidance_scale: float = DEFAULT_GUIDANCE_SCALE,
-    seed: int | None = None
-) -> Image.Image | None:
-    """Generates a personalized emoji using face image, style images, and text prompt."""
-    pipe = pipe.to(DEVICE)
+    seeds: list[int | None] | None = None,
+    image_size: int | None = None, # None = the model's native resolution
+    callback_on_step_end=None,
+    face_hashes: list[str | None] | None = None, # Normalized-face hashes (face embedding cache keys)
+    face_embeds: list[torch.Tensor | None] | None = None, # Embeds already taken from the cache
+    deep_cache_interval: int = 0 # UNet feature caching (see utils/deep_cache.py); <= 1 = off
+) -> list[Image.Image] | None:
+    """Generates one personalized emoji per (face, prompt) pair with a shared style library in one call."""
     if pipe is None:
         print("Error: Face+Style pipeline is not loaded.")
         return None
-    if not face_image or not style_images:
-        print("Error: Missing face image or style images.")
+    face_hashes = face_hashes if face_hashes is not None else [None] * len(face_images)
+    face_embeds = face_embeds if face_embeds is not None else [None] * len(face_images)
+    if (not face_images or style_embeds is None
+            or any(face is None and embeds is None and face_hash is None
+                   for face, embeds, face_hash in zip(face_images, face_embeds, face_hashes))):
+        print("Error: Missing face image or style embeddings.")
         return None
 
-    prompt = prompt if prompt else "emoji in a highly stylized artistic manner"
-    final_negative_prompt = negative_prompt if negative_prompt is not None else DEFAULT_STYLE_NEGATIVE_PROMPT
-
-    device = pipe.device
-    generator = torch.Generator(device=device).manual_seed(seed) if seed is not None else None
+    prompts = [p if p else "emoji in a highly stylized artistic manner" for p in prompts]
+    final_negative_prompts = [n if n is not None else DEFAULT_STYLE_NEGATIVE_PROMPT for n in negative_prompts]
+    generators = make_generators(seeds if seeds is not None else [None] * len(prompts))
 
-    # According to diffusers docs, pass [style_images, face_image] (list of images, not tensors)
-    ip_adapter_inputs = [style_images, face_image]
+    # Style embeds are precomputed per library; faces not in the face embedding cache go through
+    # the image encoder in one pass. Order matches the loaded adapters: [Plus (style), Plus-Face (face)]
+    try:
+        face_embeds = get_face_embeds(pipe, face_images, face_hashes, face_embeds)
+    except ValueError as e:
+        print(f"Error: {e}")
+        return None
+    ip_adapter_embeds = prepare_ip_adapter_embeds(
+        pipe, [style_embeds, face_embeds], guidance_scale, batch_size=len(prompts)
+    )
     adapter_scales = [style_scale, face_scale]
 
+    # Adapter processors live on the shared UNet, so scales must be set on every request
+    try:
+        pipe.set_ip_adapter_scale(adapter_scales)
+    except ValueError as e:
+         print(f"Error setting IP adapter scales (check number of loaded adapters): {e}")
+         return None
     print(f"Set IP-Adapter scales: Style={style_scale}, Face={face_scale}")
-    print(f"Generating face+style emoji with prompt: '{prompt}'")
+    print(f"Generating {len(prompts)} face+style emoji(s) with prompts: {prompts}")
     try:
-        image = pipe(
-            prompt=prompt,
-            negative_prompt=final_negative_prompt,
-            ip_adapter_image=ip_adapter_inputs,
-            ip_adapter_scale=adapter_scales,
-            num_inference_steps=num_inference_steps,
-            guidance_scale=guidance_scale,
-            generator=generator
-        ).images[0]
+        # Text-encoder outputs come from the prompt cache (negatives are almost always hits)
+        prompt_embeds = encode_prompts_cached(pipe, prompts, final_negative_prompts, guidance_scale)
+        with deep_cache(pipe, deep_cache_interval):
+            images = pipe(
+                **prompt_embeds,
+                ip_adapter_image_embeds=ip_adapter_embeds,
+                num_inference_steps=num_inference_steps,
+                guidance_scale=guidance_scale,
+                generator=generators,
+                height=image_size,
+                width=image_size,
+                callback_on_step_end=callback_on_step_end
+            ).images
         print("Face+style emoji generation complete.")
-        return image
+        return images
     except Exception as e:
         print(f"Error during face+style emoji generation: {e}")
-        return None
\ No newline at end of file
+        return None
+
+def generate_face_style_emoji(
+    pipe,
+    face_image: Image.Image,
+    style_embeds: torch.Tensor,
+    prompt: str,
+    negative_prompt: str | None = None,  # Allow None from caller
+    style_scale: float = DEFAULT_STYLE_SCALE,
+    face_scale: float = DEFAULT_FACE_SCALE,
+    num_inference_steps: int = DEFAULT_STEPS,
+    guidance_scale: float = DEFAULT_GUIDANCE_SCALE,
+    seed: int | None = None,
+    count: int | None = None # None = one image; N = a list of N variants
+) -> Image.Image | list[Image.Image] | None:
+    """Generates a personalized emoji using face image, style library embeddings, and text prompt.
+
+    With `count`, generates that many variants (consecutive seeds) in one pipeline call and returns them as a list.
+    """
+    prompts, negative_prompts = [prompt] * (count or 1), [negative_prompt] * (count or 1)
+    seeds = consecutive_seeds(seed, count) if count is not None else [seed]
+    images = generate_face_style_emoji_batch(
+        pipe, [face_image] * len(prompts), style_embeds, prompts, negative_prompts,
+        style_scale, face_scale, num_inference_steps, guidance_scale, seeds
+    )
+    if count is not None:
+        return images
+    return images[0] if images else None
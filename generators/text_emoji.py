@@ -1,41 +1,72 @@
 import torch
 from PIL import Image
-from utils.config import DEVICE, DEFAULT_TEXT_NEGATIVE_PROMPT, DEFAULT_STEPS, DEFAULT_GUIDANCE_SCALE
+from utils.config import DEFAULT_TEXT_NEGATIVE_PROMPT, DEFAULT_STEPS, DEFAULT_GUIDANCE_SCALE
+from generators.common import make_generators
+from utils.batch_scheduler import consecutive_seeds
+from utils.prompt_cache import encode_prompts_cached
+from utils.deep_cache import deep_cache
 
 @torch.no_grad()
-def generate_text_emoji(
+def generate_text_emoji_batch(
     pipe,
-    prompt: str,
-    negative_prompt: str | None = None, 
+    prompts: list[str],
+    negative_prompts: list[str | None],
     num_inference_steps: int = DEFAULT_STEPS,
     guidance_scale: float = DEFAULT_GUIDANCE_SCALE,
-    seed: int | None = None
-) -> Image.Image | None:
-    """Generates an emoji based purely on text prompt."""
+    seeds: list[int | None] | None = None,
+    image_size: int | None = None, # None = the model's native resolution
+    callback_on_step_end=None,
+    deep_cache_interval: int = 0 # UNet feature caching (see utils/deep_cache.py); <= 1 = off
+) -> list[Image.Image] | None:
+    """Generates one emoji per prompt in a single batched pipeline call."""
 
     if pipe is None:
         print("Error: Text-to-Emoji pipeline is not loaded.")
         return None
 
     # Use default negative prompt if caller provides None or empty string
-    final_negative_prompt = negative_prompt if negative_prompt else DEFAULT_TEXT_NEGATIVE_PROMPT
-
-    generator = None
-    if seed is not None:
-        generator = torch.Generator(device=DEVICE).manual_seed(seed)
+    final_negative_prompts = [n if n else DEFAULT_TEXT_NEGATIVE_PROMPT for n in negative_prompts]
+    generators = make_generators(seeds if seeds is not None else [None] * len(prompts))
 
-    print(f"Generating text emoji with prompt: '{prompt}'")
+    print(f"Generating {len(prompts)} text emoji(s) with prompts: {prompts}")
     try:
-        image = pipe(
-            prompt=prompt,
-            negative_prompt=final_negative_prompt,
-            num_inference_steps=num_inference_steps,
-            guidance_scale=guidance_scale,
-            generator=generator
-        ).images[0]
+        # Text-encoder outputs come from the prompt cache (negatives are almost always hits)
+        prompt_embeds = encode_prompts_cached(pipe, prompts, final_negative_prompts, guidance_scale)
+        with deep_cache(pipe, deep_cache_interval):
+            images = pipe(
+                **prompt_embeds,
+                num_inference_steps=num_inference_steps,
+                guidance_scale=guidance_scale,
+                generator=generators,
+                height=image_size,
+                width=image_size,
+                callback_on_step_end=callback_on_step_end
+            ).images
         print("Text emoji generation complete.")
-        return image
+        return images
     except Exception as e:
         print(f"Error during text emoji generation: {e}")
         # Consider logging the full error: import traceback; traceback.print_exc()
-        return None
\ No newline at end of file
+        return None
+
+def generate_text_emoji(
+    pipe,
+    prompt: str,
+    negative_prompt: str | None = None, 
+    num_inference_steps: int = DEFAULT_STEPS,
+    guidance_scale: float = DEFAULT_GUIDANCE_SCALE,
+    seed: int | None = None,
+    count: int | None = None # None = one image; N = a list of N variants
+) -> Image.Image | list[Image.Image] | None:
+    """Generates an emoji based purely on text prompt.
+
+    With `count`, generates that many variants (consecutive seeds) in one pipeline call and returns them as a list.
+    """
+    prompts, negative_prompts = [prompt] * (count or 1), [negative_prompt] * (count or 1)
+    seeds = consecutive_seeds(seed, count) if count is not None else [seed]
+    images = generate_text_emoji_batch(
+        pipe, prompts, negative_prompts, num_inference_steps, guidance_scale, seeds
+    )
+    if count is not None:
+        return images
+    return images[0] if images else None
@@ -1,41 +1,43 @@
 import torch
 from PIL import Image
-from typing import List
 from utils.config import (
-    DEVICE,
     DEFAULT_STYLE_NEGATIVE_PROMPT,
     DEFAULT_STEPS,
     DEFAULT_GUIDANCE_SCALE,
     DEFAULT_STYLE_SCALE
 )
+from utils.style_embeddings import prepare_ip_adapter_embeds
+from generators.common import make_generators
+from utils.batch_scheduler import consecutive_seeds
+from utils.prompt_cache import encode_prompts_cached
+from utils.deep_cache import deep_cache
 
 @torch.no_grad()
-def generate_text_style_emoji(
+def generate_text_style_emoji_batch(
     pipe,
-    style_images: List[Image.Image],
-    prompt: str,
-    negative_prompt: str | None = None, # Allow None from caller
+    style_embeds: torch.Tensor,
+    prompts: list[str],
+    negative_prompts: list[str | None],
     style_scale: float = DEFAULT_STYLE_SCALE,
     num_inference_steps: int = DEFAULT_STEPS,
     guidance_scale: float = DEFAULT_GUIDANCE_SCALE,
-    seed: int | None = None
-) -> Image.Image | None:
-    """Generates an emoji using text prompt and style images."""
+    seeds: list[int | None] | None = None,
+    image_size: int | None = None, # None = the model's native resolution
+    callback_on_step_end=None,
+    deep_cache_interval: int = 0 # UNet feature caching (see utils/deep_cache.py); <= 1 = off
+) -> list[Image.Image] | None:
+    """Generates one emoji per prompt with a shared style library in a single batched call."""
 
     if pipe is None:
         print("Error: Text+Style pipeline is not loaded.")
         return None
     
-    pipe = pipe.to(DEVICE)
-    if not style_images:
-        print("Error: Missing style images.")
+    if style_embeds is None:
+        print("Error: Missing style embeddings.")
         return None
 
-    final_negative_prompt = negative_prompt if negative_prompt else DEFAULT_STYLE_NEGATIVE_PROMPT
-
-    generator = None
-    if seed is not None:
-        generator = torch.Generator(device=DEVICE).manual_seed(seed)
+    final_negative_prompts = [n if n else DEFAULT_STYLE_NEGATIVE_PROMPT for n in negative_prompts]
+    generators = make_generators(seeds if seeds is not None else [None] * len(prompts))
 
     try:
         pipe.set_ip_adapter_scale(style_scale)
@@ -44,22 +46,51 @@ def generate_text_style_emoji(
          return None
     print(f"Set IP-Adapter style scale: {style_scale}")
 
-    ip_adapter_inputs = [style_images]
+    ip_adapter_embeds = prepare_ip_adapter_embeds(pipe, [style_embeds], guidance_scale, batch_size=len(prompts))
 
-    print(f"Generating text+style emoji with prompt: '{prompt}'")
+    print(f"Generating {len(prompts)} text+style emoji(s) with prompts: {prompts}")
     try:
-        image = pipe(
-            prompt=prompt,
-            negative_prompt=final_negative_prompt,
-            ip_adapter_image=ip_adapter_inputs,
-            ip_adapter_scale=style_scale,
-            num_inference_steps=num_inference_steps,
-            guidance_scale=guidance_scale,
-            generator=generator
-        ).images[0]
+        # Text-encoder outputs come from the prompt cache (negatives are almost always hits)
+        prompt_embeds = encode_prompts_cached(pipe, prompts, final_negative_prompts, guidance_scale)
+        with deep_cache(pipe, deep_cache_interval):
+            images = pipe(
+                **prompt_embeds,
+                ip_adapter_image_embeds=ip_adapter_embeds,
+                num_inference_steps=num_inference_steps,
+                guidance_scale=guidance_scale,
+                generator=generators,
+                height=image_size,
+                width=image_size,
+                callback_on_step_end=callback_on_step_end
+            ).images
         print("Text+style emoji generation complete.")
-        return image
+        return images
     except Exception as e:
         print(f"Error during text+style emoji generation: {e}")
         # import traceback; traceback.print_exc()
-        return None
\ No newline at end of file
+        return None
+
+def generate_text_style_emoji(
+    pipe,
+    style_embeds: torch.Tensor,
+    prompt: str,
+    negative_prompt: str | None = None, # Allow None from caller
+    style_scale: float = DEFAULT_STYLE_SCALE,
+    num_inference_steps: int = DEFAULT_STEPS,
+    guidance_scale: float = DEFAULT_GUIDANCE_SCALE,
+    seed: int | None = None,
+    count: int | None = None # None = one image; N = a list of N variants
+) -> Image.Image | list[Image.Image] | None:
+    """Generates an emoji using text prompt and precomputed style library embeddings.
+
+    With `count`, generates that many variants (consecutive seeds) in one pipeline call and returns them as a list.
+    """
+    prompts, negative_prompts = [prompt] * (count or 1), [negative_prompt] * (count or 1)
+    seeds = consecutive_seeds(seed, count) if count is not None else [seed]
+    images = generate_text_style_emoji_batch(
+        pipe, style_embeds, prompts, negative_prompts, style_scale,
+        num_inference_steps, guidance_scale, seeds
+    )
+    if count is not None:
+        return images
+    return images[0] if images else None
@@ -0,0 +1,23 @@
+"""Packs each style library into a memory-mappable array of pre-resized images.
+
+Usage:
+    python pack_styles.py                 # all libraries in STYLE_LIBRARIES
+    python pack_styles.py ziggy pixel_art # selected libraries
+"""
+import sys
+from utils.config import STYLE_LIBRARIES, STYLE_PACK_SIZE
+from utils.style_packs import pack_style_library
+
+
+def main():
+    style_names = sys.argv[1:] or list(STYLE_LIBRARIES)
+    for style_name in style_names:
+        style_dir = STYLE_LIBRARIES.get(style_name)
+        if style_dir is None:
+            print(f"Unknown style library: {style_name}")
+            continue
+        pack_style_library(style_dir, STYLE_PACK_SIZE)
+    print("Style packing complete.")
+
+if __name__ == "__main__":
+    main()
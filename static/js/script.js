@@ -13,8 +13,11 @@ document.addEventListener("DOMContentLoaded", () => {
   const outputImage = document.getElementById("output-image");
   const placeholderText = document.getElementById("placeholder-text");
   const errorMessage = document.getElementById("error-message");
+  const statusMessage = document.getElementById("status-message");
   const downloadBtn = document.getElementById("download-btn");
   const shareBtn = document.getElementById("share-btn");
+  const cancelBtn = document.getElementById("cancel-btn");
+  let currentJob = null; // Job being generated (for cancellation)
 
   // === Event Listeners ===
   tabButtons.forEach((btn) => {
@@ -44,6 +47,16 @@ document.addEventListener("DOMContentLoaded", () => {
 
   generateBtn.addEventListener("click", handleGenerate);
 
+  cancelBtn.addEventListener("click", async () => {
+    if (!currentJob) return;
+    cancelBtn.disabled = true;
+    try {
+      await fetch(currentJob.cancel_url, { method: "POST" });
+    } catch (error) {
+      console.error("Cancel failed:", error);
+    }
+  });
+
   // === Functions ===
   function handleTabChange(clickedTab) {
     tabButtons.forEach((tab) => tab.classList.remove("active"));
@@ -133,30 +146,36 @@ document.addEventListener("DOMContentLoaded", () => {
       formData.append("face_image", faceFile);
     }
 
-    // --- API Call ---
+    // --- API Call (async job + progress stream) ---
     try {
-      const response = await fetch("/api/generate", {
+      const response = await fetch("/api/jobs", {
         method: "POST",
         body: formData,
-        // headers: { 'Accept': 'application/json' } // Not needed for FormData usually
       });
 
-      const result = await response.json();
+      const created = await response.json();
 
       if (!response.ok) {
         // Handle HTTP errors (4xx, 5xx) with error message from JSON payload
-        throw new Error(result.error || `HTTP error ${response.status}`);
+        throw new Error(created.error || `HTTP error ${response.status}`);
       }
 
-      if (result.image_data) {
-        // Success: Display image
-        outputImage.src = result.image_data;
+      currentJob = {
+        ...created,
+        cancel_url: `/api/jobs/${created.job_id}/cancel`,
+      };
+      cancelBtn.disabled = false;
+      const result = await waitForJob(currentJob);
+
+      if (result.image_url) {
+        // Success: Display image (served as raw bytes, cacheable by the browser)
+        outputImage.src = result.image_url;
+        outputImage.dataset.format = result.format || "png";
         outputImage.style.display = "block";
         placeholderText.style.display = "none";
         downloadBtn.disabled = false;
         shareBtn.disabled = false; // Enable share button
       } else if (result.error) {
-        // Handle errors reported in JSON payload even with 200 OK (less common)
         showError(result.error);
       } else {
         // Handle unexpected success response format
@@ -167,10 +186,84 @@ document.addEventListener("DOMContentLoaded", () => {
       showError(error.message || "Network error or server unavailable.");
     } finally {
       // --- Reset UI State ---
+      currentJob = null;
+      cancelBtn.disabled = true;
       setLoading(false);
     }
   }
 
+  // Follows a job's Server-Sent Events stream until it finishes.
+  // Falls back to polling the status URL if the stream can't be used.
+  function waitForJob(job) {
+    return new Promise((resolve, reject) => {
+      if (!window.EventSource) {
+        pollJob(job.status_url).then(resolve, reject);
+        return;
+      }
+
+      const events = new EventSource(job.events_url);
+
+      events.addEventListener("progress", (e) => {
+        const progress = JSON.parse(e.data);
+        if (progress.total_steps) {
+          statusMessage.textContent = `Generating... step ${progress.step}/${progress.total_steps}`;
+        } else {
+          statusMessage.textContent = "Waiting in queue...";
+        }
+      });
+
+      events.addEventListener("preview", (e) => {
+        // Low-cost latent preview; replaced by the final image when done
+        const preview = JSON.parse(e.data);
+        outputImage.src = preview.image_data;
+        outputImage.style.display = "block";
+        placeholderText.style.display = "none";
+      });
+
+      events.addEventListener("cancelled", () => {
+        events.close();
+        reject(new Error("Generation cancelled."));
+      });
+
+      events.addEventListener("done", (e) => {
+        events.close();
+        resolve(JSON.parse(e.data));
+      });
+
+      events.addEventListener("error", (e) => {
+        events.close();
+        if (e.data) {
+          // Error reported by the server for this job
+          const payload = JSON.parse(e.data);
+          reject(new Error(payload.error || "Generation failed."));
+        } else {
+          // Connection problem: keep following the job by polling
+          pollJob(job.status_url).then(resolve, reject);
+        }
+      });
+    });
+  }
+
+  async function pollJob(statusUrl) {
+    while (true) {
+      const response = await fetch(statusUrl);
+      const job = await response.json();
+      if (!response.ok || job.status === "error") {
+        throw new Error(job.error || `HTTP error ${response.status}`);
+      }
+      if (job.status === "cancelled") {
+        throw new Error("Generation cancelled.");
+      }
+      if (job.status === "done") {
+        return job;
+      }
+      if (job.total_steps) {
+        statusMessage.textContent = `Generating... step ${job.step}/${job.total_steps}`;
+      }
+      await new Promise((r) => setTimeout(r, 1000));
+    }
+  }
+
   function setLoading(isLoading) {
     if (isLoading) {
       generateBtn.classList.add("loading");
@@ -194,6 +287,7 @@ document.addEventListener("DOMContentLoaded", () => {
     outputImage.style.display = "none";
     outputImage.src = "#"; // Clear src
     placeholderText.style.display = "flex";
+    statusMessage.textContent = "Your emoji will appear here";
     errorMessage.style.display = "none";
     errorMessage.textContent = "";
     downloadBtn.disabled = true;
@@ -204,7 +298,8 @@ document.addEventListener("DOMContentLoaded", () => {
   downloadBtn.addEventListener("click", () => {
     if (outputImage.src && outputImage.src !== "#") {
       const link = document.createElement("a");
-      link.href = outputImage.src;
+      // Ask the server for an attachment instead of re-fetching the image client-side
+      link.href = `${outputImage.src}?download=1`;
       // Generate a more descriptive filename maybe
       const mode = modeInput.value;
       const promptStart = document
@@ -212,7 +307,8 @@ document.addEventListener("DOMContentLoaded", () => {
         .value.trim()
         .substring(0, 15)
         .replace(/\s+/g, "_");
-      link.download = `MojiSan_${mode}_${promptStart || "emoji"}.png`;
+      const extension = outputImage.dataset.format || "png";
+      link.download = `MojiSan_${mode}_${promptStart || "emoji"}.${extension}`;
       document.body.appendChild(link);
       link.click();
       document.body.removeChild(link);
@@ -222,10 +318,11 @@ document.addEventListener("DOMContentLoaded", () => {
   shareBtn.addEventListener("click", async () => {
     if (outputImage.src && outputImage.src !== "#" && navigator.share) {
       try {
-        // Convert data URL to blob for sharing
+        // Fetch the served image (usually from the browser cache) for sharing
         const response = await fetch(outputImage.src);
         const blob = await response.blob();
-        const file = new File([blob], "synthemoji.png", { type: "image/png" });
+        const extension = outputImage.dataset.format || "png";
+        const file = new File([blob], `synthemoji.${extension}`, { type: blob.type });
 
         await navigator.share({
           title: "My AI Emoji!",
@@ -0,0 +1,36 @@
+import pytest
+from utils.admission import AdmissionController, AdmissionRejected
+from utils.config import RETRY_AFTER_DEFAULT_SECONDS
+
+
+def test_rejects_when_mode_queue_is_full():
+    controller = AdmissionController({"text": 2}, per_client=0)
+    controller.admit("text", "a")
+    controller.admit("text", "b")
+    with pytest.raises(AdmissionRejected) as rejected:
+        controller.admit("text", "c")
+    assert rejected.value.retry_after == RETRY_AFTER_DEFAULT_SECONDS
+    controller.release("text", "a", completed=True)
+    controller.admit("text", "c")
+
+
+def test_rejects_clients_over_their_limit():
+    controller = AdmissionController({"text": 0}, per_client=1)
+    controller.admit("text", "a")
+    with pytest.raises(AdmissionRejected):
+        controller.admit("text", "a")
+    controller.admit("text", "b") # Other clients are unaffected
+    assert controller.stats()["rejected"] == 1
+
+
+def test_retry_after_follows_measured_service_rate(monkeypatch):
+    controller = AdmissionController({"text": 4}, per_client=0)
+    clock = iter([0.0, 2.0, 4.0])
+    monkeypatch.setattr("utils.admission.time.monotonic", lambda: next(clock))
+    for client in ("a", "b", "c"):
+        controller.admit("text", client)
+        controller.release("text", client, completed=True)
+    assert controller.service_rate("text") == pytest.approx(0.5)
+    for client in ("a", "b", "c", "d"):
+        controller.admit("text", client)
+    assert controller.retry_after("text") == 8 # 4 admitted at 0.5 completions/s
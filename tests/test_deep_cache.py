@@ -0,0 +1,17 @@
+from utils.deep_cache import full_compute_steps
+
+
+def test_uniform_schedule():
+    assert sorted(full_compute_steps(10, 3)) == [0, 3, 6, 9]
+
+
+def test_interval_of_one_or_less_computes_every_step():
+    assert full_compute_steps(5, 1) == set(range(5))
+    assert full_compute_steps(5, 0) == set(range(5))
+
+
+def test_quadratic_schedule_keeps_count_and_favours_early_steps():
+    uniform, quadratic = full_compute_steps(50, 3), full_compute_steps(50, 3, "quadratic")
+    assert len(quadratic) == len(uniform)
+    assert 0 in quadratic and max(quadratic) < 50
+    assert sum(step < 25 for step in quadratic) > sum(step < 25 for step in uniform)
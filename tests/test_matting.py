@@ -0,0 +1,75 @@
+import numpy as np
+from PIL import Image
+import utils.background_removal as background_removal
+from utils.image_utils import fast_matte
+
+
+def subject_on_background(size: int = 64, background=(245, 245, 240)) -> tuple[Image.Image, np.ndarray]:
+    """A red disc centred on a uniform light background, and the disc mask."""
+    y, x = np.mgrid[:size, :size]
+    disc = (x - size / 2) ** 2 + (y - size / 2) ** 2 <= (size / 4) ** 2
+    rgb = np.empty((size, size, 3), dtype=np.uint8)
+    rgb[:] = background
+    rgb[disc] = (200, 40, 30)
+    return Image.fromarray(rgb), disc
+
+
+def busy_image(size: int = 64) -> Image.Image:
+    return Image.fromarray(np.random.default_rng(0).integers(0, 256, (size, size, 3), dtype=np.uint8))
+
+
+def test_uniform_background_is_cut_out_with_high_confidence():
+    image, disc = subject_on_background()
+    result, confidence = fast_matte(image, tolerance=18)
+    alpha = np.asarray(result)[..., 3]
+    assert result.mode == "RGBA"
+    assert confidence > 0.9
+    assert (alpha[disc] == 255).all()
+    assert alpha[0, 0] == 0 and alpha[-1, -1] == 0
+    assert ((alpha > 127) == disc).mean() > 0.99
+
+
+def test_background_within_tolerance_is_removed():
+    image, disc = subject_on_background()
+    rgb = np.asarray(image).copy()
+    rgb[~disc] -= np.random.default_rng(0).integers(0, 10, rgb[~disc].shape, dtype=np.uint8) # Noisy, within tolerance
+    alpha = np.asarray(fast_matte(Image.fromarray(rgb), tolerance=18)[0])[..., 3]
+    assert (alpha[~disc] < 255).mean() > 0.99
+
+
+def test_edges_get_soft_alpha_and_unmixed_colour():
+    rgb = np.full((64, 64, 3), (245, 245, 240), dtype=np.uint8)
+    rgb[16:48, 16:48] = (200, 40, 30)
+    rgb[16:48, 15] = (236, 204, 198) # 20% subject over the background
+    rgba = np.asarray(fast_matte(Image.fromarray(rgb), tolerance=18, edge_softness=40)[0])
+    edge = rgba[30, 15]
+    assert 0 < edge[3] < 255
+    assert edge[1] < 204 # Un-mixing moves the colour away from the background, towards the subject
+    assert rgba[30, 30, 3] == 255
+
+
+def test_busy_background_has_low_confidence():
+    _, confidence = fast_matte(busy_image(), tolerance=18)
+    assert confidence < 0.9
+
+
+def test_low_confidence_falls_back_to_rembg(monkeypatch):
+    calls = []
+    monkeypatch.setattr(background_removal, "FAST_MATTING_ENABLED", True)
+    monkeypatch.setattr(background_removal, "get_worker_session", lambda: "session")
+    monkeypatch.setattr(background_removal, "remove_background",
+                        lambda image, session=None: calls.append(session) or image.convert("RGBA"))
+    result, timings = background_removal._remove_background_task(busy_image(), 0.0)
+    assert calls == ["session"]
+    assert timings["fast_matting_confidence"] < background_removal.FAST_MATTING_MIN_CONFIDENCE
+    assert result.mode == "RGBA"
+
+
+def test_high_confidence_skips_rembg(monkeypatch):
+    monkeypatch.setattr(background_removal, "FAST_MATTING_ENABLED", True)
+    monkeypatch.setattr(background_removal, "remove_background",
+                        lambda image, session=None: (_ for _ in ()).throw(AssertionError("rembg called")))
+    image, _ = subject_on_background()
+    result, timings = background_removal._remove_background_task(image, 0.0)
+    assert timings["fast_matting_confidence"] >= background_removal.FAST_MATTING_MIN_CONFIDENCE
+    assert result.mode == "RGBA"
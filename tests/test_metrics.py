@@ -0,0 +1,19 @@
+import sys
+import types
+from app import app
+
+
+def test_metrics_scrape_during_warmup_import(monkeypatch):
+    # The warm-up thread's imports are in sys.modules before their globals are assigned
+    for module_name in ("utils.model_loader", "utils.prompt_cache", "utils.face_embeddings", "utils.worker_pool"):
+        monkeypatch.setitem(sys.modules, module_name, types.ModuleType(module_name))
+    response = app.test_client().get("/metrics")
+    assert response.status_code == 200
+    assert b"emoji_cache_hits_total" in response.data
+
+
+def test_metrics_export_result_cache_evictions(monkeypatch):
+    from utils.result_cache import result_cache
+    monkeypatch.setattr(result_cache, "evictions", 3)
+    response = app.test_client().get("/metrics")
+    assert b'emoji_cache_evictions_total{cache="result"} 3' in response.data
@@ -0,0 +1,19 @@
+import pytest
+from utils.packs import parse_sizes
+from utils.config import PACK_MAX_SIZE, PACK_MAX_SIZES
+
+
+def test_sorts_and_dedupes_sizes():
+    assert parse_sizes("128, 32,64,32") == [32, 64, 128]
+
+
+@pytest.mark.parametrize("value", [
+    "",
+    "abc",
+    "0,32",
+    str(PACK_MAX_SIZE + 1),
+    ",".join(str(size) for size in range(1, PACK_MAX_SIZES + 2)),
+])
+def test_rejects_invalid_sizes(value):
+    with pytest.raises(ValueError):
+        parse_sizes(value)
@@ -0,0 +1,49 @@
+from types import SimpleNamespace
+import torch
+import utils.prompt_cache as prompt_cache_module
+from utils.prompt_cache import PromptEmbeddingCache, _lookup
+
+
+class FakeTokenizer:
+    model_max_length = 77
+
+    def __call__(self, texts, **kwargs):
+        return SimpleNamespace(input_ids=torch.zeros(len(texts), self.model_max_length, dtype=torch.long))
+
+
+class FakeOutput(tuple):
+    @property
+    def hidden_states(self):
+        return self[2]
+
+
+class FakeProjectionEncoder:
+    """Returns SDXL-shaped outputs for text_encoder_2: a pooled projection plus hidden states."""
+    device = torch.device("cpu")
+
+    def __call__(self, input_ids, output_hidden_states=True):
+        batch = input_ids.shape[0]
+        hidden = torch.randn(batch, 77, 1280)
+        return FakeOutput((torch.randn(batch, 1280), None, (hidden, hidden, hidden)))
+
+
+def held_bytes(cache: PromptEmbeddingCache) -> int:
+    """Bytes of storage each entry keeps alive on its own (eviction only frees what it holds)."""
+    return sum(
+        tensor.untyped_storage().nbytes()
+        for value in cache._entries.values() for tensor in value if tensor is not None
+    )
+
+
+def test_cached_entries_do_not_pin_the_batch(monkeypatch):
+    cache = PromptEmbeddingCache(max_bytes=2**30)
+    monkeypatch.setattr(prompt_cache_module, "prompt_cache", cache)
+    pipe = SimpleNamespace(tokenizer_2=FakeTokenizer(), text_encoder_2=FakeProjectionEncoder())
+
+    texts = [f"prompt {i}" for i in range(8)]
+    _lookup(pipe, "text_encoder_2", texts)
+
+    assert cache.stats()["entries"] == 8
+    assert cache.stats()["bytes"] == held_bytes(cache)
+    assert _lookup(pipe, "text_encoder_2", texts[:1])[0][0].shape == (1, 77, 1280)
+    assert cache.stats()["hits"] == 1
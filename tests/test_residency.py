@@ -0,0 +1,56 @@
+import torch
+from utils.residency import ResidencyManager
+
+
+def make_manager(budget_bytes: int | None = 100) -> tuple[ResidencyManager, list[str]]:
+    """CPU manager with a simulated budget and three 40-byte components (none resident)."""
+    moves = []
+    manager = ResidencyManager("cpu", budget_bytes=budget_bytes)
+    original_move = manager._move
+    manager._move = lambda key, device: (moves.append(key), original_move(key, device))
+    for key in ("unet", "vae", "image_encoder"):
+        manager.register(key, torch.nn.Linear(1, 1), nbytes=40)
+    return manager, moves
+
+
+def test_ensure_is_noop_when_already_resident():
+    manager, moves = make_manager()
+    assert manager.ensure(["unet", "vae"]) is True
+    moves.clear()
+    assert manager.ensure(["unet", "vae"]) is False
+    assert moves == []
+    assert manager.stats()["transfers"] == 2
+
+
+def test_evicts_least_recently_used_to_fit_budget():
+    manager, moves = make_manager()
+    manager.ensure(["unet"])
+    manager.ensure(["vae"])
+    manager.ensure(["unet"]) # unet is now the most recently used
+    manager.ensure(["image_encoder"])
+    assert not manager.is_resident("vae")
+    assert manager.stats()["resident"] == ["unet", "image_encoder"]
+    assert manager.evictions == 1
+    assert manager.resident_bytes() <= 100
+
+
+def test_never_evicts_the_requested_working_set():
+    manager, _ = make_manager()
+    manager.ensure(["unet", "vae"])
+    manager.ensure(["vae", "image_encoder"])
+    assert manager.stats()["resident"] == ["vae", "image_encoder"]
+
+
+def test_warns_when_working_set_exceeds_budget(capsys):
+    manager, _ = make_manager(budget_bytes=60)
+    assert manager.ensure(["unet", "vae"]) is True
+    assert "exceeds the device memory budget" in capsys.readouterr().out
+    assert manager.stats()["resident"] == ["unet", "vae"] # Still loaded, just over budget
+
+
+def test_unlimited_budget_never_evicts():
+    manager, _ = make_manager(budget_bytes=None)
+    manager.ensure(["unet"])
+    manager.ensure(["vae", "image_encoder"])
+    assert manager.evictions == 0
+    assert manager.resident_bytes() == 120
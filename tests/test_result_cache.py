@@ -0,0 +1,101 @@
+import os
+import dataclasses
+import pytest
+import utils.style_embeddings
+from app import result_cache_key
+from utils.batch_scheduler import GenerationRequest
+from utils.result_cache import ResultCache
+
+
+def disk_files(cache: ResultCache) -> list[str]:
+    return sorted(name for name in os.listdir(cache.cache_dir) if name.endswith(cache.suffix))
+
+
+def test_memory_hit_and_miss():
+    cache = ResultCache(100, None, 0)
+    assert cache.get("a") is None
+    cache.put("a", b"image")
+    assert cache.get("a") == b"image"
+    stats = cache.stats()
+    assert (stats["memory_hits"], stats["disk_hits"], stats["misses"]) == (1, 0, 1)
+
+
+def test_spills_to_disk_and_promotes_on_hit(tmp_path):
+    cache = ResultCache(10, str(tmp_path), 100)
+    cache.put("a", b"a" * 10)
+    cache.put("b", b"b" * 10) # Over the memory budget: "a" spills
+    assert disk_files(cache) == ["a.png"]
+    assert cache.stats()["memory_entries"] == 1
+
+    assert cache.get("a") == b"a" * 10
+    assert cache.stats()["disk_hits"] == 1
+    assert cache.get("a") == b"a" * 10 # Promoted back to memory
+    assert cache.stats()["memory_hits"] == 1
+
+
+def test_without_a_directory_evicted_entries_are_dropped():
+    cache = ResultCache(10, None, 100)
+    cache.put("a", b"a" * 10)
+    cache.put("b", b"b" * 10)
+    assert cache.get("a") is None
+
+
+def test_disk_is_trimmed_oldest_first(tmp_path):
+    cache = ResultCache(10, str(tmp_path), 25)
+    cache.put("a", b"a" * 10)
+    cache.put("b", b"b" * 10) # "a" spills
+    os.utime(tmp_path / "a.png", (0, 0)) # Oldest file on disk
+    cache.put("c", b"c" * 10) # "b" spills
+    cache.put("d", b"d" * 10) # "c" spills: 30 bytes > 25, so "a" is deleted
+    assert disk_files(cache) == ["b.png", "c.png"]
+    assert cache.stats()["evictions"] == 4 # Three spills and one trimmed file
+    assert cache.get("a") is None
+    assert cache.get("b") == b"b" * 10
+
+
+def base_request(**overrides) -> GenerationRequest:
+    fields = dict(
+        mode="face_style", prompt="a cat", style_name="pixel", face_hash="f" * 64,
+        quality="standard", image_size=512,
+    )
+    fields.update(overrides)
+    return GenerationRequest(**fields)
+
+
+@pytest.fixture
+def style_hashes(monkeypatch):
+    hashes = {"pixel": "1" * 64, "clay": "2" * 64}
+    monkeypatch.setattr(utils.style_embeddings, "style_library_hash", lambda name: hashes.get(name))
+    return hashes
+
+
+def test_cache_key_is_stable(style_hashes):
+    assert result_cache_key(base_request(), 1) == result_cache_key(base_request(), 1)
+    # Fields that do not change the image do not change the key
+    assert result_cache_key(base_request(), 1) == result_cache_key(base_request(image_format="webp", count=4), 1)
+
+
+@pytest.mark.parametrize("overrides", [
+    {"prompt": "a dog"},
+    {"negative_prompt": "blurry"},
+    {"style_name": "clay"},
+    {"face_hash": "e" * 64},
+    {"guidance_scale": 3.0},
+    {"style_scale": 0.1},
+    {"face_scale": 0.1},
+    {"num_inference_steps": 7},
+    {"image_size": 768},
+    {"quality": "draft"},
+    {"deep_cache_interval": 3},
+    {"mode": "text_style", "face_hash": None},
+])
+def test_cache_key_changes_with_each_keyed_field(style_hashes, overrides):
+    assert result_cache_key(base_request(), 1) != result_cache_key(base_request(**overrides), 1)
+
+
+def test_cache_key_changes_with_seed(style_hashes):
+    assert result_cache_key(base_request(), 1) != result_cache_key(base_request(), 2)
+
+
+def test_unhashable_style_library_is_not_cached(style_hashes):
+    assert result_cache_key(base_request(style_name="missing"), 1) is None
@@ -0,0 +1,20 @@
+import pytest
+from utils.worker_pool import parse_worker_specs, WorkerSpec
+
+
+def test_parses_modes_and_devices():
+    assert parse_worker_specs("text@cuda:0; text_style,face_style@cuda:1;text") == [
+        WorkerSpec(["text"], "cuda:0"),
+        WorkerSpec(["text_style", "face_style"], "cuda:1"),
+        WorkerSpec(["text"], None),
+    ]
+
+
+def test_empty_spec_means_no_workers():
+    assert parse_worker_specs("") == []
+
+
+@pytest.mark.parametrize("value", ["bogus@cpu", "@cpu", "text,video@cuda:0"])
+def test_rejects_unknown_or_missing_modes(value):
+    with pytest.raises(ValueError):
+        parse_worker_specs(value)
@@ -0,0 +1,111 @@
+import math
+import time
+import threading
+from collections import deque
+from concurrent.futures import Future
+from utils.config import (
+    ADMISSION_QUEUE_DEPTH,
+    MAX_REQUESTS_PER_CLIENT,
+    RETRY_AFTER_DEFAULT_SECONDS,
+    RETRY_AFTER_MAX_SECONDS,
+)
+from utils.batch_scheduler import GenerationRequest, submit_generation
+from utils.metrics import ADMISSION_REJECTED
+
+RATE_WINDOW = 32 # Completions per mode the service rate is measured over
+
+
+class AdmissionRejected(Exception):
+    """The request was not admitted; `retry_after` is the suggested wait in seconds."""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """Bounds the generation requests admitted per mode and per client.
+
+    A request holds its slots from admission until its generation future resolves (including
+    cancellation and deadline expiry), so abandoned requests free capacity as soon as the
+    scheduler drops or interrupts them.
+    """
+
+    def __init__(self, queue_depth: dict, per_client: int):
+        self.queue_depth = queue_depth # mode -> max admitted (0 = unlimited)
+        self.per_client = per_client
+        self._admitted = {}    # mode -> requests admitted and not finished
+        self._clients = {}     # client -> requests admitted and not finished
+        self._completions = {} # mode -> completion times of the last RATE_WINDOW successes
+        self._lock = threading.Lock()
+        self.rejected = 0
+
+    def service_rate(self, mode: str) -> float | None:
+        """Measured completions per second for a mode (None until two have been seen)."""
+        with self._lock:
+            completions = self._completions.get(mode)
+            if not completions or len(completions) < 2 or completions[-1] <= completions[0]:
+                return None
+            return (len(completions) - 1) / (completions[-1] - completions[0])
+
+    def retry_after(self, mode: str) -> int:
+        """Seconds until the admitted requests of a mode should have drained at the measured rate."""
+        rate = self.service_rate(mode)
+        if rate is None:
+            return RETRY_AFTER_DEFAULT_SECONDS
+        with self._lock:
+            admitted = self._admitted.get(mode, 0)
+        return min(RETRY_AFTER_MAX_SECONDS, max(1, math.ceil(admitted / rate)))
+
+    def admit(self, mode: str, client: str):
+        """Takes a slot for the mode and the client. Raises AdmissionRejected when either is full."""
+        with self._lock:
+            depth = self.queue_depth.get(mode, 0)
+            if depth and self._admitted.get(mode, 0) >= depth:
+                reason, message = "queue_full", f"Too many '{mode}' requests queued, please retry later."
+            elif self.per_client and self._clients.get(client, 0) >= self.per_client:
+                reason, message = "client_limit", f"At most {self.per_client} concurrent requests per client."
+            else:
+                self._admitted[mode] = self._admitted.get(mode, 0) + 1
+                self._clients[client] = self._clients.get(client, 0) + 1
+                return
+            self.rejected += 1
+        ADMISSION_REJECTED.inc(mode=mode, reason=reason)
+        raise AdmissionRejected(message, self.retry_after(mode))
+
+    def release(self, mode: str, client: str, completed: bool):
+        """Frees the slots taken by admit(); successful completions feed the service rate."""
+        with self._lock:
+            self._admitted[mode] -= 1
+            self._clients[client] -= 1
+            if not self._clients[client]:
+                del self._clients[client]
+            if completed:
+                self._completions.setdefault(mode, deque(maxlen=RATE_WINDOW)).append(time.monotonic())
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "admitted": dict(self._admitted),
+                "queue_depth": dict(self.queue_depth),
+                "clients": len(self._clients),
+                "per_client": self.per_client,
+                "rejected": self.rejected,
+            }
+
+
+admission = AdmissionController(ADMISSION_QUEUE_DEPTH, MAX_REQUESTS_PER_CLIENT)
+
+
+def submit_admitted(request: GenerationRequest, client: str) -> Future:
+    """Admits a request for `client` and submits it; raises AdmissionRejected when over a limit."""
+    admission.admit(request.mode, client)
+    try:
+        future = submit_generation(request)
+    except Exception:
+        admission.release(request.mode, client, completed=False)
+        raise
+    future.add_done_callback(
+        lambda f: admission.release(request.mode, client, completed=f.exception() is None)
+    )
+    return future
@@ -0,0 +1,100 @@
+import os
+import time
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from PIL import Image
+from utils.config import (
+    REMBG_MODEL, REMBG_WORKERS, REMBG_INTRA_OP_THREADS,
+    FAST_MATTING_ENABLED, FAST_MATTING_MIN_CONFIDENCE, FAST_MATTING_TOLERANCE
+)
+from utils.image_utils import remove_background, fast_matte
+
+
+# One rembg session per worker thread (ONNX Runtime releases the GIL while running)
+_worker_state = threading.local()
+
+
+def intra_op_threads() -> int:
+    if REMBG_INTRA_OP_THREADS > 0:
+        return REMBG_INTRA_OP_THREADS
+    return max(1, (os.cpu_count() or 1) // max(1, REMBG_WORKERS))
+
+def create_rembg_session(model_name: str = REMBG_MODEL):
+    """Builds a rembg session with explicit ONNX Runtime options instead of rembg's per-call default."""
+    import onnxruntime as ort
+    from rembg.sessions import sessions_class
+
+    session_class = next((sc for sc in sessions_class if sc.name() == model_name), None)
+    if session_class is None:
+        raise ValueError(f"Unknown rembg model: {model_name}")
+
+    sess_opts = ort.SessionOptions()
+    sess_opts.intra_op_num_threads = intra_op_threads()
+    sess_opts.inter_op_num_threads = 1 # Parallelism comes from the worker pool
+    start = time.perf_counter()
+    session = session_class(model_name, sess_opts)
+    print(f"Created rembg session '{model_name}' ({sess_opts.intra_op_num_threads} intra-op threads) "
+          f"in {time.perf_counter() - start:.2f}s on {threading.current_thread().name}.")
+    return session
+
+def get_worker_session():
+    """Returns the calling worker's session, creating it on first use."""
+    session = getattr(_worker_state, "session", None)
+    if session is None:
+        session = create_rembg_session()
+        _worker_state.session = session
+    return session
+
+def _remove_background_task(image: Image.Image, submitted_at: float) -> tuple[Image.Image | None, dict]:
+    started_at = time.perf_counter()
+    timings = {"background_removal_wait_seconds": started_at - submitted_at}
+    if FAST_MATTING_ENABLED:
+        try:
+            result, confidence = fast_matte(image, tolerance=FAST_MATTING_TOLERANCE)
+        except Exception as e:
+            print(f"Warning: Fast matting failed: {e}")
+            result, confidence = None, 0.0
+        timings["fast_matting_confidence"] = confidence
+        if confidence >= FAST_MATTING_MIN_CONFIDENCE:
+            timings["background_removal_seconds"] = time.perf_counter() - started_at
+            return result, timings
+        print(f"Fast matting confidence {confidence:.2f} below threshold, falling back to rembg.")
+
+    try:
+        session = get_worker_session()
+    except Exception as e:
+        print(f"Error creating rembg session: {e}")
+        session = None # Fall back to rembg's default session handling
+    result = remove_background(image, session=session)
+    timings["background_removal_seconds"] = time.perf_counter() - started_at
+    return result, timings
+
+
+background_removal_pool = ThreadPoolExecutor(max_workers=max(1, REMBG_WORKERS), thread_name_prefix="rembg")
+
+def submit_background_removal(image: Image.Image) -> Future:
+    """Queues an image for matting; the future resolves to (RGBA image or None, stage timings)."""
+    return background_removal_pool.submit(_remove_background_task, image, time.perf_counter())
+
+def warm_up_background_removal() -> bool:
+    """Creates every worker's session up front so the first requests don't pay for model loading.
+
+    Returns False if any worker could not create its session.
+    """
+    barrier = threading.Barrier(max(1, REMBG_WORKERS))
+
+    def warm_up() -> bool:
+        try:
+            get_worker_session()
+            created = True
+        except Exception as e:
+            print(f"Warning: Could not create rembg session: {e}")
+            created = False
+        try:
+            barrier.wait(timeout=60) # Keep each worker busy so every thread gets its own task
+        except threading.BrokenBarrierError:
+            pass
+        return created
+
+    futures = [background_removal_pool.submit(warm_up) for _ in range(max(1, REMBG_WORKERS))]
+    return all(future.result() for future in futures)
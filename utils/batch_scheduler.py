@@ -0,0 +1,368 @@
+import time
+import uuid
+import queue
+import threading
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Callable
+from PIL import Image
+from utils import config
+from utils.metrics import observe_stage, log_event, GENERATED_IMAGES
+from utils.config import (
+    DEFAULT_STEPS,
+    DEFAULT_GUIDANCE_SCALE,
+    DEFAULT_STYLE_SCALE,
+    DEFAULT_FACE_SCALE,
+    BATCH_WINDOW_MS,
+    MAX_BATCH_SIZE,
+    PREVIEW_INTERVAL_STEPS,
+    PREVIEW_SIZE,
+    DEEP_CACHE_INTERVAL,
+)
+# Model code (torch, diffusers) is imported inside run_batch/make_step_callback, so the
+# web app can import this module without paying for it at startup.
+
+
+def consecutive_seeds(seed: int | None, count: int) -> list[int | None]:
+    """Seeds for `count` variants of one prompt: `seed`, `seed + 1`, ... (all random if seed is None)."""
+    if seed is None:
+        return [None] * count
+    return [(seed + i) % 2**32 for i in range(count)]
+
+
+class GenerationError(Exception):
+    """A generation request that failed for a reason worth reporting to the client."""
+
+
+class GenerationCancelled(GenerationError):
+    """The request was cancelled before its generation finished."""
+
+
+class DeadlineExceeded(GenerationCancelled):
+    """The request's deadline passed before its generation finished."""
+
+
+@dataclass
+class GenerationRequest:
+    """One emoji generation submitted to the scheduler; its `count` images arrive on `future`."""
+    mode: str
+    prompt: str
+    request_id: str = field(default_factory=lambda: uuid.uuid4().hex) # Correlates structured log lines
+    negative_prompt: str | None = None
+    style_name: str | None = None
+    face_image: Image.Image | None = None
+    face_hash: str | None = None # sha256 of the normalized face (result + face embedding cache key)
+    face_embeds: "torch.Tensor | None" = field(default=None, repr=False) # Cached Plus-Face embeds (face_image may then be None)
+    guidance_scale: float = DEFAULT_GUIDANCE_SCALE
+    style_scale: float = DEFAULT_STYLE_SCALE
+    face_scale: float = DEFAULT_FACE_SCALE
+    num_inference_steps: int = DEFAULT_STEPS
+    deep_cache_interval: int = DEEP_CACHE_INTERVAL # Full UNet every N steps (see utils/deep_cache.py); <= 1 = off
+    # Device-dependent defaults, read from the config when the request is created
+    quality: str = field(default_factory=lambda: config.DEFAULT_QUALITY) # Selects the scheduler (see resolve_quality_tier)
+    image_size: int = field(default_factory=lambda: config.GENERATION_SIZE)
+    seed: int | None = None
+    count: int = 1 # Variants generated in the same pipeline call, with consecutive seeds
+    progress: Callable[[int, int], None] | None = field(default=None, repr=False) # (step, total_steps)
+    preview: Callable[[int, Image.Image], None] | None = field(default=None, repr=False) # (step, thumbnail)
+    preview_interval: int = PREVIEW_INTERVAL_STEPS
+    preview_size: int = PREVIEW_SIZE
+    image_format: str = "png" # Output encoding (applied after generation)
+    image_effort: int | None = None
+    pack_sizes: list[int] | None = None # Multi-size pack of the final image (see utils/packs.py)
+    pack_format: str = "zip" # "zip" or "atlas"
+    cancelled: bool = False
+    deadline: float | None = None # time.perf_counter() value after which the generation is abandoned
+    on_cancel: Callable[[], None] | None = field(default=None, repr=False) # Forwards cancellation (set by the worker pool)
+    timings: dict = field(default_factory=dict)
+    submitted_at: float = field(default_factory=time.perf_counter)
+    future: Future = field(default_factory=Future, repr=False)
+
+    def variant_seeds(self) -> list[int | None]:
+        """One seed per variant: `seed`, `seed + 1`, ... (all random if no seed was given)."""
+        return consecutive_seeds(self.seed, self.count)
+
+    def cancel(self):
+        """Asks the scheduler to drop this request (or interrupt its batch if it is the only one left)."""
+        self.cancelled = True
+        if self.on_cancel is not None:
+            self.on_cancel()
+
+    def expired(self) -> bool:
+        return self.deadline is not None and time.perf_counter() > self.deadline
+
+    def should_stop(self) -> bool:
+        """Cancelled, or past the deadline: the result is no longer wanted."""
+        return self.cancelled or self.expired()
+
+    def stop_error(self) -> GenerationCancelled:
+        if self.cancelled:
+            return GenerationCancelled("Generation cancelled.")
+        return DeadlineExceeded("Deadline exceeded before the generation finished.")
+
+    def batch_key(self) -> tuple:
+        """Requests with equal keys can share one pipeline call."""
+        uses_style = self.mode in ("text_style", "face_style")
+        return (
+            self.mode,
+            self.quality, # Schedulers are set per call
+            self.image_size,
+            self.style_name if uses_style else None,
+            self.num_inference_steps,
+            self.deep_cache_interval if self.deep_cache_interval > 1 else 0, # The feature cache spans the call
+            self.guidance_scale,
+            self.style_scale if uses_style else None, # IP-Adapter scales are set per call
+            self.face_scale if self.mode == "face_style" else None,
+        )
+
+
+class BatchScheduler:
+    """Single GPU-owning thread that coalesces compatible requests into batched pipeline calls."""
+
+    def __init__(self, window_ms: int = BATCH_WINDOW_MS, max_batch_size: int = MAX_BATCH_SIZE):
+        self.window = window_ms / 1000.0
+        self.max_batch_size = max(1, max_batch_size)
+        self._queue = queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="batch-scheduler", daemon=True)
+                self._thread.start()
+
+    def submit(self, request: GenerationRequest) -> Future:
+        """Queues a request and returns a Future resolving to its list of generated PIL images."""
+        self.start()
+        self._queue.put(request)
+        return request.future
+
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def _collect(self) -> list[GenerationRequest]:
+        """Blocks for the first request, then gathers more until the window closes or the batch is full."""
+        pending = [self._queue.get()]
+        deadline = time.monotonic() + self.window
+        while len(pending) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                pending.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return pending
+
+    def _run(self):
+        while True:
+            pending = self._collect()
+            groups = {}
+            for request in pending:
+                if request.should_stop(): # Dropped without touching the pipeline
+                    request.future.set_exception(request.stop_error())
+                    continue
+                groups.setdefault(request.batch_key(), []).append(request)
+            for group in groups.values():
+                for batch in self._split_by_images(group):
+                    self._run_batch(batch)
+
+    def _split_by_images(self, group: list[GenerationRequest]) -> list[list[GenerationRequest]]:
+        """Splits a group so no batch exceeds max_batch_size images (a request is never split)."""
+        batches, current, images = [], [], 0
+        for request in group:
+            if current and images + request.count > self.max_batch_size:
+                batches.append(current)
+                current, images = [], 0
+            current.append(request)
+            images += request.count
+        batches.append(current)
+        return batches
+
+    def _run_batch(self, batch: list[GenerationRequest]):
+        try:
+            images = run_batch(batch)
+            interrupted = all(request.should_stop() for request in batch) # The images are unfinished
+            for request, request_images in zip(batch, images):
+                if request.cancelled or (interrupted and request.expired()):
+                    request.future.set_exception(request.stop_error())
+                else:
+                    request.future.set_result(request_images)
+        except Exception as e:
+            for request in batch:
+                if not request.future.done():
+                    request.future.set_exception(e)
+
+
+def make_step_callback(batch: list[GenerationRequest], step_times: dict):
+    """Builds the pipeline step-end callback for a batch.
+
+    It fans progress out to every request, projects latent previews for requests that asked
+    for them, and interrupts the denoising loop once every request in the batch is cancelled
+    or past its deadline.
+    Step end times are recorded in `step_times` (the first step also covers pipeline setup,
+    so only later steps are observed as denoise_step).
+    """
+    from utils.previews import latents_to_preview
+
+    # Previews show each request's first variant
+    first_image_index = [sum(request.count for request in batch[:i]) for i in range(len(batch))]
+
+    def on_step_end(pipe, step, timestep, callback_kwargs):
+        now = time.perf_counter()
+        if step_times.get("last_step_end") is not None:
+            observe_stage("denoise_step", now - step_times["last_step_end"])
+        step_times["last_step_end"] = now
+        done_steps, total_steps = step + 1, pipe.num_timesteps
+        for index, request in zip(first_image_index, batch):
+            try:
+                if request.progress is not None:
+                    request.progress(done_steps, total_steps)
+                if (request.preview is not None and request.preview_interval > 0
+                        and done_steps % request.preview_interval == 0 and done_steps < total_steps):
+                    start = time.perf_counter()
+                    thumbnail = latents_to_preview(callback_kwargs["latents"][index], request.preview_size)
+                    request.preview(done_steps, thumbnail)
+                    request.timings["preview_seconds"] = (
+                        request.timings.get("preview_seconds", 0.0) + time.perf_counter() - start
+                    )
+                    request.timings["previews"] = request.timings.get("previews", 0) + 1
+            except Exception as e:
+                print(f"Warning: Step callback failed: {e}")
+
+        if all(request.should_stop() for request in batch):
+            print("All requests in batch cancelled or past their deadline, interrupting denoising.")
+            pipe._interrupt = True # Checked by the pipeline before each remaining step
+        return callback_kwargs
+
+    return on_step_end
+
+def run_batch(batch: list[GenerationRequest]) -> list[list[Image.Image]]:
+    """Runs a group of compatible requests as one pipeline call (must run on the scheduler thread).
+
+    Each request contributes `count` images to the call; returns the images grouped per request.
+    """
+    from utils.model_loader import get_pipeline_for_mode
+    from utils.style_embeddings import get_style_embeds
+    from utils.cpu_profile import inference_autocast
+    from generators.text_emoji import generate_text_emoji_batch
+    from generators.text_style_emoji import generate_text_style_emoji_batch
+    from generators.face_style_emoji import generate_face_style_emoji_batch
+
+    first = batch[0]
+    mode = first.mode
+    started_at = time.perf_counter()
+    for request in batch:
+        request.timings["queue_wait_seconds"] = started_at - request.submitted_at
+        observe_stage("queue_wait", request.timings["queue_wait_seconds"])
+    pipe = get_pipeline_for_mode(mode, first.quality)
+    if not pipe:
+        raise GenerationError(f"{mode.capitalize()} generation model not loaded.")
+
+    # One entry per image; variants share the prompt (and face) of their request, so the
+    # prompt and face embedding caches encode each of them once
+    variants = [request for request in batch for _ in range(request.count)]
+    prompts = [request.prompt for request in variants]
+    negative_prompts = [request.negative_prompt for request in variants]
+    seeds = [seed for request in batch for seed in request.variant_seeds()]
+    step_times = {}
+    step_callback = make_step_callback(batch, step_times)
+    print(f"Running batch of {len(batch)} '{mode}' request(s), {len(variants)} image(s).")
+    start = time.perf_counter()
+
+    with inference_autocast(): # bf16 on capable CPUs (see utils/cpu_profile.py)
+        if mode == "text":
+            images = generate_text_emoji_batch(
+                pipe=pipe,
+                prompts=prompts,
+                negative_prompts=negative_prompts,
+                num_inference_steps=first.num_inference_steps,
+                guidance_scale=first.guidance_scale,
+                seeds=seeds,
+                image_size=first.image_size,
+                callback_on_step_end=step_callback,
+                deep_cache_interval=first.deep_cache_interval
+            )
+        elif mode in ("text_style", "face_style"):
+            style_embeds = get_style_embeds(pipe, first.style_name)
+            if style_embeds is None:
+                raise GenerationError(f"Could not load style embeddings for '{first.style_name}'.")
+
+            if mode == "text_style":
+                images = generate_text_style_emoji_batch(
+                    pipe=pipe,
+                    style_embeds=style_embeds,
+                    prompts=prompts,
+                    negative_prompts=negative_prompts,
+                    style_scale=first.style_scale,
+                    num_inference_steps=first.num_inference_steps,
+                    guidance_scale=first.guidance_scale,
+                    seeds=seeds,
+                    image_size=first.image_size,
+                    callback_on_step_end=step_callback,
+                    deep_cache_interval=first.deep_cache_interval
+                )
+            else:
+                images = generate_face_style_emoji_batch(
+                    pipe=pipe,
+                    face_images=[request.face_image for request in variants],
+                    style_embeds=style_embeds,
+                    prompts=prompts,
+                    negative_prompts=negative_prompts,
+                    style_scale=first.style_scale,
+                    face_scale=first.face_scale,
+                    num_inference_steps=first.num_inference_steps,
+                    guidance_scale=first.guidance_scale,
+                    seeds=seeds,
+                    image_size=first.image_size,
+                    callback_on_step_end=step_callback,
+                    face_hashes=[request.face_hash for request in variants],
+                    face_embeds=[request.face_embeds for request in variants],
+                    deep_cache_interval=first.deep_cache_interval
+                )
+        else:
+            raise GenerationError(f"Invalid mode specified: {mode}")
+
+    if images is None:
+        raise GenerationError("Failed to generate image. Check server logs for details.")
+
+    finished_at = time.perf_counter()
+    generation_seconds = finished_at - start
+    observe_stage("generation", generation_seconds)
+    GENERATED_IMAGES.inc(len(images), mode=mode)
+    # Everything after the last denoising step is the VAE decode (plus conversion to PIL)
+    vae_decode_seconds = finished_at - step_times["last_step_end"] if step_times.get("last_step_end") else None
+    if vae_decode_seconds is not None:
+        observe_stage("vae_decode", vae_decode_seconds)
+    log_event(
+        "batch_finished", request_ids=[request.request_id for request in batch], mode=mode,
+        images=len(variants), generation_seconds=round(generation_seconds, 4),
+        vae_decode_seconds=round(vae_decode_seconds, 4) if vae_decode_seconds is not None else None,
+        deep_cache_interval=first.deep_cache_interval if first.deep_cache_interval > 1 else None,
+    )
+    grouped, offset = [], 0
+    for request in batch:
+        request.timings["generation_seconds"] = generation_seconds
+        if vae_decode_seconds is not None:
+            request.timings["vae_decode_seconds"] = vae_decode_seconds
+        request.timings["batch_size"] = len(variants)
+        grouped.append(images[offset:offset + request.count])
+        offset += request.count
+    return grouped
+
+
+# Shared scheduler used by the Flask app
+scheduler = BatchScheduler()
+
+# Where submit_generation sends requests: the in-process scheduler, or a worker pool
+# (see utils/worker_pool.py). Backends provide submit(request) -> Future and queue_depth().
+generation_backend = scheduler
+
+def set_generation_backend(backend):
+    global generation_backend
+    generation_backend = backend
+
+def submit_generation(request: GenerationRequest) -> Future:
+    """Submits a request to the generation backend (the shared scheduler by default)."""
+    return generation_backend.submit(request)
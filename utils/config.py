@@ -1,20 +1,27 @@
-import torch
 import os
+import threading
 from dotenv import load_dotenv
 
 load_dotenv()
 
 
-DEFAULT_DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
-DEVICE = torch.device(os.getenv("APP_DEVICE", DEFAULT_DEVICE)) 
+# Device-dependent settings (DEVICE, TORCH_DTYPE and the defaults registered in
+# _LAZY_SETTINGS) are resolved on first access by the module __getattr__ at the end of
+# this file, so importing the config does not import torch.
+_LAZY_SETTINGS = {} # name -> function(device) -> value
 
-if DEVICE.type == 'cuda':
-    TORCH_DTYPE = torch.float16
-else:
-    TORCH_DTYPE = torch.float32 
+def _resolve_device():
+    import torch
+    default_device = "cuda" if torch.cuda.is_available() else "cpu"
+    device = torch.device(os.getenv("APP_DEVICE", default_device))
+    torch_dtype = torch.float16 if device.type == 'cuda' else torch.float32
+    print(f"Using device: {device}")
+    print(f"Using dtype: {torch_dtype}")
+    return device, torch_dtype
 
-print(f"Using device: {DEVICE}")
-print(f"Using dtype: {TORCH_DTYPE}")
+# Device memory budget for resident model components (0 = unlimited).
+# Least-recently-used components are offloaded to CPU only when it would be exceeded.
+DEVICE_MEMORY_BUDGET_MB = int(os.getenv("DEVICE_MEMORY_BUDGET_MB", "0"))
 
 
 # --- Model IDs ---
@@ -32,6 +39,11 @@ ADAPTER_WEIGHT_FACE = "ip-adapter-plus-face_sdxl_vit-h.safetensors"
 DEFAULT_NEGATIVE_PROMPT = "multiple faces"
 DEFAULT_STYLE_NEGATIVE_PROMPT = "photoreal"
 DEFAULT_TEXT_NEGATIVE_PROMPT = "background, multiple images"
+# Appended to the prompt in text mode
+TEXT_EMOJI_PROMPT_SUFFIX = (
+    "Apple Emoji Style, Plain Matte White background, centered, minimal, no text, "
+    "no watermark, no border, high contrast, simple, clean, isolated, icon, 3D, soft shadow"
+)
 DEFAULT_STEPS = 50 # Balance speed/quality
 DEFAULT_GUIDANCE_SCALE = 5.0
 DEFAULT_STYLE_SCALE = 0.4
@@ -45,4 +57,203 @@ STYLE_LIBRARIES = {
     "claymation": "static/styles/claymation",
     "sticker_art": "static/styles/sticker_art",
 }
-NUM_STYLE_IMAGES_PER_LIBRARY = 10
\ No newline at end of file
+NUM_STYLE_IMAGES_PER_LIBRARY = 10
+
+# --- Style Embedding Store ---
+# Precomputed IP-Adapter image embeddings are persisted next to each style library
+# as "<style_dir>/.ip_embeds_<adapter weight stem>.pt" (see utils/style_embeddings.py).
+STYLE_EMBEDS_FILENAME = ".ip_embeds_{adapter}.pt"
+STYLE_EMBEDS_ADAPTER_WEIGHTS = [ADAPTER_WEIGHT_PLUS] # Style libraries only feed the Plus adapter
+
+# --- Style Library Manifests ---
+# datasetgen.py records every generated image (file, sha256, prompt, seed, model, parameters)
+# in "<style_dir>/manifest.json". When present it sets the library's image order and supplies
+# the file hashes the style caches key off (see utils/style_manifest.py).
+STYLE_LIBRARY_MANIFEST = "manifest.json"
+
+# --- Packed Style Libraries ---
+# `python pack_styles.py` stores each library as one uint8 array of images already resized
+# and center-cropped to the image encoder's input size, memory-mapped by the loader.
+STYLE_PACK_FILENAME = ".style_pack_{size}.npy"
+STYLE_PACK_MANIFEST = ".style_pack_{size}.json"
+STYLE_PACK_SIZE = 224 # CLIP ViT-H/14 crop size
+
+# --- Face Uploads ---
+# Uploads are bounded, decoded at reduced resolution and normalized before encoding.
+# Plus-Face image embeddings are cached by a hash of the normalized face.
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_MB", "10")) * 2**20
+MAX_UPLOAD_PIXELS = int(os.getenv("MAX_UPLOAD_MEGAPIXELS", "50")) * 10**6
+FACE_DECODE_SIZE = 512 # Short side decoded for face detection
+FACE_IMAGE_SIZE = 224  # Short side of the normalized face (the CLIP encoder's input size)
+FACE_CROP = os.getenv("FACE_CROP", "1") == "1" # Crop around the largest face (needs opencv-python)
+FACE_CROP_MARGIN = 0.6 # Context kept around the face box, as a fraction of its size
+FACE_EMBED_CACHE_MB = int(os.getenv("FACE_EMBED_CACHE_MB", "128"))
+
+# --- Micro-Batching Scheduler ---
+# Concurrent compatible requests (same mode, style, steps, guidance and adapter scales)
+# arriving within the window are run as one batched pipeline call.
+BATCH_WINDOW_MS = int(os.getenv("BATCH_WINDOW_MS", "50"))
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "4")) # Images per call (a request with count > 1 adds count images)
+MAX_VARIANTS = int(os.getenv("MAX_VARIANTS", "8")) # Max `count` per request (a request is never split across batches)
+
+# --- Admission Control ---
+# Requests that need generation are admitted up to a depth per mode (queued + running) and
+# a number per client; beyond that they get 429 with a Retry-After estimated from the measured
+# completion rate. 0 disables a limit. Per-mode depths: ADMISSION_QUEUE_DEPTH_<MODE>.
+ADMISSION_QUEUE_DEPTH = {
+    mode: int(os.getenv(f"ADMISSION_QUEUE_DEPTH_{mode.upper()}", os.getenv("ADMISSION_QUEUE_DEPTH", "16")))
+    for mode in ("text", "text_style", "face_style")
+}
+MAX_REQUESTS_PER_CLIENT = int(os.getenv("MAX_REQUESTS_PER_CLIENT", "4"))
+RETRY_AFTER_DEFAULT_SECONDS = 10 # Until completions have been measured
+RETRY_AFTER_MAX_SECONDS = 120
+# Generation is abandoned (denoising interrupted at the next step) once the deadline passes,
+# or when a blocking client disconnects. Clients may ask for a shorter `deadline` (seconds).
+REQUEST_DEADLINE_SECONDS = float(os.getenv("REQUEST_DEADLINE_SECONDS", "300")) # 0 = no deadline
+DISCONNECT_POLL_SECONDS = 0.5
+
+# --- Worker Processes ---
+# Empty: generation runs on this process's scheduler thread. Otherwise ";"-separated
+# "modes@device" specs, one spawned worker process each (own models and batch scheduler), e.g.
+# "text@cuda:0;text_style,face_style@cuda:1" or "text,text_style,face_style@cpu;text@cpu".
+# Requests go to the least-loaded ready worker serving their mode; crashed workers are restarted.
+WORKERS = os.getenv("WORKERS", "")
+WORKER_AFFINITY_PENALTY = int(os.getenv("WORKER_AFFINITY_PENALTY", "2")) # Extra queued images worth avoiding a mode switch
+WORKER_RESTART_DELAY_SECONDS = float(os.getenv("WORKER_RESTART_DELAY_SECONDS", "2"))
+WORKER_HEALTH_INTERVAL_SECONDS = 1.0
+
+# --- Bulk Generation (bulk_generate.py) ---
+# Requests submitted ahead of the finished ones, so batches stay full while earlier results
+# are matted and encoded
+BULK_MAX_IN_FLIGHT = int(os.getenv("BULK_MAX_IN_FLIGHT", str(3 * MAX_BATCH_SIZE)))
+BULK_POSTPROCESS_WORKERS = int(os.getenv("BULK_POSTPROCESS_WORKERS", "4")) # Background removal + encoding
+BULK_SHARD_CHARS = 2 # Output files are sharded by the first hex characters of sha256(id)
+BULK_PROGRESS_INTERVAL_SECONDS = float(os.getenv("BULK_PROGRESS_INTERVAL_SECONDS", "10"))
+
+# --- Asynchronous Jobs ---
+JOB_TTL_SECONDS = int(os.getenv("JOB_TTL_SECONDS", "600")) # Finished jobs are kept this long
+JOB_POSTPROCESS_WORKERS = int(os.getenv("JOB_POSTPROCESS_WORKERS", "2")) # Background removal + encoding
+SSE_HEARTBEAT_SECONDS = 15
+
+# --- Live Latent Previews ---
+# Every N denoising steps a small RGB thumbnail is projected straight from the latents
+# (no VAE decode) and pushed to the job's event stream. 0 disables previews.
+PREVIEW_INTERVAL_STEPS = int(os.getenv("PREVIEW_INTERVAL_STEPS", "5"))
+PREVIEW_SIZE = int(os.getenv("PREVIEW_SIZE", "128")) # px, longest side
+
+# --- UNet Feature Caching (DeepCache) ---
+# Opt-in acceleration: with an interval N > 1 the UNet runs in full on one step in N, and the
+# steps in between reuse the cached deep-block features, recomputing only the outermost
+# DEEP_CACHE_DEPTH down/up blocks. Requests may set `deep_cache` (the interval); this is the default.
+DEEP_CACHE_INTERVAL = int(os.getenv("DEEP_CACHE_INTERVAL", "0")) # 0 or 1 = off
+DEEP_CACHE_MAX_INTERVAL = 10
+DEEP_CACHE_DEPTH = int(os.getenv("DEEP_CACHE_DEPTH", "1")) # Shallow blocks recomputed on cached steps (1 = fastest)
+# "uniform": full steps evenly spaced; "quadratic": the same number of full steps, denser
+# early in denoising where the layout forms
+DEEP_CACHE_SCHEDULE = os.getenv("DEEP_CACHE_SCHEDULE", "uniform")
+
+# --- Prompt Embedding Cache ---
+# Text-encoder outputs keyed by (text, encoder). The default negative prompts are pinned.
+PROMPT_CACHE_MAX_MB = int(os.getenv("PROMPT_CACHE_MAX_MB", "256"))
+
+# --- Result Cache ---
+# Final (background-removed) PNGs keyed by a hash of everything that determines the output.
+# Entries evicted from memory spill to RESULT_CACHE_DIR, which is bounded separately.
+RESULT_CACHE_MEMORY_MB = int(os.getenv("RESULT_CACHE_MEMORY_MB", "64"))
+RESULT_CACHE_DISK_MB = int(os.getenv("RESULT_CACHE_DISK_MB", "512")) # 0 disables the disk tier
+RESULT_CACHE_DIR = os.getenv("RESULT_CACHE_DIR", "cache/results")
+
+# --- Background Removal ---
+# Matting runs on its own worker pool; each worker owns one ONNX Runtime session.
+REMBG_MODEL = os.getenv("REMBG_MODEL", "u2net")
+REMBG_WORKERS = int(os.getenv("REMBG_WORKERS", "2"))
+REMBG_INTRA_OP_THREADS = int(os.getenv("REMBG_INTRA_OP_THREADS", "0")) # 0 = split the CPU cores between workers
+
+# --- Fast Matting ---
+# Plain-background outputs are cut out with a NumPy flood fill; rembg only runs when
+# the fast matte's confidence is below the threshold.
+FAST_MATTING_ENABLED = os.getenv("FAST_MATTING_ENABLED", "1") == "1"
+FAST_MATTING_MIN_CONFIDENCE = float(os.getenv("FAST_MATTING_MIN_CONFIDENCE", "0.9"))
+FAST_MATTING_TOLERANCE = float(os.getenv("FAST_MATTING_TOLERANCE", "18")) # Max channel distance (0-255) from the background colour
+
+# --- Served Images ---
+# Final images are stored by content hash and served as raw bytes from /api/images/<id>.
+IMAGE_FORMATS = {"png": "image/png", "webp": "image/webp"} # WebP is always lossless
+DEFAULT_IMAGE_FORMAT = "png"
+DEFAULT_PNG_COMPRESS_LEVEL = 6 # 0 (fastest) - 9 (smallest)
+DEFAULT_WEBP_METHOD = 4        # 0 (fastest) - 6 (smallest)
+IMAGE_STORE_MEMORY_MB = int(os.getenv("IMAGE_STORE_MEMORY_MB", "128"))
+IMAGE_STORE_DISK_MB = int(os.getenv("IMAGE_STORE_DISK_MB", "1024"))
+IMAGE_STORE_DIR = os.getenv("IMAGE_STORE_DIR", "cache/images")
+IMAGE_CACHE_MAX_AGE = 31536000 # Image ids are content hashes, so responses never change
+
+# --- Multi-Size Packs ---
+# `sizes=32,64,...` returns a ZIP (streamed from /api/images/<id>/pack.zip) or a sprite atlas
+# of premultiplied-alpha downsamples of the final image.
+PACK_MAX_SIZE = 1024
+PACK_MAX_SIZES = 8
+# Opt-in: generate below GENERATION_SIZE when only small sizes are needed. Not yet checked
+# against downsampling the full-size image, so it stays off by default.
+PACK_NATIVE_RESOLUTION = os.getenv("PACK_NATIVE_RESOLUTION", "0") == "1"
+PACK_MIN_GENERATION_SIZE = int(os.getenv("PACK_MIN_GENERATION_SIZE", "768")) # SDXL degrades quickly below this
+PACK_OVERSAMPLE = 2.0 # Generation size >= largest pack size x this
+
+# --- Quality Tiers ---
+# Each tier picks a scheduler and a step budget; schedulers are swapped per request
+# on the existing pipeline views (see utils/model_loader.py). "mode_schedulers" overrides
+# the scheduler per mode: "high" keeps each mode's original one (SDXL's default Euler for
+# text, DDIM for the IP-Adapter modes).
+QUALITY_TIERS = {
+    "draft": {"scheduler": "dpmpp_2m", "steps": int(os.getenv("DRAFT_STEPS", "16"))},
+    "standard": {"scheduler": "euler_a", "steps": int(os.getenv("STANDARD_STEPS", "30"))},
+    "high": {"scheduler": "ddim", "mode_schedulers": {"text": "euler"}, "steps": int(os.getenv("HIGH_STEPS", str(DEFAULT_STEPS)))},
+}
+_LAZY_SETTINGS["DEFAULT_QUALITY"] = lambda device: os.getenv(
+    "DEFAULT_QUALITY", "high" if device.type == "cuda" else "draft"
+)
+
+# Optional distilled few-step adapters (e.g. an LCM/TCD LoRA for SDXL). When the weights file
+# exists locally, the tier runs with the adapter, its scheduler, steps and guidance instead.
+DISTILLED_ADAPTERS = {
+    "draft": {
+        "path": os.getenv("DRAFT_LORA_PATH", "models/lcm-lora-sdxl.safetensors"),
+        "scheduler": "lcm",
+        "steps": int(os.getenv("DRAFT_LORA_STEPS", "6")),
+        "guidance_scale": 1.5, # Distilled models need little or no CFG
+    },
+}
+
+# --- CPU Execution Profile ---
+# Applied when DEVICE is the CPU (see utils/cpu_profile.py); reported at startup.
+CPU_BF16_AUTOCAST = os.getenv("CPU_BF16_AUTOCAST", "auto") # auto = use bf16 if the CPU supports it natively
+CPU_CHANNELS_LAST = os.getenv("CPU_CHANNELS_LAST", "1") == "1"
+CPU_COMPILE = os.getenv("CPU_COMPILE", "0") == "1" # torch.compile the UNet and VAE decoder
+CPU_COMPILE_CACHE_DIR = os.getenv("CPU_COMPILE_CACHE_DIR", "cache/torch_compile")
+CPU_INTRA_OP_THREADS = int(os.getenv("CPU_INTRA_OP_THREADS", "0")) # 0 = torch default
+CPU_INTER_OP_THREADS = int(os.getenv("CPU_INTER_OP_THREADS", "0"))
+CPU_QUANTIZE_TEXT_ENCODERS = os.getenv("CPU_QUANTIZE_TEXT_ENCODERS", "0") == "1" # Dynamic int8 Linear layers
+
+# Output resolution; CPU hosts generate smaller images by default
+_LAZY_SETTINGS["GENERATION_SIZE"] = lambda device: int(
+    os.getenv("GENERATION_SIZE", "1024" if device.type == "cuda" else "768")
+)
+
+# --- Startup Warm-up ---
+# Modes loaded and exercised with one tiny dummy inference on a background thread at boot;
+# /readyz reports ready once all of them are warm.
+WARMUP_MODES = [mode for mode in os.getenv("WARMUP_MODES", "text,text_style,face_style").split(",") if mode]
+WARMUP_STEPS = int(os.getenv("WARMUP_STEPS", "2"))
+
+# --- Lazy Device Settings ---
+_lazy_lock = threading.Lock()
+
+def __getattr__(name):
+    """Resolves the device and the settings derived from it on first access."""
+    if name not in ("DEVICE", "TORCH_DTYPE") and name not in _LAZY_SETTINGS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    with _lazy_lock:
+        if "DEVICE" not in globals():
+            device, torch_dtype = _resolve_device()
+            resolved = {name: resolve(device) for name, resolve in _LAZY_SETTINGS.items()}
+            globals().update(resolved, DEVICE=device, TORCH_DTYPE=torch_dtype)
+    return globals()[name]
@@ -0,0 +1,106 @@
+import os
+import contextlib
+import torch
+from utils.config import (
+    DEVICE,
+    CPU_BF16_AUTOCAST,
+    CPU_CHANNELS_LAST,
+    CPU_COMPILE,
+    CPU_COMPILE_CACHE_DIR,
+    CPU_INTRA_OP_THREADS,
+    CPU_INTER_OP_THREADS,
+    CPU_QUANTIZE_TEXT_ENCODERS,
+)
+
+
+# What was actually applied (reported at startup and by get_cpu_profile())
+cpu_profile = {}
+
+
+def cpu_supports_bf16() -> bool:
+    """True if oneDNN has native bf16 kernels on this CPU (AVX512-BF16 / AMX)."""
+    try:
+        return torch.backends.mkldnn.is_available() and torch.ops.mkldnn._is_mkldnn_bf16_supported()
+    except Exception:
+        return False
+
+def bf16_autocast_enabled() -> bool:
+    if DEVICE.type != "cpu" or CPU_BF16_AUTOCAST == "0":
+        return False
+    return CPU_BF16_AUTOCAST == "1" or cpu_supports_bf16()
+
+def inference_autocast():
+    """Context for pipeline calls: bf16 autocast on capable CPUs, otherwise a no-op."""
+    if bf16_autocast_enabled():
+        return torch.autocast("cpu", dtype=torch.bfloat16)
+    return contextlib.nullcontext()
+
+def configure_cpu_threads():
+    """Applies the configured intra/inter-op thread counts (inter-op only works before any parallel work)."""
+    if CPU_INTRA_OP_THREADS > 0:
+        torch.set_num_threads(CPU_INTRA_OP_THREADS)
+    if CPU_INTER_OP_THREADS > 0:
+        try:
+            torch.set_num_interop_threads(CPU_INTER_OP_THREADS)
+        except RuntimeError as e:
+            print(f"Warning: Could not set inter-op threads: {e}")
+
+def _quantize_text_encoders(pipe) -> list[str]:
+    quantized = []
+    for name in ("text_encoder", "text_encoder_2"):
+        text_encoder = getattr(pipe, name, None)
+        if text_encoder is None:
+            continue
+        # In place, so the pipeline views and the residency manager keep the same module
+        torch.ao.quantization.quantize_dynamic(text_encoder, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+        quantized.append(name)
+    return quantized
+
+def _compile_modules(pipe) -> list[str]:
+    os.makedirs(CPU_COMPILE_CACHE_DIR, exist_ok=True)
+    os.environ["TORCHINDUCTOR_CACHE_DIR"] = os.path.abspath(CPU_COMPILE_CACHE_DIR) # Read lazily by inductor
+    torch._inductor.config.fx_graph_cache = True # Reuse compiled graphs across restarts
+    # Module.compile() compiles in place: IP-Adapter processor swaps and views keep working
+    # (a swap only triggers a guarded recompile of the affected graph).
+    pipe.unet.compile()
+    pipe.vae.decoder.compile()
+    return ["unet", "vae.decoder"]
+
+def apply_cpu_profile(pipe) -> dict:
+    """Applies the configured CPU optimizations to the shared backbone and reports them."""
+    if DEVICE.type != "cpu":
+        return cpu_profile
+
+    configure_cpu_threads()
+    cpu_profile.update({
+        "intra_op_threads": torch.get_num_threads(),
+        "inter_op_threads": torch.get_num_interop_threads(),
+        "bf16_supported": cpu_supports_bf16(),
+        "bf16_autocast": bf16_autocast_enabled(),
+        "channels_last": False,
+        "compiled": [],
+        "quantized": [],
+    })
+
+    if CPU_CHANNELS_LAST:
+        pipe.unet.to(memory_format=torch.channels_last)
+        pipe.vae.to(memory_format=torch.channels_last)
+        cpu_profile["channels_last"] = True
+
+    if CPU_QUANTIZE_TEXT_ENCODERS:
+        try:
+            cpu_profile["quantized"] = _quantize_text_encoders(pipe)
+        except Exception as e:
+            print(f"Warning: Text encoder quantization failed: {e}")
+
+    if CPU_COMPILE:
+        try:
+            cpu_profile["compiled"] = _compile_modules(pipe)
+        except Exception as e:
+            print(f"Warning: torch.compile unavailable, running eagerly: {e}")
+
+    print("CPU profile: " + ", ".join(f"{k}={v}" for k, v in cpu_profile.items()))
+    return cpu_profile
+
+def get_cpu_profile() -> dict:
+    return dict(cpu_profile)
@@ -0,0 +1,134 @@
+import math
+from contextlib import contextmanager
+from utils.config import DEEP_CACHE_DEPTH, DEEP_CACHE_SCHEDULE
+
+SCHEDULES = ("uniform", "quadratic")
+
+
+def full_compute_steps(total_steps: int, interval: int, schedule: str = DEEP_CACHE_SCHEDULE) -> set[int]:
+    """UNet calls (0-based) that run the full network; the first one always does."""
+    if interval <= 1 or total_steps <= 1:
+        return set(range(total_steps))
+    if schedule == "quadratic":
+        # Same number of full steps as "uniform", at total * (k / n)^2 (kept distinct)
+        count = math.ceil(total_steps / interval)
+        steps, step = set(), -1
+        for k in range(count):
+            step = min(total_steps - 1, max(step + 1, round(total_steps * (k / count) ** 2)))
+            steps.add(step)
+        return steps
+    return set(range(0, total_steps, interval))
+
+
+class UNetFeatureCache:
+    """Reuses the deep UNet blocks' outputs between full-compute steps (DeepCache).
+
+    The forwards of every block below the outermost `depth` down/up blocks (and the mid block)
+    are wrapped once: on a full step they run and store their outputs, on a cached step they
+    return the stored outputs, so only conv_in, the shallow blocks and conv_out are computed.
+    The UNet forward itself is untouched, so skip connections keep lining up.
+    Inactive outside of a `deep_cache` context.
+    """
+
+    def __init__(self, unet):
+        self.unet = unet
+        self.active = False
+        self.skip = False
+        self.depth = None
+        self.outputs = {}
+        self.full_steps = set()
+        self.calls = 0
+        self.full_calls = 0
+        self._total_steps = None
+        self._interval, self._schedule = 1, "uniform"
+        self._skipped = set()
+        self._wrapped = {}
+        unet.register_forward_pre_hook(self._on_unet_call)
+
+    def _wrap(self, name: str, block):
+        if name in self._wrapped:
+            return
+        original = block.forward
+
+        def forward(*args, **kwargs):
+            if self.active and name in self._skipped:
+                if self.skip and name in self.outputs:
+                    return self.outputs[name]
+                output = original(*args, **kwargs)
+                self.outputs[name] = output
+                return output
+            return original(*args, **kwargs)
+
+        block.forward = forward
+        self._wrapped[name] = original
+
+    def deep_blocks(self, depth: int) -> list[tuple[str, object]]:
+        """Blocks skipped on cached steps when the outermost `depth` down/up blocks are recomputed."""
+        down_blocks, up_blocks = self.unet.down_blocks, self.unet.up_blocks
+        blocks = [(f"down_{i}", block) for i, block in enumerate(down_blocks) if i >= depth]
+        if self.unet.mid_block is not None:
+            blocks.append(("mid", self.unet.mid_block))
+        blocks += [(f"up_{i}", block) for i, block in enumerate(up_blocks) if i < len(up_blocks) - depth]
+        return blocks
+
+    def start(self, total_steps, interval: int, depth: int, schedule: str):
+        """total_steps: UNet calls in the run, or a callable returning them at the first call."""
+        self.depth = max(1, min(depth, len(self.unet.down_blocks)))
+        blocks = self.deep_blocks(self.depth)
+        for name, block in blocks:
+            self._wrap(name, block)
+        self._skipped = {name for name, _ in blocks}
+        self._total_steps = total_steps
+        self._interval, self._schedule = interval, schedule
+        self.outputs = {}
+        self.calls = 0
+        self.full_calls = 0
+        self.active = True
+
+    def stop(self):
+        self.active = False
+        self.skip = False
+        self.outputs = {} # Drops the cached activations
+
+    def _on_unet_call(self, module, args):
+        if not self.active:
+            return
+        if self.calls == 0:
+            total_steps = self._total_steps() if callable(self._total_steps) else self._total_steps
+            self.full_steps = full_compute_steps(total_steps, self._interval, self._schedule)
+        self.skip = self.calls not in self.full_steps and bool(self.outputs)
+        if not self.skip:
+            self.outputs = {} # A changed batch shape can never pick up stale features
+            self.full_calls += 1
+        self.calls += 1
+
+
+def feature_cache_for(unet) -> UNetFeatureCache:
+    """The UNet's feature cache, created (and its blocks wrapped) on first use."""
+    cache = getattr(unet, "_emoji_feature_cache", None)
+    if cache is None:
+        cache = UNetFeatureCache(unet)
+        unet._emoji_feature_cache = cache
+    return cache
+
+@contextmanager
+def deep_cache(pipe, interval: int, depth: int = DEEP_CACHE_DEPTH, schedule: str = DEEP_CACHE_SCHEDULE):
+    """Runs the pipeline calls inside with UNet feature caching every `interval` steps (no-op for <= 1).
+
+    Not applied to a torch.compile'd UNet, whose graphs would be re-specialised on every switch.
+    """
+    unet = pipe.unet
+    if interval <= 1:
+        yield None
+        return
+    if getattr(unet, "_compiled_call_impl", None) is not None:
+        print("Warning: UNet feature caching is not supported on a compiled UNet, running uncached.")
+        yield None
+        return
+    cache = feature_cache_for(unet)
+    # The scheduler's timesteps are set by the pipeline before its first UNet call
+    cache.start(lambda: len(pipe.scheduler.timesteps), interval, depth, schedule if schedule in SCHEDULES else "uniform")
+    try:
+        yield cache
+    finally:
+        cache.stop()
@@ -0,0 +1,145 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from PIL import Image
+from utils.config import (
+    MAX_UPLOAD_PIXELS,
+    FACE_DECODE_SIZE,
+    FACE_IMAGE_SIZE,
+    FACE_CROP,
+    FACE_CROP_MARGIN,
+    FACE_EMBED_CACHE_MB,
+)
+from utils.image_utils import decode_upload, crop_to_face, resize_short_side
+from utils.metrics import timed
+# torch is only needed once faces are encoded (on the scheduler thread), so the web app
+# can import this module for upload handling without loading it.
+
+
+def _nbytes(embeds) -> int:
+    return embeds.numel() * embeds.element_size()
+
+
+class FaceEmbeddingCache:
+    """LRU cache of Plus-Face [negative, positive] image embeds keyed by normalized-face hash.
+
+    Upload hashes are recorded as aliases of the face hash, so a re-uploaded file can skip
+    decoding as well as the vision encoder.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict() # face_hash -> embeds (CPU)
+        self._aliases = {} # upload_hash -> face_hash
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, face_hash: str):
+        with self._lock:
+            embeds = self._entries.get(face_hash)
+            if embeds is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(face_hash)
+            self.hits += 1
+            return embeds
+
+    def put(self, face_hash: str, embeds):
+        with self._lock:
+            if face_hash in self._entries:
+                return
+            self._entries[face_hash] = embeds
+            self.bytes += _nbytes(embeds)
+            while self.bytes > self.max_bytes and len(self._entries) > 1:
+                old_hash, old_embeds = self._entries.popitem(last=False)
+                self.bytes -= _nbytes(old_embeds)
+                self.evictions += 1
+                self._aliases = {u: f for u, f in self._aliases.items() if f != old_hash}
+
+    def add_alias(self, upload_hash: str, face_hash: str):
+        with self._lock:
+            self._aliases[upload_hash] = face_hash
+
+    def lookup_upload(self, upload_hash: str):
+        """Returns (face_hash, embeds) for a previously seen upload, or None."""
+        with self._lock:
+            face_hash = self._aliases.get(upload_hash)
+        if face_hash is None:
+            return None
+        embeds = self.get(face_hash)
+        return (face_hash, embeds) if embeds is not None else None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._aliases.clear()
+            self.bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+            }
+
+
+face_embeds_cache = FaceEmbeddingCache(FACE_EMBED_CACHE_MB * 2**20)
+
+
+def normalize_face_upload(data: bytes) -> tuple[Image.Image, str]:
+    """Decodes an uploaded face at reduced resolution, crops it and returns (face, face_hash).
+
+    Raises ValueError for images above the pixel limit (other decode errors propagate).
+    """
+    with timed("upload_decode"):
+        image = decode_upload(data, FACE_DECODE_SIZE if FACE_CROP else FACE_IMAGE_SIZE, MAX_UPLOAD_PIXELS)
+        if FACE_CROP:
+            image = crop_to_face(image, FACE_CROP_MARGIN)
+        face = resize_short_side(image, FACE_IMAGE_SIZE)
+    hasher = hashlib.sha256(f"{face.width}x{face.height}".encode("utf-8"))
+    hasher.update(face.tobytes())
+    return face, hasher.hexdigest()
+
+def get_face_embeds(pipe, face_images: list, face_hashes: list, face_embeds: list) -> list:
+    """Returns one (2, 1, tokens, dim) embeds tensor per face, encoding only the cache misses.
+
+    face_embeds holds embeds already resolved by the caller (or None); misses are encoded
+    in one vision-encoder pass and cached under their face hash.
+    """
+    from utils.style_embeddings import encode_ip_adapter_images
+
+    resolved = list(face_embeds)
+    for index, face_hash in enumerate(face_hashes):
+        if resolved[index] is None and face_hash is not None:
+            resolved[index] = face_embeds_cache.get(face_hash)
+
+    # Misses are encoded once per distinct face (variants of one request repeat their face)
+    missing = {}
+    for index, embeds in enumerate(resolved):
+        if embeds is None:
+            face_key = face_hashes[index] if face_hashes[index] is not None else id(face_images[index])
+            missing.setdefault(face_key, []).append(index)
+    if missing:
+        first_indices = [indices[0] for indices in missing.values()]
+        if any(face_images[index] is None for index in first_indices):
+            raise ValueError("Face embeddings were evicted and no face image is available.")
+        encoded = encode_ip_adapter_images(pipe, [face_images[index] for index in first_indices]).cpu()
+        for position, indices in enumerate(missing.values()):
+            embeds = encoded[:, position:position + 1].clone() # Do not pin the whole batch
+            for index in indices:
+                resolved[index] = embeds
+            if face_hashes[indices[0]] is not None:
+                face_embeds_cache.put(face_hashes[indices[0]], embeds)
+    return resolved
+
+def get_face_cache_stats() -> dict:
+    return face_embeds_cache.stats()
@@ -1,9 +1,10 @@
 import requests
 from io import BytesIO
-from PIL import Image
-from rembg import remove as remove_bg_rembg 
+import numpy as np
+from PIL import Image, ImageOps
 import os
 import glob
+from utils.style_manifest import load_library_manifest
 
 
 
@@ -30,15 +31,172 @@ def load_image_from_path(path: str) -> Image.Image | None:
         print(f"Error loading image from path {path}: {e}")
         return None
 
-def remove_background(image: Image.Image) -> Image.Image | None:
-    """Removes the background from a PIL image using rembg."""
+def decode_upload(data: bytes, min_side: int, max_pixels: int) -> Image.Image:
+    """Decodes an uploaded image at the lowest resolution whose short side is still >= min_side.
+
+    JPEGs are decoded at 1/2, 1/4 or 1/8 scale by libjpeg (draft mode) instead of at full size.
+    Raises ValueError for images above max_pixels (checked from the header, before decoding).
+    """
+    image = Image.open(BytesIO(data))
+    width, height = image.size
+    if width * height > max_pixels:
+        raise ValueError(f"Image is too large ({width}x{height} pixels).")
+    scale = min(1.0, min_side / min(width, height))
+    image.draft("RGB", (max(1, round(width * scale)), max(1, round(height * scale))))
+    image = ImageOps.exif_transpose(image) # Phone photos are often stored rotated
+    return image.convert("RGB")
+
+def crop_to_face(image: Image.Image, margin: float = 0.6) -> Image.Image:
+    """Square crop around the largest detected face (needs opencv-python; otherwise a no-op)."""
+    try:
+        import cv2 # Optional dependency
+    except ImportError:
+        return image
+    gray = np.asarray(image.convert("L"))
+    detector = cv2.CascadeClassifier(os.path.join(cv2.data.haarcascades, "haarcascade_frontalface_default.xml"))
+    faces = detector.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=5, minSize=(32, 32))
+    if len(faces) == 0:
+        return image
+    x, y, w, h = max(faces, key=lambda face: face[2] * face[3])
+    side = min(int(max(w, h) * (1 + 2 * margin)), image.width, image.height)
+    left = min(max(0, x + w // 2 - side // 2), image.width - side)
+    top = min(max(0, y + h // 2 - side // 2), image.height - side)
+    return image.crop((left, top, left + side, top + side))
+
+def resize_short_side(image: Image.Image, size: int) -> Image.Image:
+    """Bicubic resize so the shorter side equals size (never upscales)."""
+    scale = size / min(image.size)
+    if scale >= 1:
+        return image
+    return image.resize((max(size, round(image.width * scale)), max(size, round(image.height * scale))), Image.BICUBIC)
+
+def remove_background(image: Image.Image, session=None) -> Image.Image | None:
+    """Removes the background from a PIL image using rembg (pass a session to reuse a loaded model)."""
     try:
-        
-        processed_image = remove_bg_rembg(image)
+        from rembg import remove as remove_bg_rembg # Imported on first use (onnxruntime is slow to import)
+        processed_image = remove_bg_rembg(image, session=session)
         return processed_image
     except Exception as e:
         print(f"Error during background removal: {e}")
         return None 
+
+# --- Fast Matting (plain backgrounds) ---
+
+def _propagate_along_rows(reached: np.ndarray, candidate: np.ndarray) -> np.ndarray:
+    """Marks every horizontal run of candidate pixels that contains a reached pixel."""
+    height, width = candidate.shape
+    flat = candidate.ravel()
+    run_starts = flat.copy()
+    run_starts[1:] &= ~flat[:-1]
+    run_starts[::width] = flat[::width] # Runs never continue across rows
+    run_ids = np.cumsum(run_starts) * flat # 0 = not a candidate pixel
+    hit = np.zeros(run_ids.max() + 1, dtype=bool)
+    hit[run_ids[reached.ravel() & flat]] = True
+    hit[0] = False
+    return hit[run_ids].reshape(height, width)
+
+def _flood_fill_from_border(candidate: np.ndarray, max_sweeps: int = 64) -> np.ndarray:
+    """Connected region of `candidate` reachable from the image border (4-connectivity).
+
+    Alternates row and column run propagation instead of pixel-by-pixel growth, so it
+    converges in a handful of vectorised sweeps for typical backgrounds.
+    """
+    reached = np.zeros_like(candidate)
+    reached[0, :], reached[-1, :] = candidate[0, :], candidate[-1, :]
+    reached[:, 0], reached[:, -1] = candidate[:, 0], candidate[:, -1]
+    count = -1
+    for _ in range(max_sweeps):
+        reached = _propagate_along_rows(reached, candidate)
+        reached = _propagate_along_rows(reached.T, candidate.T).T
+        new_count = int(reached.sum())
+        if new_count == count:
+            break
+        count = new_count
+    return reached
+
+def _dilate(mask: np.ndarray, iterations: int) -> np.ndarray:
+    dilated = mask.copy()
+    for _ in range(iterations):
+        grown = dilated.copy()
+        grown[1:, :] |= dilated[:-1, :]
+        grown[:-1, :] |= dilated[1:, :]
+        grown[:, 1:] |= dilated[:, :-1]
+        grown[:, :-1] |= dilated[:, 1:]
+        dilated = grown
+    return dilated
+
+def fast_matte(
+    image: Image.Image,
+    tolerance: float = 18.0,
+    edge_softness: float = 40.0,
+    edge_width: int = 2,
+) -> tuple[Image.Image, float]:
+    """Cuts out a subject on a near-uniform background without a neural model.
+
+    The background colour is the median border pixel; pixels within `tolerance` of it that are
+    connected to the border become transparent. A band of `edge_width` px around the background
+    gets soft alpha from the colour distance, with the background colour un-mixed from it.
+    Returns (RGBA image, confidence in [0, 1]).
+    """
+    rgb = np.asarray(image.convert("RGB"))
+    height, width, _ = rgb.shape
+    border = np.concatenate([rgb[0], rgb[-1], rgb[:, 0], rgb[:, -1]])
+    background_color = np.median(border, axis=0)
+
+    # Per-pixel Chebyshev distance to the background colour (channel-wise maximum is cheaper than .max(axis=2))
+    channel_distance = np.abs(rgb.astype(np.int16) - background_color.round().astype(np.int16))
+    distance = np.maximum(np.maximum(channel_distance[..., 0], channel_distance[..., 1]), channel_distance[..., 2])
+    background = _flood_fill_from_border(distance <= tolerance)
+
+    alpha = np.full((height, width), 255, dtype=np.uint8)
+    alpha[background] = 0
+    edge = _dilate(background, edge_width) & ~background
+    edge_alpha = np.clip((distance[edge] - tolerance) / edge_softness, 0.0, 1.0)
+    alpha[edge] = (edge_alpha * 255.0).round().astype(np.uint8)
+
+    # Un-mix the background from semi-transparent edge pixels: C = a*F + (1-a)*B
+    rgba = np.dstack([rgb, alpha])
+    edge_alpha = np.maximum(edge_alpha, 1e-3)[:, None]
+    edge_rgb = (rgb[edge] - (1.0 - edge_alpha) * background_color) / edge_alpha
+    rgba[edge, :3] = np.clip(edge_rgb, 0, 255).round().astype(np.uint8)
+
+    # Confidence: the border should be background and the subject a plausible share of the frame
+    border_mask = np.concatenate([background[0], background[-1], background[:, 0], background[:, -1]])
+    border_score = float(border_mask.mean())
+    foreground_fraction = float((alpha > 127).mean())
+    if foreground_fraction < 0.02 or foreground_fraction > 0.9:
+        area_score = 0.0
+    else:
+        area_score = min(1.0, foreground_fraction / 0.05, (0.9 - foreground_fraction) / 0.1)
+    confidence = border_score * area_score
+    return Image.fromarray(rgba, mode="RGBA"), confidence
+
+def encode_image(image: Image.Image, image_format: str = "png", effort: int | None = None) -> bytes:
+    """Encodes an image losslessly as PNG (effort = compress_level 0-9) or WebP (effort = method 0-6)."""
+    buffered = BytesIO()
+    if image_format == "webp":
+        image.save(buffered, format="WEBP", lossless=True, method=4 if effort is None else effort)
+    else:
+        image.save(buffered, format="PNG", compress_level=6 if effort is None else effort)
+    return buffered.getvalue()
+
+def list_style_image_files(style_dir: str) -> list[str]:
+    """Lists the image files of a style library in a stable order.
+
+    Libraries with a manifest (see datasetgen.py) follow its order (1.png, 2.png, ..., 10.png);
+    other files come after, sorted.
+    """
+    image_files = []
+    for ext in ["*.png", "*.jpg", "*.jpeg", "*.webp"]:
+        image_files.extend(glob.glob(os.path.join(style_dir, ext)))
+
+    image_files.sort() # Ensure consistent order (also keeps embedding hashes stable)
+    manifest = load_library_manifest(style_dir)
+    if manifest is not None:
+        position = {entry["file"]: index for index, entry in enumerate(manifest.get("images", []))}
+        image_files.sort(key=lambda path: position.get(os.path.basename(path), len(position)))
+    return image_files
+
 def load_style_images(style_dir: str, num_images: int = 10) -> list[Image.Image]:
     """Loads up to num_images from a directory."""
     images = []
@@ -46,12 +204,7 @@ def load_style_images(style_dir: str, num_images: int = 10) -> list[Image.Image]
         print(f"Error: Style directory not found: {style_dir}")
         return images
 
-   
-    image_files = []
-    for ext in ["*.png", "*.jpg", "*.jpeg", "*.webp"]:
-        image_files.extend(glob.glob(os.path.join(style_dir, ext)))
-
-    image_files.sort() # Optional: ensure consistent order
+    image_files = list_style_image_files(style_dir)
 
     count = 0
     for file_path in image_files:
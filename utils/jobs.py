@@ -0,0 +1,96 @@
+import time
+import uuid
+import threading
+from utils.config import JOB_TTL_SECONDS
+
+
+class Job:
+    """State of one asynchronous generation; `version` increases on every update."""
+
+    def __init__(self):
+        self.id = uuid.uuid4().hex
+        self.status = "queued" # queued -> running -> done | error | cancelled
+        self.step = 0
+        self.total_steps = None
+        self.preview = None      # Latest latent preview (data URL) and the step it was taken at
+        self.preview_step = None
+        self.cancel_hook = None  # Called when the client aborts the job
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.updated_at = self.created_at
+        self.version = 0
+
+    def to_dict(self) -> dict:
+        data = {
+            "job_id": self.id,
+            "status": self.status,
+            "step": self.step,
+            "total_steps": self.total_steps,
+            "preview_step": self.preview_step,
+        }
+        if self.result is not None:
+            data.update(self.result)
+        if self.error is not None:
+            data["error"] = self.error
+        return data
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("done", "error", "cancelled")
+
+
+class JobStore:
+    """In-memory job registry with change notification for progress streaming."""
+
+    def __init__(self, ttl_seconds: int = JOB_TTL_SECONDS):
+        self.ttl_seconds = ttl_seconds
+        self._jobs = {}
+        self._changed = threading.Condition()
+
+    def create(self) -> Job:
+        job = Job()
+        with self._changed:
+            self._prune()
+            self._jobs[job.id] = job
+        return job
+
+    def get(self, job_id: str) -> Job | None:
+        with self._changed:
+            return self._jobs.get(job_id)
+
+    def discard(self, job_id: str):
+        """Removes a job that never started (e.g. rejected by admission control)."""
+        with self._changed:
+            self._jobs.pop(job_id, None)
+            self._changed.notify_all()
+
+    def update(self, job_id: str, **fields):
+        """Updates job attributes and wakes up any event streams waiting on it."""
+        with self._changed:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return
+            for name, value in fields.items():
+                setattr(job, name, value)
+            job.updated_at = time.time()
+            job.version += 1
+            self._changed.notify_all()
+
+    def wait_for_change(self, job_id: str, seen_version: int, timeout: float) -> Job | None:
+        """Blocks until the job's version moves past `seen_version` (or the timeout expires)."""
+        with self._changed:
+            self._changed.wait_for(
+                lambda: job_id not in self._jobs or self._jobs[job_id].version != seen_version,
+                timeout=timeout,
+            )
+            return self._jobs.get(job_id)
+
+    def _prune(self):
+        """Drops finished jobs older than the TTL (called with the lock held)."""
+        cutoff = time.time() - self.ttl_seconds
+        for job_id in [j.id for j in self._jobs.values() if j.finished and j.updated_at < cutoff]:
+            del self._jobs[job_id]
+
+
+job_store = JobStore()
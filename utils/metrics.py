@@ -0,0 +1,238 @@
+import sys
+import json
+import time
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+# Self-contained Prometheus text-format metrics (no client library needed) and structured
+# JSON logging. Importing this module is cheap; runtime gauges are read from modules that
+# are already loaded, so scraping /metrics never imports torch.
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+def _format_labels(label_names: tuple, label_values: tuple, extra: str = "") -> str:
+    parts = [f'{name}="{str(value)}"' for name, value in zip(label_names, label_values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Metric:
+    """A counter or gauge with optional labels."""
+
+    def __init__(self, name: str, help_text: str, metric_type: str, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.metric_type = metric_type
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels.get(name, "") for name in self.label_names)
+
+    def inc(self, amount: float = 1.0, **labels):
+        with self._lock:
+            key = self._key(labels)
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def set(self, value: float, **labels):
+        """Sets a gauge (or mirrors a total kept elsewhere, e.g. a cache's hit counter)."""
+        with self._lock:
+            self._values[self._key(labels)] = float(value)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.metric_type}"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    """Cumulative-bucket histogram with optional labels."""
+
+    def __init__(self, name: str, help_text: str, label_names=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {} # label values -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels.get(name, "") for name in self.label_names)
+        with self._lock:
+            series = self._series.setdefault(key, [0] * len(self.buckets) + [0.0, 0])
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def totals(self) -> dict:
+        """{label values: (sum, count)} for every series."""
+        with self._lock:
+            return {key: (series[-2], series[-1]) for key, series in self._series.items()}
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, series in sorted(self._series.items()):
+                for bound, count in zip(self.buckets, series):
+                    labels = _format_labels(self.label_names, key, 'le="%g"' % bound)
+                    lines.append(f"{self.name}_bucket{labels} {count}")
+                labels = _format_labels(self.label_names, key, 'le="+Inf"')
+                lines.append(f"{self.name}_bucket{labels} {series[-1]}")
+                lines.append(f"{self.name}_sum{_format_labels(self.label_names, key)} {_format_value(series[-2])}")
+                lines.append(f"{self.name}_count{_format_labels(self.label_names, key)} {series[-1]}")
+        return lines
+
+
+class MetricsRegistry:
+    """Holds every metric and renders them in the Prometheus text exposition format."""
+
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name: str, help_text: str, label_names=()) -> Metric:
+        metric = Metric(name, help_text, "counter", label_names)
+        self._metrics.append(metric)
+        return metric
+
+    def gauge(self, name: str, help_text: str, label_names=()) -> Metric:
+        metric = Metric(name, help_text, "gauge", label_names)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, help_text: str, label_names=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        metric = Histogram(name, help_text, label_names, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+
+# --- Stage Timings ---
+# Stages: parse, upload_decode, queue_wait, model_load, device_transfer, prompt_encode,
+# ip_image_encode, denoise_step, vae_decode, generation, background_removal_wait,
+# background_removal, output_encode
+STAGE_SECONDS = metrics.histogram("emoji_stage_seconds", "Latency of each request stage.", ["stage"])
+HTTP_REQUESTS = metrics.counter("emoji_http_requests_total", "HTTP requests by endpoint and status.", ["endpoint", "status"])
+HTTP_SECONDS = metrics.histogram("emoji_http_request_seconds", "HTTP request latency (until the response is returned).", ["endpoint"])
+GENERATED_IMAGES = metrics.counter("emoji_generated_images_total", "Images produced by the pipeline.", ["mode"])
+ADMISSION_REJECTED = metrics.counter("emoji_admission_rejected_total", "Requests rejected with 429.", ["mode", "reason"])
+REQUESTS_ABANDONED = metrics.counter("emoji_requests_abandoned_total", "Generations given up on before finishing.", ["reason"])
+
+# --- Runtime Gauges (refreshed on scrape) ---
+CACHE_HITS = metrics.counter("emoji_cache_hits_total", "Cache hits.", ["cache"])
+CACHE_MISSES = metrics.counter("emoji_cache_misses_total", "Cache misses.", ["cache"])
+CACHE_EVICTIONS = metrics.counter("emoji_cache_evictions_total", "Cache evictions.", ["cache"])
+CACHE_BYTES = metrics.gauge("emoji_cache_bytes", "Bytes held in memory by each cache.", ["cache"])
+ADMITTED_REQUESTS = metrics.gauge("emoji_admitted_requests", "Requests admitted and not finished, per mode.", ["mode"])
+QUEUE_DEPTH = metrics.gauge("emoji_queue_depth", "Requests waiting for the batch scheduler (or in flight on worker processes).")
+DEVICE_TRANSFERS = metrics.counter("emoji_device_transfers_total", "Model component moves between devices.")
+DEVICE_EVICTIONS = metrics.counter("emoji_device_evictions_total", "Model components offloaded from the compute device.")
+DEVICE_RESIDENT_BYTES = metrics.gauge("emoji_device_resident_bytes", "Model bytes resident on the compute device.")
+GPU_MEMORY_PEAK = metrics.gauge("emoji_gpu_memory_max_allocated_bytes", "High-water mark of allocated GPU memory.")
+WORKER_PROCESSES = metrics.gauge("emoji_worker_processes", "Generation worker processes by state.", ["state"])
+WORKER_RESTARTS = metrics.counter("emoji_worker_restarts_total", "Generation worker processes restarted after exiting.")
+
+# Called as observer(stage, seconds) on every stage observation; worker processes use this
+# to forward their timings to the front end's registry
+stage_observers = []
+
+
+def observe_stage(stage: str, seconds: float):
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    for observer in stage_observers:
+        observer(stage, seconds)
+
+@contextmanager
+def timed(stage: str):
+    """Observes the duration of the block as `stage`."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - start)
+
+def _loaded(module_name: str, attribute: str):
+    """An attribute of an already-imported module, or None while the module is missing or still initializing."""
+    return getattr(sys.modules.get(module_name), attribute, None)
+
+def refresh_runtime_metrics():
+    """Copies cache, admission, queue, worker, residency and GPU memory counters into the registry (called per scrape).
+
+    Modules imported by the background warm-up sit in sys.modules before their globals exist,
+    so every object is looked up with _loaded and skipped until it is there.
+    """
+    for cache_name, attribute in (("result", "result_cache"), ("image_store", "image_store")):
+        cache = _loaded("utils.result_cache", attribute)
+        if cache is not None:
+            stats = cache.stats()
+            CACHE_HITS.set(stats["memory_hits"] + stats["disk_hits"], cache=cache_name)
+            CACHE_MISSES.set(stats["misses"], cache=cache_name)
+            CACHE_EVICTIONS.set(stats["evictions"], cache=cache_name)
+            CACHE_BYTES.set(stats["memory_bytes"], cache=cache_name)
+    for cache_name, module_name, attribute in (
+        ("prompt_embeds", "utils.prompt_cache", "prompt_cache"),
+        ("face_embeds", "utils.face_embeddings", "face_embeds_cache"),
+    ):
+        cache = _loaded(module_name, attribute)
+        if cache is not None:
+            stats = cache.stats()
+            CACHE_HITS.set(stats["hits"], cache=cache_name)
+            CACHE_MISSES.set(stats["misses"], cache=cache_name)
+            CACHE_EVICTIONS.set(stats["evictions"], cache=cache_name)
+            CACHE_BYTES.set(stats["bytes"], cache=cache_name)
+    admission = _loaded("utils.admission", "admission")
+    if admission is not None:
+        for mode, admitted in admission.stats()["admitted"].items():
+            ADMITTED_REQUESTS.set(admitted, mode=mode)
+    generation_backend = _loaded("utils.batch_scheduler", "generation_backend")
+    if generation_backend is not None:
+        QUEUE_DEPTH.set(generation_backend.queue_depth())
+    worker_pool = _loaded("utils.worker_pool", "worker_pool")
+    if worker_pool is not None:
+        stats = worker_pool.stats()
+        for state in ("ready", "loading", "down"):
+            WORKER_PROCESSES.set(sum(1 for worker in stats["workers"] if worker["state"] == state), state=state)
+        WORKER_RESTARTS.set(stats["restarts"])
+    residency = _loaded("utils.model_loader", "residency")
+    if residency is not None:
+        stats = residency.stats()
+        DEVICE_TRANSFERS.set(stats["transfers"])
+        DEVICE_EVICTIONS.set(stats["evictions"])
+        DEVICE_RESIDENT_BYTES.set(stats["resident_bytes"])
+    torch = sys.modules.get("torch")
+    if torch is not None and torch.cuda.is_available():
+        GPU_MEMORY_PEAK.set(torch.cuda.max_memory_allocated())
+
+def render_metrics() -> str:
+    refresh_runtime_metrics()
+    return metrics.render()
+
+# --- Structured Logs ---
+
+def log_event(event: str, request_id: str | None = None, **fields):
+    """Prints one JSON log line (alongside the human-readable prints)."""
+    record = {
+        "time": datetime.now(timezone.utc).isoformat(timespec="milliseconds"),
+        "event": event,
+        "request_id": request_id,
+        **fields,
+    }
+    print(json.dumps(record, default=str), flush=True)
@@ -1,45 +1,120 @@
 import torch
 from diffusers import (
     StableDiffusionXLPipeline,
-    AutoPipelineForText2Image,
-    DDIMScheduler
+    DDIMScheduler,
+    DPMSolverMultistepScheduler,
+    EulerAncestralDiscreteScheduler,
+    EulerDiscreteScheduler,
+    LCMScheduler
 )
 from transformers import CLIPVisionModelWithProjection
 from .config import (
     DEVICE, TORCH_DTYPE, BASE_MODEL_ID,
     IMAGE_ENCODER_ID, IMAGE_ENCODER_SUBFOLDER,
     IP_ADAPTER_REPO, IP_ADAPTER_SUBFOLDER,
-    ADAPTER_WEIGHT_PLUS, ADAPTER_WEIGHT_FACE
+    ADAPTER_WEIGHT_PLUS, ADAPTER_WEIGHT_FACE,
+    DEVICE_MEMORY_BUDGET_MB,
+    DEFAULT_QUALITY, DISTILLED_ADAPTERS
 )
+from .residency import ResidencyManager
+from .cpu_profile import apply_cpu_profile
+from .quality import resolve_quality_tier
+from .prompt_cache import prompt_cache
+from .face_embeddings import face_embeds_cache
+from .metrics import timed
 import gc
 
 
+# Component registry: the SDXL backbone (UNet, VAE, text encoders, tokenizers) and the
+# CLIP image encoder are loaded exactly once and shared by every mode.
 loaded_models = {
-    "text_pipe": None,
-    "face_style_pipe": None,
-    "text_style_pipe": None,
+    "base_pipe": None,
     "image_encoder": None,
 }
 
-def move_pipeline_to_device(pipe, device):
-    if pipe is not None:
-        pipe.to(device)
-        # Only move image_encoder if it exists and is not None
-        if hasattr(pipe, "components") and "image_encoder" in pipe.components:
-            image_encoder = pipe.components["image_encoder"]
-            if image_encoder is not None:
-                image_encoder.to(device)
-
-def ensure_only_one_on_gpu(target_key):
-    """Moves all pipelines to CPU except the one specified by target_key (which is moved to GPU)."""
-    for key, pipe in loaded_models.items():
-        if pipe is not None:
-            if key == target_key:
-                move_pipeline_to_device(pipe, DEVICE)
-            else:
-                move_pipeline_to_device(pipe, "cpu")
-    if torch.cuda.is_available():
-        torch.cuda.empty_cache()
+# Snapshots of the shared UNet's attention processors / image projection per adapter config
+ip_adapter_states = {}
+active_adapter_config = None
+
+# Lightweight per-mode pipelines built over the shared components (mode -> pipeline)
+pipeline_views = {}
+
+# Which IP-Adapter configuration each mode runs with
+MODE_ADAPTER_CONFIG = {
+    "text": "none",
+    "text_style": "plus",                 # [Plus]
+    "face_style": "plus_face",            # [Plus, Plus-Face]
+}
+
+# Scheduler choices for the quality tiers: name -> (class, config overrides)
+SCHEDULERS = {
+    "ddim": (DDIMScheduler, {}),
+    "dpmpp_2m": (DPMSolverMultistepScheduler, {"algorithm_type": "dpmsolver++", "use_karras_sigmas": True}),
+    "euler_a": (EulerAncestralDiscreteScheduler, {}),
+    "euler": (EulerDiscreteScheduler, {}), # SDXL's default
+    "lcm": (LCMScheduler, {}),
+}
+
+# Scheduler instances per (mode, scheduler name), created once and swapped onto the views
+view_schedulers = {}
+
+# Distilled LoRA adapters loaded into the shared UNet (tier -> adapter name) and the active one
+distilled_adapters = {}
+active_distilled_adapter = None
+
+# Backbone components each mode needs on the compute device
+BACKBONE_COMPONENTS = ["unet", "vae", "text_encoder", "text_encoder_2", "image_encoder"]
+MODE_COMPONENTS = {
+    "text": ["unet", "vae", "text_encoder", "text_encoder_2"],
+    "text_style": BACKBONE_COMPONENTS,
+    "face_style": BACKBONE_COMPONENTS,
+}
+
+# Components are loaded on CPU and placed on DEVICE on demand
+residency = ResidencyManager(
+    DEVICE,
+    budget_bytes=DEVICE_MEMORY_BUDGET_MB * 2**20 if DEVICE_MEMORY_BUDGET_MB > 0 else None,
+)
+
+def ensure_mode_resident(mode):
+    """Places the components a mode needs on the device (no-op when already resident)."""
+    if residency.ensure(MODE_COMPONENTS[mode]):
+        print(f"Residency updated for mode '{mode}': {residency.stats()['resident']}")
+
+def get_residency_stats():
+    """Current device placement, bytes, evictions and transfer time."""
+    return residency.stats()
+
+def _capture_ip_adapter_state(unet):
+    """Snapshots the UNet's current attention processors and IP-Adapter image projection."""
+    return {
+        "attn_processors": dict(unet.attn_processors),
+        "encoder_hid_proj": unet.encoder_hid_proj,
+        "encoder_hid_dim_type": unet.config.encoder_hid_dim_type,
+    }
+
+def _apply_ip_adapter_state(unet, state):
+    """Installs a previously captured adapter configuration on the shared UNet."""
+    # Detached processors/projections don't follow unet.to(), so bring them along here
+    for processor in state["attn_processors"].values():
+        if isinstance(processor, torch.nn.Module):
+            processor.to(device=unet.device, dtype=unet.dtype)
+    if state["encoder_hid_proj"] is not None:
+        state["encoder_hid_proj"].to(device=unet.device, dtype=unet.dtype)
+
+    # The projection is swapped first: its own attention layers count towards unet.attn_processors
+    unet.encoder_hid_proj = state["encoder_hid_proj"]
+    unet.config.encoder_hid_dim_type = state["encoder_hid_dim_type"]
+    unet.set_attn_processor(dict(state["attn_processors"])) # set_attn_processor consumes the dict
+
+def activate_ip_adapter_config(adapter_config):
+    """Swaps the shared UNet to the given adapter configuration ('none', 'plus', 'plus_face')."""
+    global active_adapter_config
+    if adapter_config == active_adapter_config:
+        return
+    _apply_ip_adapter_state(loaded_models["base_pipe"].unet, ip_adapter_states[adapter_config])
+    active_adapter_config = adapter_config
+    print(f"Activated IP-Adapter configuration: {adapter_config}")
 
 def load_image_encoder():
     """Loads the CLIP Vision Image Encoder."""
@@ -50,7 +125,7 @@ def load_image_encoder():
                 IMAGE_ENCODER_ID,
                 subfolder=IMAGE_ENCODER_SUBFOLDER,
                 torch_dtype=TORCH_DTYPE,
-            ).to(DEVICE)
+            )
             loaded_models["image_encoder"] = encoder
             print("Image Encoder loaded.")
         except Exception as e:
@@ -59,127 +134,156 @@ def load_image_encoder():
             raise e
     return loaded_models["image_encoder"]
 
-def load_text_emoji_pipeline():
-    """Loads the basic SDXL pipeline for text-to-emoji."""
-    if loaded_models["text_pipe"] is None:
-        print("Loading Text-to-Emoji Pipeline (SDXL Base)...")
-        try:
-            pipe = StableDiffusionXLPipeline.from_pretrained(
-                BASE_MODEL_ID,
-                torch_dtype=TORCH_DTYPE,
-                variant="fp16" if TORCH_DTYPE == torch.float16 else None
-            ).to(DEVICE)
-            # Optional memory savings:
-            # pipe.enable_model_cpu_offload()
-            loaded_models["text_pipe"] = pipe
-            print("Text-to-Emoji Pipeline loaded.")
-        except Exception as e:
-            print(f"Error loading text pipeline: {e}")
-            raise e
-    return loaded_models["text_pipe"]
+# Optional replacement for the pretrained SDXL download (see set_backbone_factory)
+backbone_factory = None
+
+def set_backbone_factory(factory):
+    """Makes load_shared_backbone use factory() instead of the pretrained weights.
+
+    factory() returns (pipe, load_ip_adapter), where load_ip_adapter(pipe, weight_name) installs
+    IP-Adapters on the pipe's UNet like pipe.load_ip_adapter does. The benchmarks use this to
+    run everything on tiny random-weight models. Must be called before the backbone is loaded.
+    """
+    global backbone_factory
+    backbone_factory = factory
+
+def _load_pretrained_backbone():
+    """Loads the pretrained SDXL pipeline; returns (pipe, load_ip_adapter)."""
+    encoder = load_image_encoder() # Ensure encoder is loaded first
+    pipe = StableDiffusionXLPipeline.from_pretrained(
+        BASE_MODEL_ID,
+        image_encoder=encoder,
+        torch_dtype=TORCH_DTYPE,
+        variant="fp16" if TORCH_DTYPE == torch.float16 else None,
+    )
 
-def load_face_style_pipeline():
-    """Loads the pipeline with multiple IP-Adapters (Plus and Face)."""
-    if loaded_models["face_style_pipe"] is None:
-        print("Loading Multi IP-Adapter Pipeline (Face + Style)...")
-        encoder = load_image_encoder() # Ensure encoder is loaded first
-        if encoder is None: return None # Handle encoder load failure
+    def load_ip_adapter(pipe, weight_name):
+        pipe.load_ip_adapter(IP_ADAPTER_REPO, subfolder=IP_ADAPTER_SUBFOLDER, weight_name=weight_name)
 
+    return pipe, load_ip_adapter
+
+def load_shared_backbone():
+    """Loads the SDXL backbone once and prepares every IP-Adapter configuration on its UNet."""
+    global active_adapter_config
+    if loaded_models["base_pipe"] is None:
+        print("Loading shared SDXL backbone...")
         try:
-            pipe = AutoPipelineForText2Image.from_pretrained(
-                BASE_MODEL_ID,
-                image_encoder=encoder,
-                torch_dtype=TORCH_DTYPE,
-                variant="fp16" if TORCH_DTYPE == torch.float16 else None,
-            ).to(DEVICE)
-            pipe.scheduler = DDIMScheduler.from_config(pipe.scheduler.config)
+            if backbone_factory is not None:
+                pipe, load_ip_adapter = backbone_factory()
+                loaded_models["image_encoder"] = pipe.image_encoder
+            else:
+                pipe, load_ip_adapter = _load_pretrained_backbone()
+            ip_adapter_states["none"] = _capture_ip_adapter_state(pipe.unet)
+
+            print(f"Loading IP-Adapter weights: {ADAPTER_WEIGHT_PLUS}...")
+            load_ip_adapter(pipe, ADAPTER_WEIGHT_PLUS) # Only load the plus adapter
+            ip_adapter_states["plus"] = _capture_ip_adapter_state(pipe.unet)
+            _apply_ip_adapter_state(pipe.unet, ip_adapter_states["none"])
 
             adapter_weights = [ADAPTER_WEIGHT_PLUS, ADAPTER_WEIGHT_FACE]
             print(f"Loading IP-Adapter weights: {adapter_weights}...")
-            pipe.load_ip_adapter(
-                IP_ADAPTER_REPO,
-                subfolder=IP_ADAPTER_SUBFOLDER,
-                weight_name=adapter_weights
-            )
-            # Optional memory savings:
-            # pipe.enable_model_cpu_offload()
-            loaded_models["face_style_pipe"] = pipe
-            print("Multi IP-Adapter Pipeline loaded.")
+            load_ip_adapter(pipe, adapter_weights)
+            ip_adapter_states["plus_face"] = _capture_ip_adapter_state(pipe.unet)
+            _apply_ip_adapter_state(pipe.unet, ip_adapter_states["none"])
+            active_adapter_config = "none"
+
+            apply_cpu_profile(pipe) # No-op unless DEVICE is the CPU
+            for key in BACKBONE_COMPONENTS:
+                residency.register(key, getattr(pipe, key))
+
+            loaded_models["base_pipe"] = pipe
+            print("Shared SDXL backbone loaded.")
         except Exception as e:
-            print(f"Error loading face+style pipeline: {e}")
+            print(f"Error loading shared backbone: {e}")
             raise e
-    return loaded_models["face_style_pipe"]
+    return loaded_models["base_pipe"]
 
-def load_text_style_pipeline():
-    """Loads the pipeline with a single IP-Adapter (Plus) for style."""
-    if loaded_models["text_style_pipe"] is None:
-        print("Loading Single IP-Adapter Pipeline (Text + Style)...")
-        encoder = load_image_encoder() # Ensure encoder is loaded first
-        if encoder is None: return None # Handle encoder load failure
+def _build_pipeline_view(base_pipe, mode):
+    """Builds a pipeline object for a mode that reuses the backbone's modules (no weight copies)."""
+    components = dict(base_pipe.components)
+    # The scheduler is the only per-view state; it is replaced per request by the quality tier
+    components["scheduler"] = DDIMScheduler.from_config(base_pipe.scheduler.config)
+    return StableDiffusionXLPipeline(**components)
 
-        try:
-            pipe = AutoPipelineForText2Image.from_pretrained(
-                BASE_MODEL_ID,
-                image_encoder=encoder,
-                torch_dtype=TORCH_DTYPE,
-                variant="fp16" if TORCH_DTYPE == torch.float16 else None,
-            ).to(DEVICE)
-            pipe.scheduler = DDIMScheduler.from_config(pipe.scheduler.config)
+def load_pipeline_view(mode):
+    """Returns the (cached) pipeline view for a mode, loading the shared backbone if needed."""
+    if mode not in pipeline_views:
+        with timed("model_load"):
+            base_pipe = load_shared_backbone()
+            if base_pipe is None: return None
+            pipeline_views[mode] = _build_pipeline_view(base_pipe, mode)
+    return pipeline_views[mode]
 
-            print(f"Loading IP-Adapter weights: {ADAPTER_WEIGHT_PLUS}...")
-            pipe.load_ip_adapter(
-                IP_ADAPTER_REPO,
-                subfolder=IP_ADAPTER_SUBFOLDER,
-                weight_name=ADAPTER_WEIGHT_PLUS # Only load the plus adapter
-            )
-            # Optional memory savings:
-            # pipe.enable_model_cpu_offload()
-            loaded_models["text_style_pipe"] = pipe
-            print("Single IP-Adapter (Style) Pipeline loaded.")
-        except Exception as e:
-            print(f"Error loading text+style pipeline: {e}")
-            raise e
-    return loaded_models["text_style_pipe"]
-
-def get_pipeline_for_mode(mode):
-    """Returns the pipeline for the given mode, ensuring only it is on GPU."""
-    if mode == "text":
-        pipe = load_text_emoji_pipeline()
-        ensure_only_one_on_gpu("text_pipe")
-        return pipe
-    elif mode == "face_style":
-        pipe = load_face_style_pipeline()
-        ensure_only_one_on_gpu("face_style_pipe")
-        return pipe
-    elif mode == "text_style":
-        pipe = load_text_style_pipeline()
-        ensure_only_one_on_gpu("text_style_pipe")
-        return pipe
+# --- Quality Tiers ---
+
+def _get_view_scheduler(base_pipe, mode, scheduler_name):
+    key = (mode, scheduler_name)
+    if key not in view_schedulers:
+        scheduler_class, overrides = SCHEDULERS[scheduler_name]
+        view_schedulers[key] = scheduler_class.from_config(base_pipe.scheduler.config, **overrides)
+    return view_schedulers[key]
+
+def activate_distilled_adapter(adapter):
+    """Enables a distilled LoRA on the shared UNet (loading it on first use), or disables LoRA for None."""
+    global active_distilled_adapter
+    if adapter == active_distilled_adapter:
+        return
+    base_pipe = loaded_models["base_pipe"]
+    if adapter is None:
+        base_pipe.disable_lora()
     else:
+        if adapter not in distilled_adapters:
+            path = DISTILLED_ADAPTERS[adapter]["path"]
+            print(f"Loading distilled adapter '{adapter}' from {path}...")
+            # Distilled LoRAs (LCM/TCD) only touch the UNet, so cached prompt embeddings stay valid
+            base_pipe.load_lora_weights(path, adapter_name=adapter)
+            distilled_adapters[adapter] = adapter
+        base_pipe.enable_lora()
+        base_pipe.set_adapters([distilled_adapters[adapter]])
+    active_distilled_adapter = adapter
+    print(f"Active distilled adapter: {adapter}")
+
+def apply_quality_tier(pipe, mode, quality):
+    """Swaps the view's scheduler (and distilled adapter) for a tier without reloading anything."""
+    settings = resolve_quality_tier(quality, mode)
+    pipe.scheduler = _get_view_scheduler(loaded_models["base_pipe"], mode, settings["scheduler"])
+    if settings["adapter"] is not None or active_distilled_adapter is not None:
+        activate_distilled_adapter(settings["adapter"])
+
+def get_pipeline_for_mode(mode, quality=DEFAULT_QUALITY):
+    """Returns the pipeline view for the given mode with its IP-Adapter configuration and quality tier active."""
+    if mode not in MODE_ADAPTER_CONFIG:
         return None
+    pipe = load_pipeline_view(mode)
+    if pipe is None:
+        return None
+    ensure_mode_resident(mode)
+    activate_ip_adapter_config(MODE_ADAPTER_CONFIG[mode])
+    apply_quality_tier(pipe, mode, quality)
+    return pipe
 
 def get_pipelines():
-    """(Legacy) Loads all pipelines (not recommended for low VRAM)."""
-    load_text_emoji_pipeline()
-    load_face_style_pipeline()
-    load_text_style_pipeline()
-    # Return only the pipeline objects, not the encoder separately unless needed
-    return {
-        "text": loaded_models["text_pipe"],
-        "face_style": loaded_models["face_style_pipe"],
-        "text_style": loaded_models["text_style_pipe"],
-    }
+    """(Legacy) Builds the pipeline views for every mode (they share one backbone)."""
+    return {mode: load_pipeline_view(mode) for mode in MODE_ADAPTER_CONFIG}
 
 def cleanup_models():
     """Releases model memory (useful for efficient resource management)."""
-    global loaded_models
+    global loaded_models, active_adapter_config, active_distilled_adapter
     print("Cleaning up loaded models...")
-    del loaded_models["text_pipe"]
-    del loaded_models["face_style_pipe"]
-    del loaded_models["text_style_pipe"]
+    pipeline_views.clear()
+    view_schedulers.clear()
+    distilled_adapters.clear()
+    active_distilled_adapter = None
+    ip_adapter_states.clear()
+    prompt_cache.clear() # Cached embeddings belong to the released text encoders
+    face_embeds_cache.clear() # ...and these to the released image encoder
+    active_adapter_config = None
+    for key in BACKBONE_COMPONENTS:
+        residency.unregister(key)
+    del loaded_models["base_pipe"]
     del loaded_models["image_encoder"]
-    loaded_models = { k: None for k in loaded_models } # Reset dictionary
+    loaded_models = { k: None for k in ("base_pipe", "image_encoder") } # Reset dictionary
     if torch.cuda.is_available():
         torch.cuda.empty_cache()
     gc.collect()
-    print("Models cleaned up.")
\ No newline at end of file
+    print("Models cleaned up.")
@@ -0,0 +1,98 @@
+import io
+import math
+import zipfile
+from PIL import Image
+from utils.config import PACK_MAX_SIZE, PACK_MAX_SIZES, PACK_MIN_GENERATION_SIZE, PACK_OVERSAMPLE
+
+
+def parse_sizes(value: str) -> list[int]:
+    """Parses "32,64,128" into sorted unique sizes. Raises ValueError for invalid input."""
+    try:
+        sizes = sorted({int(part) for part in value.split(",") if part.strip()})
+    except ValueError:
+        raise ValueError("Sizes must be a comma-separated list of integers.")
+    if not sizes or len(sizes) > PACK_MAX_SIZES:
+        raise ValueError(f"Between 1 and {PACK_MAX_SIZES} sizes are allowed.")
+    if sizes[0] < 1 or sizes[-1] > PACK_MAX_SIZE:
+        raise ValueError(f"Sizes must be between 1 and {PACK_MAX_SIZE} px.")
+    return sizes
+
+def pack_generation_size(sizes: list[int], generation_size: int) -> int:
+    """Smallest SDXL resolution (multiple of 64) that still oversamples the largest requested size.
+
+    Denoising cost grows with the square of the resolution, so small packs are much cheaper.
+    """
+    needed = math.ceil(sizes[-1] * PACK_OVERSAMPLE / 64) * 64
+    return min(generation_size, max(PACK_MIN_GENERATION_SIZE, needed))
+
+def downsample_rgba(image: Image.Image, sizes: list[int]) -> dict[int, Image.Image]:
+    """Lanczos downsampling in premultiplied alpha (no dark fringes from transparent pixels).
+
+    Premultiplies once; each size is resized from the full-resolution master to fit a size x size box.
+    """
+    premultiplied = image.convert("RGBA").convert("RGBa")
+    results = {}
+    for size in sizes:
+        scale = size / max(image.size)
+        target = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+        if target == image.size:
+            results[size] = image.convert("RGBA")
+        else:
+            results[size] = premultiplied.resize(target, Image.LANCZOS, reducing_gap=3.0).convert("RGBA")
+    return results
+
+def build_sprite_atlas(images: dict[int, Image.Image]) -> tuple[Image.Image, dict]:
+    """Lays the sizes out left to right (largest first) on one transparent sheet.
+
+    Returns (atlas, frames) with frames = {size: {"x", "y", "width", "height"}}.
+    """
+    ordered = sorted(images.items(), reverse=True)
+    width = sum(image.width for _, image in ordered)
+    height = max(image.height for _, image in ordered)
+    atlas = Image.new("RGBA", (width, height), (0, 0, 0, 0))
+    frames, x = {}, 0
+    for size, image in ordered:
+        atlas.paste(image, (x, 0))
+        frames[str(size)] = {"x": x, "y": 0, "width": image.width, "height": image.height}
+        x += image.width
+    return atlas, frames
+
+
+class _ChunkWriter(io.RawIOBase):
+    """Write-only, unseekable sink that hands written bytes to a streaming response."""
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def stream_zip_pack(image: Image.Image, sizes: list[int], name: str = "emoji"):
+    """Yields a ZIP of `<name>_<size>.png` files chunk by chunk, one entry at a time.
+
+    Only the entry being written is held in memory; zipfile writes data descriptors when
+    the output is not seekable. PNGs are already compressed, so entries are stored.
+    """
+    sink = _ChunkWriter()
+    with zipfile.ZipFile(sink, mode="w", compression=zipfile.ZIP_STORED) as archive:
+        for size, resized in downsample_rgba(image, sizes).items():
+            buffered = io.BytesIO()
+            resized.save(buffered, format="PNG", compress_level=6)
+            archive.writestr(f"{name}_{size}.png", buffered.getvalue())
+            yield sink.drain()
+    yield sink.drain() # Central directory
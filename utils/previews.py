@@ -0,0 +1,38 @@
+import io
+import base64
+import torch
+from PIL import Image
+
+
+# Linear approximation of the SDXL VAE decoder: latent channels -> RGB.
+# Much cheaper than a VAE decode and good enough to judge composition and colours.
+SDXL_LATENT_RGB_FACTORS = [
+    #   R        G        B
+    [ 0.3651,  0.4232,  0.4341],
+    [-0.2533, -0.0042,  0.1068],
+    [ 0.1076,  0.1111, -0.0362],
+    [-0.3165, -0.2492, -0.2188],
+]
+SDXL_LATENT_RGB_BIAS = [0.1084, -0.0175, -0.0011]
+
+
+@torch.no_grad()
+def latents_to_preview(latents: torch.Tensor, size: int) -> Image.Image:
+    """Projects one (4, h, w) latent to a small RGB thumbnail."""
+    factors = torch.tensor(SDXL_LATENT_RGB_FACTORS, device=latents.device, dtype=latents.dtype)
+    bias = torch.tensor(SDXL_LATENT_RGB_BIAS, device=latents.device, dtype=latents.dtype)
+    rgb = latents.permute(1, 2, 0) @ factors + bias # (h, w, 3) roughly in [-1, 1]
+    rgb = ((rgb + 1.0) / 2.0).clamp(0, 1).mul(255).to(torch.uint8).cpu().numpy()
+
+    image = Image.fromarray(rgb)
+    if max(image.size) != size:
+        scale = size / max(image.size)
+        new_size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+        image = image.resize(new_size, Image.BILINEAR)
+    return image
+
+def preview_to_data_url(image: Image.Image) -> str:
+    """Encodes a preview thumbnail as a small JPEG data URL."""
+    buffered = io.BytesIO()
+    image.save(buffered, format="JPEG", quality=80)
+    return "data:image/jpeg;base64," + base64.b64encode(buffered.getvalue()).decode("utf-8")
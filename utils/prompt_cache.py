@@ -0,0 +1,143 @@
+import threading
+from collections import OrderedDict
+import torch
+from utils.config import (
+    DEVICE,
+    PROMPT_CACHE_MAX_MB,
+    DEFAULT_NEGATIVE_PROMPT,
+    DEFAULT_STYLE_NEGATIVE_PROMPT,
+    DEFAULT_TEXT_NEGATIVE_PROMPT,
+)
+from utils.metrics import timed
+
+
+def _nbytes(value) -> int:
+    return sum(t.numel() * t.element_size() for t in value if t is not None)
+
+
+class PromptEmbeddingCache:
+    """LRU cache of per-encoder prompt embeddings with a byte budget and hit counters.
+
+    Values are (hidden_states, pooled) tuples; pooled is None for the first SDXL text encoder.
+    Pinned texts are never evicted.
+    """
+
+    def __init__(self, max_bytes: int, pinned_texts=()):
+        self.max_bytes = max_bytes
+        self.pinned_texts = set(pinned_texts)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = value
+            self.bytes += _nbytes(value)
+            for old_key in list(self._entries.keys()):
+                if self.bytes <= self.max_bytes:
+                    break
+                if old_key[0] in self.pinned_texts or old_key == key:
+                    continue
+                self.bytes -= _nbytes(self._entries.pop(old_key))
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+            }
+
+
+prompt_cache = PromptEmbeddingCache(
+    PROMPT_CACHE_MAX_MB * 2**20,
+    pinned_texts=(DEFAULT_NEGATIVE_PROMPT, DEFAULT_STYLE_NEGATIVE_PROMPT, DEFAULT_TEXT_NEGATIVE_PROMPT),
+)
+
+@torch.no_grad()
+def _encode_texts(pipe, encoder_name: str, texts: list[str]) -> list[tuple]:
+    """Encodes texts with one SDXL text encoder the same way StableDiffusionXLPipeline.encode_prompt does."""
+    tokenizer = pipe.tokenizer if encoder_name == "text_encoder" else pipe.tokenizer_2
+    text_encoder = getattr(pipe, encoder_name)
+    text_input_ids = tokenizer(
+        texts,
+        padding="max_length",
+        max_length=tokenizer.model_max_length,
+        truncation=True,
+        return_tensors="pt",
+    ).input_ids
+    # Outside autocast: int8-quantized encoders (CPU profile) only accept float32 activations
+    with torch.autocast(device_type=text_encoder.device.type, enabled=False):
+        output = text_encoder(text_input_ids.to(text_encoder.device), output_hidden_states=True)
+    hidden_states = output.hidden_states[-2] # SDXL uses the penultimate layer
+    pooled = output[0] if output[0].ndim == 2 else None # Only the projection model has a pooled output
+    # Clone each row: a slice would keep the whole batch's storage alive behind its cache entry
+    return [
+        (hidden_states[i:i + 1].clone(), pooled[i:i + 1].clone() if pooled is not None else None)
+        for i in range(len(texts))
+    ]
+
+def _lookup(pipe, encoder_name: str, texts: list[str]) -> list[tuple]:
+    """Returns cached embeddings for each text, encoding all misses in one encoder call."""
+    results = {}
+    for text in dict.fromkeys(texts):
+        cached = prompt_cache.get((text, encoder_name))
+        if cached is not None:
+            results[text] = cached
+    missing = [text for text in dict.fromkeys(texts) if text not in results]
+    if missing:
+        for text, value in zip(missing, _encode_texts(pipe, encoder_name, missing)):
+            prompt_cache.put((text, encoder_name), value)
+            results[text] = value
+    return [results[text] for text in texts]
+
+def _encode_batch(pipe, texts: list[str]) -> tuple[torch.Tensor, torch.Tensor]:
+    first = _lookup(pipe, "text_encoder", texts)
+    second = _lookup(pipe, "text_encoder_2", texts)
+    prompt_embeds = torch.cat([torch.cat([a[0], b[0]], dim=-1) for a, b in zip(first, second)])
+    pooled_prompt_embeds = torch.cat([b[1] for b in second])
+    dtype = pipe.text_encoder_2.dtype
+    return prompt_embeds.to(device=DEVICE, dtype=dtype), pooled_prompt_embeds.to(device=DEVICE, dtype=dtype)
+
+def encode_prompts_cached(pipe, prompts: list[str], negative_prompts: list[str], guidance_scale: float) -> dict:
+    """Returns prompt/negative embedding kwargs for an SDXL pipeline call, served from the cache where possible."""
+    with timed("prompt_encode"):
+        prompt_embeds, pooled_prompt_embeds = _encode_batch(pipe, prompts)
+        embeds = {
+            "prompt_embeds": prompt_embeds,
+            "pooled_prompt_embeds": pooled_prompt_embeds,
+        }
+        if guidance_scale > 1: # Negatives are only used with classifier-free guidance
+            negative_prompt_embeds, negative_pooled_prompt_embeds = _encode_batch(pipe, negative_prompts)
+            embeds["negative_prompt_embeds"] = negative_prompt_embeds
+            embeds["negative_pooled_prompt_embeds"] = negative_pooled_prompt_embeds
+    return embeds
+
+def get_prompt_cache_stats() -> dict:
+    return prompt_cache.stats()
@@ -0,0 +1,25 @@
+import os
+from utils.config import QUALITY_TIERS, DISTILLED_ADAPTERS
+
+
+def resolve_quality_tier(quality, mode: str | None = None):
+    """Returns the scheduler, step budget, guidance override and distilled adapter for a tier.
+
+    The scheduler is the mode's own when the tier overrides it (see QUALITY_TIERS). A tier listed
+    in DISTILLED_ADAPTERS uses its adapter settings when the weights exist locally.
+    """
+    if quality not in QUALITY_TIERS:
+        from utils.config import DEFAULT_QUALITY # Device-dependent, resolved lazily
+        quality = DEFAULT_QUALITY
+    tier = QUALITY_TIERS[quality]
+    scheduler = tier.get("mode_schedulers", {}).get(mode, tier["scheduler"])
+    settings = {"scheduler": scheduler, "steps": tier["steps"], "guidance_scale": None, "adapter": None}
+    distilled = DISTILLED_ADAPTERS.get(quality)
+    if distilled and os.path.isfile(distilled["path"]):
+        settings.update(
+            scheduler=distilled["scheduler"],
+            steps=distilled["steps"],
+            guidance_scale=distilled.get("guidance_scale"),
+            adapter=quality,
+        )
+    return settings
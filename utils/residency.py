@@ -0,0 +1,118 @@
+import time
+import threading
+from collections import OrderedDict
+import torch
+from utils.metrics import observe_stage
+
+
+def module_nbytes(module: torch.nn.Module) -> int:
+    """Bytes occupied by a module's parameters and buffers."""
+    total = 0
+    for tensor in list(module.parameters()) + list(module.buffers()):
+        total += tensor.numel() * tensor.element_size()
+    return total
+
+
+class ResidencyManager:
+    """Tracks which components live on the compute device and moves only what a request needs.
+
+    Placement is bookkept here rather than read back from the modules, so the same decisions
+    can be exercised on CPU (device="cpu") with a simulated budget.
+    """
+
+    def __init__(self, device, budget_bytes: int | None = None, offload_device="cpu"):
+        self.device = torch.device(device)
+        self.offload_device = torch.device(offload_device)
+        self.budget_bytes = budget_bytes # None = unlimited
+        self._components = {}            # key -> {"module": nn.Module, "bytes": int}
+        self._resident = OrderedDict()   # keys on the device, least recently used first
+        self._lock = threading.RLock()
+        self.evictions = 0
+        self.transfers = 0
+        self.transfer_seconds = 0.0
+
+    def register(self, key: str, module: torch.nn.Module, nbytes: int | None = None, resident: bool = False):
+        """Adds a component. `resident` states whether it already sits on the compute device."""
+        with self._lock:
+            self._components[key] = {
+                "module": module,
+                "bytes": module_nbytes(module) if nbytes is None else nbytes,
+            }
+            self._resident.pop(key, None)
+            if resident:
+                self._resident[key] = True
+
+    def unregister(self, key: str):
+        with self._lock:
+            self._components.pop(key, None)
+            self._resident.pop(key, None)
+
+    def is_resident(self, key: str) -> bool:
+        return key in self._resident
+
+    def resident_bytes(self) -> int:
+        return sum(self._components[key]["bytes"] for key in self._resident)
+
+    def _move(self, key: str, device):
+        start = time.perf_counter()
+        self._components[key]["module"].to(device)
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+        elapsed = time.perf_counter() - start
+        observe_stage("device_transfer", elapsed)
+        self.transfer_seconds += elapsed
+        self.transfers += 1
+
+    def evict(self, key: str):
+        """Moves a component back to the offload device."""
+        with self._lock:
+            if key not in self._resident:
+                return
+            self._move(key, self.offload_device)
+            del self._resident[key]
+            self.evictions += 1
+
+    def ensure(self, keys: list[str]) -> bool:
+        """Makes `keys` resident. No-op if they already are; evicts LRU components only when over budget.
+
+        Returns True if anything had to move.
+        """
+        with self._lock:
+            missing = [key for key in keys if key not in self._resident]
+            for key in keys:
+                if key in self._resident:
+                    self._resident.move_to_end(key) # Mark as recently used
+            if not missing:
+                return False
+
+            required = sum(self._components[key]["bytes"] for key in missing)
+            if self.budget_bytes is not None:
+                evictable = [key for key in self._resident if key not in keys] # LRU first
+                evicted_any = False
+                while evictable and self.resident_bytes() + required > self.budget_bytes:
+                    self.evict(evictable.pop(0))
+                    evicted_any = True
+                if evicted_any and self.device.type == "cuda":
+                    torch.cuda.empty_cache()
+                if self.resident_bytes() + required > self.budget_bytes:
+                    print(f"Warning: Working set {keys} exceeds the device memory budget "
+                          f"({(self.resident_bytes() + required) / 2**20:.0f}MB > {self.budget_bytes / 2**20:.0f}MB).")
+
+            for key in missing:
+                self._move(key, self.device)
+                self._resident[key] = True
+            return True
+
+    def stats(self) -> dict:
+        """Snapshot of the current placement and transfer counters."""
+        with self._lock:
+            return {
+                "device": str(self.device),
+                "budget_bytes": self.budget_bytes,
+                "resident": list(self._resident.keys()),
+                "resident_bytes": self.resident_bytes(),
+                "components": {key: info["bytes"] for key, info in self._components.items()},
+                "evictions": self.evictions,
+                "transfers": self.transfers,
+                "transfer_seconds": round(self.transfer_seconds, 4),
+            }
@@ -0,0 +1,153 @@
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from utils.config import (
+    RESULT_CACHE_MEMORY_MB, RESULT_CACHE_DISK_MB, RESULT_CACHE_DIR,
+    IMAGE_STORE_MEMORY_MB, IMAGE_STORE_DISK_MB, IMAGE_STORE_DIR
+)
+
+
+def content_key(fields: dict) -> str:
+    """Stable hash of a dict of JSON-serialisable fields."""
+    payload = json.dumps(fields, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    """Content-addressed byte store: an in-memory LRU that spills evicted entries to a bounded directory.
+
+    Disk entries are promoted back to memory on a hit; the directory is trimmed oldest-first
+    (by modification time, refreshed on every disk hit).
+    """
+
+    def __init__(self, max_memory_bytes: int, cache_dir: str | None, max_disk_bytes: int, suffix: str = ".png"):
+        self.max_memory_bytes = max_memory_bytes
+        self.cache_dir = cache_dir if cache_dir and max_disk_bytes > 0 else None
+        self.max_disk_bytes = max_disk_bytes
+        self.suffix = suffix
+        self._memory = OrderedDict() # key -> bytes, least recently used first
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0 # Entries pushed out of memory (spilled) plus files trimmed from disk
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key + self.suffix)
+
+    def get(self, key: str) -> bytes | None:
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return data
+
+        data = self._read_disk(key)
+        with self._lock:
+            if data is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+        self._put_memory(key, data)
+        return data
+
+    def put(self, key: str, data: bytes):
+        self._put_memory(key, data)
+
+    def _put_memory(self, key: str, data: bytes):
+        spilled = []
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return
+            self._memory[key] = data
+            self._memory_bytes += len(data)
+            while self._memory_bytes > self.max_memory_bytes and len(self._memory) > 1:
+                old_key, old_data = self._memory.popitem(last=False)
+                self._memory_bytes -= len(old_data)
+                self.evictions += 1
+                spilled.append((old_key, old_data))
+        for old_key, old_data in spilled:
+            self._write_disk(old_key, old_data)
+
+    def _read_disk(self, key: str) -> bytes | None:
+        if self.cache_dir is None:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path) # Refresh recency for trimming
+            return data
+        except OSError:
+            return None
+
+    def _write_disk(self, key: str, data: bytes):
+        if self.cache_dir is None:
+            return
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            path = self._path(key)
+            if not os.path.exists(path):
+                tmp_path = f"{path}.{threading.get_ident()}.tmp"
+                with open(tmp_path, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, path) # Atomic, so readers never see partial files
+            self._trim_disk()
+        except OSError as e:
+            print(f"Warning: Could not write result cache entry {key}: {e}")
+
+    def _trim_disk(self):
+        """Deletes the oldest cache files until the directory fits its budget."""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(self.suffix):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+                with self._lock:
+                    self.evictions += 1
+            except OSError:
+                pass
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "memory_entries": len(self._memory),
+                "memory_bytes": self._memory_bytes,
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+# Final emoji PNGs (shared by the blocking and job APIs)
+result_cache = ResultCache(
+    RESULT_CACHE_MEMORY_MB * 2**20,
+    RESULT_CACHE_DIR,
+    RESULT_CACHE_DISK_MB * 2**20,
+)
+
+# Encoded images served by /api/images/<id> (id = content hash + format extension)
+image_store = ResultCache(
+    IMAGE_STORE_MEMORY_MB * 2**20,
+    IMAGE_STORE_DIR,
+    IMAGE_STORE_DISK_MB * 2**20,
+    suffix=".img",
+)
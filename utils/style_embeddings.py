@@ -0,0 +1,171 @@
+import os
+import hashlib
+import numpy as np
+import torch
+from PIL import Image
+from utils.config import (
+    DEVICE,
+    STYLE_LIBRARIES,
+    NUM_STYLE_IMAGES_PER_LIBRARY,
+    IMAGE_ENCODER_ID,
+    IMAGE_ENCODER_SUBFOLDER,
+    ADAPTER_WEIGHT_PLUS,
+    STYLE_EMBEDS_FILENAME,
+    STYLE_EMBEDS_ADAPTER_WEIGHTS,
+)
+from utils.image_utils import list_style_image_files, load_style_images
+from utils.style_packs import load_style_pack
+from utils.style_manifest import load_library_manifest, trusted_file_hashes, file_sha256
+from utils.metrics import timed
+
+
+# (style_name, adapter_weight) -> {"hash": str, "embeds": torch.Tensor}
+# Embeds are stored on CPU as a (2, num_images, tokens, dim) tensor: [negative, positive].
+style_embeds_cache = {}
+
+
+def _embeds_path(style_dir: str, adapter_weight: str) -> str:
+    adapter_stem = os.path.splitext(adapter_weight)[0]
+    return os.path.join(style_dir, STYLE_EMBEDS_FILENAME.format(adapter=adapter_stem))
+
+def library_hash(style_dir: str, adapter_weight: str, num_images: int = NUM_STYLE_IMAGES_PER_LIBRARY) -> str | None:
+    """Content hash of a style library (file names + bytes) for a given encoder/adapter pair.
+
+    Libraries with a manifest hash the files' sha256 digests, taken from the manifest for files
+    unchanged since it was written, so unchanged images are not read.
+    """
+    image_files = list_style_image_files(style_dir)[:num_images]
+    if not image_files:
+        return None
+
+    manifest = load_library_manifest(style_dir)
+    trusted_hashes = trusted_file_hashes(style_dir, manifest) if manifest is not None else {}
+    hasher = hashlib.sha256()
+    hasher.update(f"{IMAGE_ENCODER_ID}/{IMAGE_ENCODER_SUBFOLDER}|{adapter_weight}".encode("utf-8"))
+    for file_path in image_files:
+        file_name = os.path.basename(file_path)
+        hasher.update(file_name.encode("utf-8"))
+        if manifest is not None:
+            hasher.update((trusted_hashes.get(file_name) or file_sha256(file_path)).encode("utf-8"))
+        else:
+            with open(file_path, "rb") as f:
+                hasher.update(f.read())
+    return hasher.hexdigest()
+
+@torch.no_grad()
+def encode_ip_adapter_images(pipe, images: list[Image.Image | np.ndarray]) -> torch.Tensor:
+    """Runs the CLIP vision encoder once and returns stacked [negative, positive] hidden states."""
+    with timed("ip_image_encode"):
+        image_embeds, uncond_image_embeds = pipe.encode_image(
+            images, DEVICE, 1, output_hidden_states=True # Plus / Plus-Face adapters use hidden states
+        )
+        return torch.stack([uncond_image_embeds, image_embeds])
+
+def prepare_ip_adapter_embeds(
+    pipe,
+    embeds_list: list[torch.Tensor | list[torch.Tensor]],
+    guidance_scale: float,
+    batch_size: int = 1,
+) -> list[torch.Tensor]:
+    """Converts stored [negative, positive] embeds into the pipeline's `ip_adapter_image_embeds` format.
+
+    Each entry (one per adapter) is either a single tensor shared by the whole batch, or a list
+    with one tensor per batch item (e.g. a different face per request).
+    """
+    do_classifier_free_guidance = guidance_scale > 1
+    prepared = []
+    for embeds in embeds_list:
+        items = embeds if isinstance(embeds, list) else [embeds] * batch_size
+        negative = torch.cat([item[0:1] for item in items])
+        positive = torch.cat([item[1:2] for item in items])
+        # The pipeline splits CFG embeds with .chunk(2): negatives first, then positives
+        batched = torch.cat([negative, positive]) if do_classifier_free_guidance else positive
+        prepared.append(batched.to(device=DEVICE, dtype=pipe.unet.dtype))
+    return prepared
+
+def load_style_embeds(style_name: str, adapter_weight: str = ADAPTER_WEIGHT_PLUS) -> torch.Tensor | None:
+    """Loads persisted embeds for a style library if they exist and match the library's content hash."""
+    style_dir = STYLE_LIBRARIES.get(style_name)
+    if style_dir is None or not os.path.isdir(style_dir):
+        return None
+
+    current_hash = library_hash(style_dir, adapter_weight)
+    cached = style_embeds_cache.get((style_name, adapter_weight))
+    if cached is not None and cached["hash"] == current_hash:
+        return cached["embeds"]
+
+    path = _embeds_path(style_dir, adapter_weight)
+    if not os.path.exists(path):
+        return None
+    try:
+        stored = torch.load(path, map_location="cpu")
+    except Exception as e:
+        print(f"Warning: Could not read style embeddings {path}: {e}")
+        return None
+    if stored.get("hash") != current_hash:
+        print(f"Style embeddings for '{style_name}' are stale (library changed), will recompute.")
+        return None
+
+    style_embeds_cache[(style_name, adapter_weight)] = stored
+    return stored["embeds"]
+
+def compute_style_embeds(pipe, style_name: str, adapter_weight: str = ADAPTER_WEIGHT_PLUS) -> torch.Tensor | None:
+    """Encodes a style library with the pipeline's image encoder and persists the result."""
+    style_dir = STYLE_LIBRARIES.get(style_name)
+    if style_dir is None:
+        print(f"Error: Unknown style library: {style_name}")
+        return None
+
+    # A packed library already matches the encoder's input size, so the processor's resize
+    # and crop are no-ops and no PNGs are decoded
+    crop_size = pipe.feature_extractor.crop_size["height"]
+    style_pack = load_style_pack(style_dir, crop_size)
+    if style_pack is not None:
+        style_images = list(style_pack)
+    else:
+        style_images = load_style_images(style_dir, NUM_STYLE_IMAGES_PER_LIBRARY)
+    if style_images is None or len(style_images) == 0:
+        return None
+
+    print(f"Computing IP-Adapter embeddings for style '{style_name}' ({adapter_weight})...")
+    embeds = encode_ip_adapter_images(pipe, style_images).cpu()
+    stored = {"hash": library_hash(style_dir, adapter_weight), "embeds": embeds}
+    style_embeds_cache[(style_name, adapter_weight)] = stored
+
+    path = _embeds_path(style_dir, adapter_weight)
+    try:
+        torch.save(stored, path)
+        print(f"Saved style embeddings to {path}")
+    except OSError as e:
+        print(f"Warning: Could not persist style embeddings to {path}: {e}")
+    return embeds
+
+def get_style_embeds(pipe, style_name: str, adapter_weight: str = ADAPTER_WEIGHT_PLUS) -> torch.Tensor | None:
+    """Returns style embeds from memory, falling back to disk and finally to the image encoder."""
+    cached = style_embeds_cache.get((style_name, adapter_weight))
+    if cached is not None:
+        return cached["embeds"]
+
+    embeds = load_style_embeds(style_name, adapter_weight)
+    if embeds is None:
+        embeds = compute_style_embeds(pipe, style_name, adapter_weight)
+    return embeds
+
+def style_library_hash(style_name: str, adapter_weight: str = ADAPTER_WEIGHT_PLUS) -> str | None:
+    """Content hash of a style library, reusing the hash of already-loaded embeds when available."""
+    cached = style_embeds_cache.get((style_name, adapter_weight))
+    if cached is not None:
+        return cached["hash"]
+    style_dir = STYLE_LIBRARIES.get(style_name)
+    if style_dir is None or not os.path.isdir(style_dir):
+        return None
+    return library_hash(style_dir, adapter_weight)
+
+def preload_style_embeds():
+    """Loads every persisted style embedding into memory (called once at startup)."""
+    for style_name in STYLE_LIBRARIES:
+        for adapter_weight in STYLE_EMBEDS_ADAPTER_WEIGHTS:
+            if load_style_embeds(style_name, adapter_weight) is not None:
+                print(f"Loaded style embeddings for '{style_name}' ({adapter_weight}).")
+            else:
+                print(f"No stored embeddings for '{style_name}' ({adapter_weight}), will compute on first use.")
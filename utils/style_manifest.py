@@ -0,0 +1,55 @@
+import os
+import json
+import hashlib
+from utils.config import STYLE_LIBRARY_MANIFEST
+
+
+def manifest_path(style_dir: str) -> str:
+    return os.path.join(style_dir, STYLE_LIBRARY_MANIFEST)
+
+def load_library_manifest(style_dir: str) -> dict | None:
+    """Reads a style library's manifest ({"style", "images": [entries in library order]}), if any."""
+    path = manifest_path(style_dir)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Warning: Could not read style library manifest {path}: {e}")
+        return None
+
+def write_library_manifest(style_dir: str, manifest: dict):
+    """Writes the manifest atomically, so an interrupted build never leaves a truncated file."""
+    path = manifest_path(style_dir)
+    temp_path = path + ".tmp"
+    with open(temp_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(temp_path, path)
+
+def file_sha256(file_path: str) -> str:
+    hasher = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(2**20), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+def trusted_file_hashes(style_dir: str, manifest: dict) -> dict[str, str]:
+    """{file name: sha256} for manifest entries that can be trusted without reading the file.
+
+    An entry is trusted when its file has the recorded size and was not modified after the
+    manifest was written; anything else has to be hashed again.
+    """
+    try:
+        manifest_mtime = os.stat(manifest_path(style_dir)).st_mtime_ns
+    except OSError:
+        return {}
+    hashes = {}
+    for entry in manifest.get("images", []):
+        try:
+            stat = os.stat(os.path.join(style_dir, entry["file"]))
+        except OSError:
+            continue
+        if stat.st_size == entry.get("bytes") and stat.st_mtime_ns <= manifest_mtime:
+            hashes[entry["file"]] = entry["sha256"]
+    return hashes
@@ -0,0 +1,80 @@
+import os
+import json
+import hashlib
+import numpy as np
+from PIL import Image
+from utils.config import (
+    NUM_STYLE_IMAGES_PER_LIBRARY,
+    STYLE_PACK_FILENAME,
+    STYLE_PACK_MANIFEST,
+    STYLE_PACK_SIZE,
+)
+from utils.image_utils import list_style_image_files, load_image_from_path
+
+
+def _pack_paths(style_dir: str, size: int) -> tuple[str, str]:
+    return (
+        os.path.join(style_dir, STYLE_PACK_FILENAME.format(size=size)),
+        os.path.join(style_dir, STYLE_PACK_MANIFEST.format(size=size)),
+    )
+
+def _file_signature(file_path: str) -> dict:
+    """Cheap identity of a source file (checked on every load; the sha256 is for auditing)."""
+    stat = os.stat(file_path)
+    return {"name": os.path.basename(file_path), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+def resize_and_crop(image: Image.Image, size: int) -> Image.Image:
+    """Shortest-edge bicubic resize + center crop, as the CLIP image processor does."""
+    width, height = image.size
+    scale = size / min(width, height)
+    resized = image.resize((max(size, round(width * scale)), max(size, round(height * scale))), Image.BICUBIC)
+    left = (resized.width - size) // 2
+    top = (resized.height - size) // 2
+    return resized.crop((left, top, left + size, top + size))
+
+def pack_style_library(style_dir: str, size: int = STYLE_PACK_SIZE, num_images: int = NUM_STYLE_IMAGES_PER_LIBRARY) -> str | None:
+    """Writes a style library as one (N, size, size, 3) uint8 .npy file plus a JSON manifest."""
+    image_files = list_style_image_files(style_dir)[:num_images]
+    if not image_files:
+        print(f"Warning: No style images in {style_dir}, nothing to pack.")
+        return None
+
+    pixels = np.empty((len(image_files), size, size, 3), dtype=np.uint8)
+    sources = []
+    for index, file_path in enumerate(image_files):
+        image = load_image_from_path(file_path)
+        if image is None:
+            print(f"Warning: Could not pack {file_path}, skipping library.")
+            return None
+        pixels[index] = np.asarray(resize_and_crop(image, size))
+        with open(file_path, "rb") as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        sources.append({**_file_signature(file_path), "sha256": digest})
+
+    pack_path, manifest_path = _pack_paths(style_dir, size)
+    np.save(pack_path, pixels)
+    with open(manifest_path, "w") as f:
+        json.dump({"size": size, "count": len(image_files), "sources": sources}, f, indent=2)
+    print(f"Packed {len(image_files)} images from {style_dir} into {pack_path} ({pixels.nbytes / 2**20:.1f}MB).")
+    return pack_path
+
+def load_style_pack(style_dir: str, size: int, num_images: int = NUM_STYLE_IMAGES_PER_LIBRARY) -> np.ndarray | None:
+    """Memory-maps a packed library (zero-copy, shared between processes).
+
+    Returns None if there is no pack at this resolution or it no longer matches the source files.
+    """
+    pack_path, manifest_path = _pack_paths(style_dir, size)
+    if not (os.path.exists(pack_path) and os.path.exists(manifest_path)):
+        return None
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        current = [_file_signature(file_path) for file_path in list_style_image_files(style_dir)[:num_images]]
+        packed = [{k: source[k] for k in ("name", "size", "mtime_ns")} for source in manifest["sources"]]
+        if manifest["size"] != size or packed != current:
+            print(f"Style pack for {style_dir} is stale, re-run pack_styles.py.")
+            return None
+        return np.load(pack_path, mmap_mode="r")
+    except (OSError, ValueError, KeyError) as e:
+        print(f"Warning: Could not read style pack {pack_path}: {e}")
+        return None
@@ -0,0 +1,108 @@
+import time
+import threading
+from PIL import Image
+from utils.config import WARMUP_MODES, WARMUP_STEPS, STYLE_LIBRARIES
+
+
+# Readiness per mode: pending -> loading -> ready | error
+warmup_state = {
+    "started_at": None,
+    "finished_at": None,
+    "modes": {mode: "pending" for mode in WARMUP_MODES},
+    "background_removal": "pending",
+    "errors": {},
+}
+_state_lock = threading.Lock()
+_warmup_thread = None
+
+
+def _set_status(component: str, status: str, error: str | None = None):
+    with _state_lock:
+        if component == "background_removal":
+            warmup_state["background_removal"] = status
+        else:
+            warmup_state["modes"][component] = status
+        if error is not None:
+            warmup_state["errors"][component] = error
+
+def warm_up_mode(mode: str):
+    """Loads a mode's models and runs one tiny dummy inference through the batch scheduler."""
+    from utils.batch_scheduler import GenerationRequest, submit_generation
+
+    uses_style = mode in ("text_style", "face_style")
+    request = GenerationRequest(
+        mode=mode,
+        prompt="warm-up",
+        style_name=next(iter(STYLE_LIBRARIES), None) if uses_style else None,
+        face_image=Image.new("RGB", (224, 224), (128, 128, 128)) if mode == "face_style" else None,
+        num_inference_steps=WARMUP_STEPS,
+        seed=0,
+    )
+    submit_generation(request).result()
+
+def run_warmup():
+    """Preloads style embeddings, warms every configured mode and the background-removal workers.
+
+    With a worker pool, each worker warms its own modes; only background removal is warmed here.
+    """
+    from utils.background_removal import warm_up_background_removal
+    from utils.worker_pool import worker_pool
+
+    with _state_lock:
+        warmup_state["started_at"] = time.time()
+    modes = WARMUP_MODES if worker_pool is None else []
+    if modes:
+        from utils.style_embeddings import preload_style_embeds
+        # Load persisted IP-Adapter style embeddings so style modes skip the image encoder
+        preload_style_embeds()
+
+    for mode in modes:
+        _set_status(mode, "loading")
+        start = time.perf_counter()
+        try:
+            warm_up_mode(mode)
+            _set_status(mode, "ready")
+            print(f"Warm-up of mode '{mode}' finished in {time.perf_counter() - start:.1f}s.")
+        except Exception as e:
+            print(f"Warm-up of mode '{mode}' failed: {e}")
+            _set_status(mode, "error", str(e))
+
+    _set_status("background_removal", "loading")
+    try:
+        # Load one rembg session per background-removal worker before taking traffic
+        if warm_up_background_removal():
+            _set_status("background_removal", "ready")
+        else:
+            _set_status("background_removal", "error", "Could not create every rembg session.")
+    except Exception as e:
+        _set_status("background_removal", "error", str(e))
+
+    with _state_lock:
+        warmup_state["finished_at"] = time.time()
+
+def start_warmup():
+    """Starts the warm-up thread (once); returns immediately."""
+    global _warmup_thread
+    with _state_lock:
+        if _warmup_thread is not None:
+            return
+        _warmup_thread = threading.Thread(target=run_warmup, name="warmup", daemon=True)
+        _warmup_thread.start()
+
+def readiness() -> dict:
+    """Snapshot for /readyz: ready once every configured mode is warm (on some worker, with a pool)."""
+    from utils.worker_pool import worker_pool
+
+    with _state_lock:
+        modes = dict(warmup_state["modes"]) if worker_pool is None else worker_pool.mode_status()
+        state = {
+            "ready": all(status == "ready" for status in modes.values()),
+            "modes": modes,
+            "background_removal": warmup_state["background_removal"], # Informational (rembg has a fallback)
+            "errors": dict(warmup_state["errors"]),
+            "started_at": warmup_state["started_at"],
+            "finished_at": warmup_state["finished_at"],
+        }
+    if worker_pool is not None:
+        state["workers"] = worker_pool.stats()["workers"]
+    return state
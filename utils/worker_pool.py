@@ -0,0 +1,402 @@
+import os
+import time
+import atexit
+import queue
+import itertools
+import threading
+import dataclasses
+import multiprocessing
+from multiprocessing.connection import wait as wait_for_connections
+from concurrent.futures import Future
+from utils.config import (
+    WORKERS,
+    WORKER_AFFINITY_PENALTY,
+    WORKER_RESTART_DELAY_SECONDS,
+    WORKER_HEALTH_INTERVAL_SECONDS,
+)
+from utils.batch_scheduler import (
+    GenerationRequest, GenerationError, GenerationCancelled, DeadlineExceeded, set_generation_backend
+)
+from utils.metrics import observe_stage, GENERATED_IMAGES
+# The front end never imports torch for this: models live in the worker processes, which
+# are spawned (not forked) so each one initialises CUDA and its own threads from scratch.
+
+GENERATION_MODES = ("text", "text_style", "face_style")
+
+# Request fields that stay in the front end (callbacks, the future and bookkeeping)
+_LOCAL_FIELDS = {"future", "progress", "preview", "on_cancel", "timings", "submitted_at", "deadline"}
+
+
+@dataclasses.dataclass
+class WorkerSpec:
+    """Modes a worker process serves and the device it runs them on (None = auto)."""
+    modes: list[str]
+    device: str | None = None
+
+
+def parse_worker_specs(value: str) -> list[WorkerSpec]:
+    """Parses "text@cuda:0;text_style,face_style@cuda:1" into worker specs. Raises ValueError."""
+    specs = []
+    for part in value.split(";"):
+        if not part.strip():
+            continue
+        modes_part, _, device = part.partition("@")
+        modes = [mode.strip() for mode in modes_part.split(",") if mode.strip()]
+        unknown = [mode for mode in modes if mode not in GENERATION_MODES]
+        if not modes or unknown:
+            raise ValueError(f"Invalid worker spec '{part}' (modes must be from {list(GENERATION_MODES)}).")
+        specs.append(WorkerSpec(modes, device.strip() or None))
+    return specs
+
+# --- Worker Process ---
+
+def _worker_main(worker_id: int, spec: WorkerSpec, cpu_threads: int, initializer, requests, events):
+    """Entry point of a worker process: warms its modes, then serves requests until told to stop.
+
+    Each worker runs the regular in-process batch scheduler, so compatible requests routed to
+    it are still batched. Results, progress, previews and stage timings go back on `events`,
+    this worker's own pipe to the front end.
+    """
+    # Device settings are resolved lazily, so the environment can still be adjusted here
+    if spec.device:
+        os.environ["APP_DEVICE"] = spec.device
+    if cpu_threads and not os.getenv("CPU_INTRA_OP_THREADS"):
+        os.environ["CPU_INTRA_OP_THREADS"] = str(cpu_threads)
+    if initializer is not None:
+        initializer()
+    from utils.batch_scheduler import submit_generation
+    from utils.metrics import stage_observers
+    from utils.warmup import warm_up_mode
+    from utils.style_embeddings import preload_style_embeds
+
+    send_lock = threading.Lock() # Events are sent from this thread and the scheduler thread
+
+    def emit(*event):
+        with send_lock:
+            events.send(event)
+
+    stage_observers.append(lambda stage, seconds: emit("stage", worker_id, stage, seconds))
+    print(f"Worker {worker_id} (pid {os.getpid()}) warming up modes {spec.modes} on {spec.device or 'auto'}...")
+    preload_style_embeds()
+    errors = {}
+    for mode in spec.modes:
+        try:
+            warm_up_mode(mode)
+        except Exception as e:
+            print(f"Worker {worker_id}: warm-up of mode '{mode}' failed: {e}")
+            errors[mode] = str(e)
+    emit("ready", worker_id, errors)
+
+    pending = {} # ticket -> GenerationRequest
+
+    def report(ticket: int, request: GenerationRequest, future: Future):
+        pending.pop(ticket, None)
+        try:
+            emit("result", worker_id, ticket, future.result(), request.timings)
+        except DeadlineExceeded as e:
+            emit("error", worker_id, ticket, "deadline", str(e), request.timings)
+        except GenerationCancelled as e:
+            emit("error", worker_id, ticket, "cancelled", str(e), request.timings)
+        except GenerationError as e:
+            emit("error", worker_id, ticket, "generation", str(e), request.timings)
+        except Exception as e:
+            emit("error", worker_id, ticket, "unexpected", f"{type(e).__name__}: {e}", request.timings)
+
+    parent = multiprocessing.parent_process()
+    while True:
+        try:
+            message = requests.get(timeout=WORKER_HEALTH_INTERVAL_SECONDS)
+        except queue.Empty:
+            if not parent.is_alive(): # Front end killed without stopping its workers
+                break
+            continue
+        if message is None:
+            break
+        kind, ticket = message[0], message[1]
+        if kind == "cancel":
+            if ticket in pending:
+                pending[ticket].cancel()
+            continue
+
+        fields, age, time_left, wants_progress, wants_preview = message[2:]
+        request = GenerationRequest(**fields)
+        # perf_counter values don't carry across processes, so ages and time left are sent
+        request.submitted_at = time.perf_counter() - age # Queue wait includes the time spent in IPC
+        if time_left is not None:
+            request.deadline = time.perf_counter() + time_left
+        if wants_progress:
+            request.progress = lambda step, total, ticket=ticket: emit("progress", worker_id, ticket, step, total)
+        if wants_preview:
+            request.preview = lambda step, thumbnail, ticket=ticket: emit("preview", worker_id, ticket, step, thumbnail)
+        pending[ticket] = request
+        submit_generation(request).add_done_callback(
+            lambda future, ticket=ticket, request=request: report(ticket, request, future)
+        )
+    print(f"Worker {worker_id} stopped.")
+
+# --- Front End ---
+
+class WorkerHandle:
+    """Front-end bookkeeping for one worker process (replaced processes keep the handle)."""
+
+    def __init__(self, worker_id: int, spec: WorkerSpec):
+        self.id = worker_id
+        self.spec = spec
+        self.process = None
+        self.requests = None   # This process's request queue
+        self.events = None     # Receiving end of this process's event pipe
+        self.inflight = {}     # ticket -> GenerationRequest
+        self.load = 0          # Images dispatched and not finished
+        self.last_mode = None  # Mode of the last dispatched request (its adapters are active)
+        self.ready = False
+        self.errors = {}       # mode -> warm-up error
+        self.restarts = 0
+        self.restart_at = None # Set while waiting to restart after an exit
+
+    @property
+    def state(self) -> str:
+        if self.process is None or not self.process.is_alive():
+            return "down"
+        return "ready" if self.ready else "loading"
+
+
+class WorkerPool:
+    """Routes generation requests to spawned worker processes, each pinned to modes and a device.
+
+    A request goes to the ready worker serving its mode with the least work in flight; workers
+    whose last request was another mode are charged `affinity_penalty` extra images, so mixed
+    traffic settles into one mode per worker instead of swapping adapters and residency on
+    every request. Workers that exit are restarted and their in-flight requests fail.
+    """
+
+    def __init__(self, specs: list[WorkerSpec], initializer=None,
+                 affinity_penalty: int = WORKER_AFFINITY_PENALTY, restart_delay: float = WORKER_RESTART_DELAY_SECONDS):
+        self.initializer = initializer # Picklable callable run first in every worker (e.g. the benchmark backbone)
+        self.affinity_penalty = affinity_penalty
+        self.restart_delay = restart_delay
+        self._context = multiprocessing.get_context("spawn")
+        self._workers = [WorkerHandle(worker_id, spec) for worker_id, spec in enumerate(specs)]
+        self._tickets = itertools.count()
+        self._lock = threading.Lock()
+        self._stopping = False
+        # CPU workers split the cores instead of each starting one thread per core
+        cpu_workers = sum(1 for spec in specs if spec.device == "cpu")
+        self._cpu_threads = max(1, (os.cpu_count() or 1) // cpu_workers) if cpu_workers else 0
+
+    def start(self):
+        for worker in self._workers:
+            self._spawn(worker)
+        threading.Thread(target=self._collect, name="worker-events", daemon=True).start()
+        threading.Thread(target=self._monitor, name="worker-monitor", daemon=True).start()
+
+    def _spawn(self, worker: WorkerHandle):
+        # Fresh channels: a crashed process may have left the old ones locked or half-written
+        worker.requests = self._context.Queue()
+        events, events_writer = self._context.Pipe(duplex=False)
+        worker.ready = False
+        worker.last_mode = None
+        worker.restart_at = None
+        cpu_threads = self._cpu_threads if worker.spec.device == "cpu" else 0
+        worker.process = self._context.Process(
+            target=_worker_main, name=f"generation-worker-{worker.id}",
+            args=(worker.id, worker.spec, cpu_threads, self.initializer, worker.requests, events_writer),
+        )
+        worker.process.start()
+        events_writer.close() # Only the worker writes, so its exit shows up as EOF here
+        worker.events = events
+        print(f"Started worker {worker.id} (pid {worker.process.pid}): modes {worker.spec.modes} on {worker.spec.device or 'auto'}.")
+
+    def _choose(self, mode: str) -> WorkerHandle | None:
+        """Least-loaded live worker serving the mode (ready workers first), with the affinity penalty."""
+        candidates = [worker for worker in self._workers if mode in worker.spec.modes and worker.state != "down"]
+        ready = [worker for worker in candidates if worker.ready and mode not in worker.errors]
+        candidates = ready or candidates
+        if not candidates:
+            return None
+        return min(candidates, key=lambda worker: (
+            worker.load + (self.affinity_penalty if worker.last_mode not in (None, mode) else 0),
+            worker.last_mode != mode,
+        ))
+
+    def submit(self, request: GenerationRequest) -> Future:
+        """Dispatches a request to a worker; returns a Future resolving to its generated PIL images."""
+        if request.cancelled:
+            request.future.set_exception(GenerationCancelled("Generation cancelled."))
+            return request.future
+        fields = {f.name: getattr(request, f.name) for f in dataclasses.fields(request) if f.name not in _LOCAL_FIELDS}
+        with self._lock:
+            worker = self._choose(request.mode)
+            if worker is None:
+                request.future.set_exception(GenerationError(f"No worker process is available for mode '{request.mode}'."))
+                return request.future
+            ticket = next(self._tickets)
+            worker.inflight[ticket] = request
+            worker.load += request.count
+            worker.last_mode = request.mode
+            requests = worker.requests
+        request.on_cancel = lambda: requests.put(("cancel", ticket))
+        now = time.perf_counter()
+        requests.put(("generate", ticket, fields, now - request.submitted_at,
+                      request.deadline - now if request.deadline is not None else None,
+                      request.progress is not None, request.preview is not None))
+        return request.future
+
+    def _finish(self, worker_id: int, ticket: int) -> GenerationRequest | None:
+        with self._lock:
+            worker = self._workers[worker_id]
+            request = worker.inflight.pop(ticket, None)
+            if request is not None:
+                worker.load -= request.count
+            return request
+
+    def _request(self, worker_id: int, ticket: int) -> GenerationRequest | None:
+        with self._lock:
+            return self._workers[worker_id].inflight.get(ticket)
+
+    def _collect(self):
+        """Applies worker events to the front-end requests (runs on its own thread)."""
+        while True:
+            with self._lock:
+                connections = [worker.events for worker in self._workers if worker.events is not None]
+            # The timeout picks up the pipes of restarted workers
+            for connection in wait_for_connections(connections, timeout=WORKER_HEALTH_INTERVAL_SECONDS):
+                try:
+                    event = connection.recv()
+                except (EOFError, OSError): # The worker exited; its events have all been read
+                    with self._lock:
+                        for worker in self._workers:
+                            if worker.events is connection:
+                                worker.events = None
+                    connection.close()
+                    continue
+                self._handle_event(event)
+
+    def _handle_event(self, event: tuple):
+        """Applies one worker event (on the collector thread)."""
+        kind, worker_id = event[0], event[1]
+        try:
+            if kind == "stage":
+                observe_stage(event[2], event[3])
+            elif kind == "ready":
+                with self._lock:
+                    self._workers[worker_id].ready = True
+                    self._workers[worker_id].errors = event[2]
+                print(f"Worker {worker_id} ready" + (f" (warm-up errors: {event[2]})" if event[2] else "."))
+            elif kind in ("progress", "preview"):
+                request = self._request(worker_id, event[2])
+                if request is not None:
+                    callback = request.progress if kind == "progress" else request.preview
+                    callback(event[3], event[4])
+            elif kind == "result":
+                request = self._finish(worker_id, event[2])
+                if request is not None:
+                    request.timings.update(event[4])
+                    GENERATED_IMAGES.inc(len(event[3]), mode=request.mode)
+                    request.future.set_result(event[3])
+            elif kind == "error":
+                request = self._finish(worker_id, event[2])
+                if request is not None:
+                    request.timings.update(event[5])
+                    error_kind, message = event[3], event[4]
+                    if error_kind == "deadline":
+                        request.future.set_exception(DeadlineExceeded(message))
+                    elif error_kind == "cancelled":
+                        request.future.set_exception(GenerationCancelled(message))
+                    elif error_kind == "generation":
+                        request.future.set_exception(GenerationError(message))
+                    else:
+                        request.future.set_exception(RuntimeError(f"Worker {worker_id}: {message}"))
+        except Exception as e:
+            print(f"Warning: Failed to handle worker event '{kind}': {e}")
+
+    def _monitor(self):
+        """Fails the in-flight requests of exited workers and restarts them after a delay."""
+        while not self._stopping:
+            time.sleep(WORKER_HEALTH_INTERVAL_SECONDS)
+            for worker in self._workers:
+                failed, error = [], None
+                with self._lock:
+                    if self._stopping or worker.process.is_alive():
+                        continue
+                    if worker.restart_at is None:
+                        print(f"Worker {worker.id} exited unexpectedly (exit code {worker.process.exitcode}), "
+                              f"restarting in {self.restart_delay:.0f}s.")
+                        error = f"Worker process exited unexpectedly (exit code {worker.process.exitcode}). Please retry."
+                        failed = list(worker.inflight.values())
+                        worker.inflight.clear()
+                        worker.load = 0
+                        worker.ready = False
+                        worker.restart_at = time.monotonic() + self.restart_delay
+                    elif time.monotonic() >= worker.restart_at:
+                        worker.restarts += 1
+                        self._spawn(worker)
+                for request in failed:
+                    if not request.future.done():
+                        request.future.set_exception(GenerationError(error))
+
+    def queue_depth(self) -> int:
+        """Requests dispatched to workers and not finished yet."""
+        with self._lock:
+            return sum(len(worker.inflight) for worker in self._workers)
+
+    def mode_status(self) -> dict:
+        """Per mode: ready if any worker serving it is warm, else loading (or error when none is live)."""
+        with self._lock:
+            status = {}
+            for mode in GENERATION_MODES:
+                states = [worker.state for worker in self._workers
+                          if mode in worker.spec.modes and mode not in worker.errors]
+                if not any(mode in worker.spec.modes for worker in self._workers):
+                    continue
+                status[mode] = "ready" if "ready" in states else "loading" if "loading" in states else "error"
+            return status
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "workers": [{
+                    "id": worker.id,
+                    "pid": worker.process.pid if worker.process is not None else None,
+                    "modes": worker.spec.modes,
+                    "device": worker.spec.device,
+                    "state": worker.state,
+                    "inflight": len(worker.inflight),
+                    "load": worker.load,
+                    "last_mode": worker.last_mode,
+                    "restarts": worker.restarts,
+                    "errors": dict(worker.errors),
+                } for worker in self._workers],
+                "restarts": sum(worker.restarts for worker in self._workers),
+            }
+
+    def stop(self, timeout: float = 10.0):
+        """Asks every worker to exit after its queued requests and waits for them."""
+        self._stopping = True
+        for worker in self._workers:
+            if worker.process is not None and worker.process.is_alive():
+                worker.requests.put(None)
+        for worker in self._workers:
+            if worker.process is not None:
+                worker.process.join(timeout)
+                if worker.process.is_alive():
+                    worker.process.terminate()
+
+
+# Shared pool used by the Flask app (None = generation runs in this process)
+worker_pool = None
+
+def start_worker_pool(specs: list[WorkerSpec] | None = None, initializer=None) -> WorkerPool | None:
+    """Starts the worker pool (once) from `specs` or the WORKERS setting and routes generation to it.
+
+    Returns None when no workers are configured.
+    """
+    global worker_pool
+    if worker_pool is None:
+        specs = specs if specs is not None else parse_worker_specs(WORKERS)
+        if not specs:
+            return None
+        worker_pool = WorkerPool(specs, initializer)
+        worker_pool.start()
+        atexit.register(worker_pool.stop) # Before multiprocessing joins the (non-daemonic) workers
+        set_generation_backend(worker_pool)
+    return worker_pool